@@ -0,0 +1,78 @@
+"""
+	- Redis memory and read latency of the chunk digests of a payload, stored the legacy way (a
+	chunks:payloadId hash, one hex digest per field) vs packed (merkle:payloadId:0, the digests back to
+	back). --payloads payloads of every --sizes are written in both layouts, then every payload is read
+	whole (HGETALL vs GET) and a --range chunk range of it (HMGET vs GETRANGE).
+	- The keys are written with the layouts of the tracker but under bench_layout:*, and removed at the end.
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_chunk_layout.py
+"""
+import argparse
+import os
+import time
+
+import redis
+
+from hashing import CHUNK_SIZE
+from merkle import DIGEST_SIZE
+
+SIZES = [64 * 1024, 1024 * 1024] # 4 byte chunks, a 1 MiB payload is 256k digests
+
+
+def timed(conn, calls):
+	"""
+		- Run calls (functions of a pipeline) in one pipeline each, returns the mean milliseconds per call
+	"""
+	start = time.perf_counter()
+	for call in calls:
+		pipe = conn.pipeline(transaction=False)
+		call(pipe)
+		pipe.execute()
+	return (time.perf_counter() - start) / len(calls) * 1000
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+	parser.add_argument('--payloads', type=int, default=10)
+	parser.add_argument('--range', type=int, default=16, help="chunks in a range read")
+	args = parser.parse_args()
+
+	conn = redis.StrictRedis()
+	print(f"{'size':>10} {'chunks':>7} {'hash B':>10} {'packed B':>10} {'ratio':>6}"
+		f" {'HGETALL ms':>11} {'GET ms':>8} {'HMGET ms':>9} {'GETRANGE ms':>12}")
+	try:
+		for size in args.sizes:
+			count = -(-size // CHUNK_SIZE)
+			hashes, packed = [], []
+			for i in range(args.payloads):
+				digests = [os.urandom(DIGEST_SIZE) for _ in range(count)]
+				hashes.append(f'bench_layout:chunks:{size}:{i}')
+				packed.append(f'bench_layout:merkle:{size}:{i}:0')
+				pipe = conn.pipeline(transaction=False)
+				fields = {str(n): d.hex() for n, d in enumerate(digests)}
+				items = list(fields.items())
+				for start in range(0, len(items), 10000):
+					pipe.hset(hashes[-1], mapping=dict(items[start:start + 10000]))
+				pipe.set(packed[-1], b''.join(digests))
+				pipe.execute()
+
+			hash_bytes = sum(conn.memory_usage(k, samples=0) for k in hashes) / args.payloads
+			packed_bytes = sum(conn.memory_usage(k) for k in packed) / args.payloads
+			start = max(0, count // 2 - args.range // 2)
+			end = min(count, start + args.range)
+			fields = [str(n) for n in range(start, end)]
+			hgetall = timed(conn, [lambda p, k=k: p.hgetall(k) for k in hashes])
+			get = timed(conn, [lambda p, k=k: p.get(k) for k in packed])
+			hmget = timed(conn, [lambda p, k=k: p.hmget(k, fields) for k in hashes])
+			getrange = timed(conn, [lambda p, k=k: p.getrange(k, start * DIGEST_SIZE, end * DIGEST_SIZE - 1) for k in packed])
+			print(f"{size:>10} {count:>7} {hash_bytes:>10.0f} {packed_bytes:>10.0f} {hash_bytes / packed_bytes:>6.2f}"
+				f" {hgetall:>11.3f} {get:>8.3f} {hmget:>9.3f} {getrange:>12.3f}")
+	finally:
+		keys = list(conn.scan_iter(match='bench_layout:*', count=1000))
+		for start in range(0, len(keys), 1000):
+			conn.delete(*keys[start:start + 1000])
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,76 @@
+"""
+	- End to end time of one verification of a large payload, JSON claims vs binary claims.
+	- Both peers run over one framed channel, binary claims are switched off on the target for the
+	JSON runs. The request and response sizes are measured separately, in process.
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_claims.py
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import string
+import time
+
+from claims import encode_claims
+from node import Node
+
+SIZES = [64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def verify_time(client, target, payloadId, repeat):
+	client.connected_peers.clear()
+	channel = client.connect_to_node(target.host, target.port)
+	best = float('inf')
+	for _ in range(repeat):
+		start = time.perf_counter()
+		results = client.verify_payload(payloadId, peer_id=channel.target_id)['results']
+		assert all(results) if isinstance(results, list) else results.all()
+		best = min(best, time.perf_counter() - start)
+	return best, channel
+
+
+def message_sizes(node, channel, payloadId, binary):
+	chunks = node.available_payloads.chunks(payloadId)
+	if binary:
+		request = encode_claims(payloadId, range(len(chunks)), chunks)
+		return len(request), len(node.parse_binary_claims(request, channel))
+	request = json.dumps({'payloadId': payloadId, 'claims': [{'chunk': c, 'position': i} for i, c in enumerate(chunks)]})
+	return len(request), len(node.parse_claims(request, channel))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Payload sizes in characters')
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--port', type=int, default=2070)
+	args = parser.parse_args()
+
+	rows = []
+	with contextlib.redirect_stdout(io.StringIO()):
+		target = Node('127.0.0.1', args.port)
+		target.daemon = True
+		target.start()
+		client = Node('127.0.0.1', args.port + 1)
+		for size in args.sizes:
+			payload = ''.join(random.choices(string.ascii_letters, k=size))
+			payloadId = f'payload_bench_{size}'
+			for peer in (target, client):
+				peer.available_payloads[payloadId] = payload
+			for binary in (False, True):
+				target.binary_claims = binary
+				seconds, channel = verify_time(client, target, payloadId, args.repeat)
+				request, response = message_sizes(client, channel, payloadId, binary)
+				channel.close()
+				rows.append((size, 'binary' if binary else 'json', seconds, request, response))
+		client.kill()
+		target.kill()
+
+	print(f"{'size':>10} {'claims':>8} {'ms':>10} {'request B':>12} {'response B':>12}")
+	for size, mode, seconds, request, response in rows:
+		print(f"{size:>10} {mode:>8} {seconds * 1000:>10.1f} {request:>12} {response:>12}")
+
+
+if __name__ == "__main__":
+	main()
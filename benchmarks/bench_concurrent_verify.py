@@ -0,0 +1,113 @@
+"""
+	- Verify throughput of a single peer as the number of concurrent verifiers grows.
+	- Every verification is a connect_to_node followed by a verify_payload, the same sequence
+	simulate.py uses. connect_to_node reuses the open channel when both peers speak frames.
+	- The payload is put into available_payloads directly, so only Redis is needed (no tracker).
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_concurrent_verify.py --mode both
+"""
+import argparse
+import contextlib
+import io
+import random
+import string
+import threading
+import time
+
+from node import Node
+
+CONCURRENCY = [1, 2, 5, 10, 20, 50, 100]
+
+
+def percentile(values, p):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_level(target, clients, payloadId, duration):
+	"""
+		- Every client keeps verifying against the target until the deadline and records its latencies
+	"""
+	latencies = [[] for _ in clients]
+	errors = [0]
+	barrier = threading.Barrier(len(clients) + 1)
+
+	def worker(i, client):
+		barrier.wait()
+		deadline = time.perf_counter() + duration
+		while time.perf_counter() < deadline:
+			start = time.perf_counter()
+			try:
+				client.connect_to_node(target.host, target.port)
+				client.verify_payload(payloadId)
+			except Exception:
+				errors[0] += 1
+				continue
+			latencies[i].append(time.perf_counter() - start)
+
+	threads = [threading.Thread(target=worker, args=(i, c)) for i, c in enumerate(clients)]
+	for t in threads:
+		t.start()
+	barrier.wait()
+	for t in threads:
+		t.join()
+
+	flat = [l for per_client in latencies for l in per_client]
+	return {
+		'ops': len(flat),
+		'ops_per_sec': len(flat) / duration,
+		'p50_ms': percentile(flat, 50) * 1000,
+		'p99_ms': percentile(flat, 99) * 1000,
+		'errors': errors[0],
+	}
+
+
+def bench_mode(use_asyncio, args):
+	payload = ''.join(random.choice(string.ascii_letters) for _ in range(args.payload_size))
+	payloadId = 'payload_bench'
+	results = []
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		target = Node('127.0.0.1', args.port, use_asyncio=use_asyncio)
+		target.daemon = True
+		target.start()
+		target.available_payloads[payloadId] = payload
+		clients = []
+		for i in range(max(args.concurrency)):
+			client = Node('127.0.0.1', args.port + 1 + i)
+			client.available_payloads[payloadId] = payload
+			clients.append(client)
+
+		for c in args.concurrency:
+			results.append((c, run_level(target, clients[:c], payloadId, args.duration)))
+
+		target._stop_event.set()
+		target.shutdown()
+		for client in clients:
+			client.sock.close()
+
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--mode', choices=['thread', 'asyncio', 'both'], default='both')
+	parser.add_argument('--concurrency', type=int, nargs='+', default=CONCURRENCY)
+	parser.add_argument('--duration', type=float, default=3.0, help='Seconds per concurrency level')
+	parser.add_argument('--payload-size', type=int, default=1024)
+	parser.add_argument('--port', type=int, default=2060)
+	args = parser.parse_args()
+
+	modes = ['thread', 'asyncio'] if args.mode == 'both' else [args.mode]
+	for mode in modes:
+		print(f"Mode: {mode}")
+		print(f"{'verifiers':>10} {'ops/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>8}")
+		for c, r in bench_mode(mode == 'asyncio', args):
+			print(f"{c:>10} {r['ops_per_sec']:>10.1f} {r['p50_ms']:>10.2f} {r['p99_ms']:>10.2f} {r['errors']:>8}")
+		print()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,83 @@
+"""
+	- Block store savings on versioned payloads: --versions revisions of a --size character document, each
+	one a copy of the previous with --edits random characters replaced, are uploaded to the tracker.
+	- Every few versions, prints the Redis memory of the block store (storeMemory of /dedup_report) next
+	to the memory the same versions take as claimed strings, measured by writing them under
+	bench_dedup:claimed:* and removing them again, and the growth of the whole Redis memory (the merkle
+	trees of the payloads included). Then deletes the payloads and checks that the store is back where
+	it started.
+	- An edit only changes the store block it falls in, so every version adds at most --edits blocks to
+	the store.
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_dedup.py (needs the tracker running)
+"""
+import argparse
+import random
+import string
+import time
+
+import redis
+import requests
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--tracker', default='http://127.0.0.1:8000')
+	parser.add_argument('--size', type=int, default=256 * 1024)
+	parser.add_argument('--versions', type=int, default=20)
+	parser.add_argument('--edits', type=int, default=100)
+	args = parser.parse_args()
+
+	conn = redis.StrictRedis()
+	session = requests.Session()
+	report = lambda: session.get(f"{args.tracker}/dedup_report").json()
+	memory = lambda: conn.info('memory')['used_memory']
+	before, memory_before = report(), memory()
+
+	document = random.choices(string.ascii_letters, k=args.size)
+	payloadIds, texts = [], []
+	print(f"{'versions':>8} {'logical MB':>11} {'store MB':>9} {'claimed MB':>11} {'saved MB':>9} {'ratio':>6}"
+		f" {'redis MB':>9} {'upload ms':>10}")
+	try:
+		for version in range(1, args.versions + 1):
+			for _ in range(args.edits):
+				document[random.randrange(args.size)] = random.choice(string.ascii_letters)
+			texts.append(''.join(document))
+			start = time.perf_counter()
+			r = session.post(f"{args.tracker}/upload_payload/", json={'payload': texts[-1]})
+			r.raise_for_status()
+			elapsed = time.perf_counter() - start
+			payloadIds.append(r.json()['payloadId'])
+			if version % max(1, args.versions // 5) and version != args.versions:
+				continue
+			now, grown = report(), memory() - memory_before
+			logical = now['logicalBytes'] - before['logicalBytes']
+			store = now['storeMemory'] - before['storeMemory']
+			claimed = claimed_memory(conn, texts, memory)
+			print(f"{version:>8} {logical / 2 ** 20:>11.2f} {store / 2 ** 20:>9.2f} {claimed / 2 ** 20:>11.2f}"
+				f" {(claimed - store) / 2 ** 20:>9.2f} {claimed / store:>6.2f} {grown / 2 ** 20:>9.2f} {elapsed * 1000:>10.1f}")
+	finally:
+		freed = sum(session.delete(f"{args.tracker}/delete_payload/", json={'id': payloadId}).json().get('freedBytes', 0)
+			for payloadId in payloadIds)
+	after = report()
+	print(f"deleted {len(payloadIds)} payloads, {freed / 2 ** 20:.2f} MB freed,"
+		f" store back to the start: {after['storedBytes'] == before['storedBytes']}")
+
+
+def claimed_memory(conn, texts, memory):
+	"""
+		- The Redis memory the texts take as claimed strings, one string key each
+	"""
+	keys = [f'bench_dedup:claimed:{i}' for i in range(len(texts))]
+	start = memory()
+	pipe = conn.pipeline(transaction=False)
+	for key, text in zip(keys, texts):
+		pipe.set(key, text)
+	pipe.execute()
+	used = memory() - start
+	conn.delete(*keys)
+	return used
+
+
+if __name__ == "__main__":
+	main()
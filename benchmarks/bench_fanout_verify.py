@@ -0,0 +1,70 @@
+"""
+	- Time to verify a payload with K peers: one verify_payload after the other vs verify_payload_many,
+	which sends the claims to all of them at once and stops at the quorum.
+	- Every peer answers after --delay seconds on top of the real work, like a peer on another host.
+	- The payload is put into available_payloads directly, so only Redis is needed (no tracker).
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_fanout_verify.py
+"""
+import argparse
+import contextlib
+import io
+import random
+import string
+import time
+
+from node import Node
+
+PEERS = [1, 3, 5, 9]
+
+
+class SlowNode(Node):
+	delay = 0.0
+
+	def handle_request(self, msg_type, data, channel):
+		time.sleep(self.delay)
+		return super().handle_request(msg_type, data, channel)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--peers', type=int, nargs='+', default=PEERS)
+	parser.add_argument('--size', type=int, default=256 * 1024)
+	parser.add_argument('--delay', type=float, default=0.02)
+	parser.add_argument('--samples', type=int, default=10)
+	parser.add_argument('--port', type=int, default=1300)
+	args = parser.parse_args()
+
+	SlowNode.delay = args.delay
+	payload = ''.join(random.choices(string.ascii_letters, k=args.size))
+	print(f"{'peers':>6} {'one by one ms':>14} {'fan-out ms':>11}")
+	port = args.port
+	for count in args.peers:
+		with contextlib.redirect_stdout(io.StringIO()):
+			verifier = Node('127.0.0.1', port)
+			peers = [SlowNode('127.0.0.1', port + 1 + i) for i in range(count)]
+			port += count + 1
+			for peer in peers:
+				peer.daemon = True
+				peer.start()
+			for peer in [verifier] + peers:
+				peer.available_payloads['payload_bench'] = payload
+			ids = [verifier.connect_to_node(peer.host, peer.port).target_id for peer in peers]
+
+			start = time.perf_counter()
+			for _ in range(args.samples):
+				assert all(all(verifier.verify_payload('payload_bench', peer_id=i)['results']) for i in ids)
+			sequential = (time.perf_counter() - start) / args.samples
+
+			start = time.perf_counter()
+			for _ in range(args.samples):
+				assert verifier.verify_payload_many('payload_bench', peer_ids=ids)['valid']
+			fanout = (time.perf_counter() - start) / args.samples
+
+			for peer in [verifier] + peers:
+				peer.kill()
+		print(f"{count:>6} {sequential * 1000:>14.1f} {fanout * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,88 @@
+"""
+	- Peer list convergence by gossip, and how many /get_peers requests it saves the tracker.
+	- --peers peers join one after the other, each one only asks the tracker for the list once when it
+	joins. Then gossip is started on all of them and the time until every peer has the latest list is
+	measured, for a few fanouts.
+	- For comparison, every peer then polls the tracker for the changes (sync_peers) at the same interval
+	for --duration seconds.
+
+	Usage: export PYTHONPATH=src; python3 src/server.py & python3 benchmarks/bench_gossip.py
+"""
+import argparse
+import threading
+import time
+
+from node import Node
+
+
+def get_peers_requests(nodes):
+	total = 0
+	for node in nodes:
+		for labels, summary in node.stats.summary().get('tracker_request_seconds', {}).items():
+			if 'get_peers' in labels:
+				total += summary['count']
+	return total
+
+
+def converge(args, fanout, base_port):
+	nodes = []
+	for i in range(args.peers):
+		nodes.append(Node._build_and_run(port=base_port + i, tracker=args.tracker))
+		nodes[-1].get_peers()
+	latest = nodes[-1].peers_version
+	start = time.perf_counter()
+	for node in nodes:
+		node.start_gossip(interval=args.interval, fanout=fanout, tracker_interval=None)
+	while not all(node.peers_version == latest for node in nodes):
+		time.sleep(0.01)
+	elapsed = time.perf_counter() - start
+	requests = get_peers_requests(nodes)
+	for node in nodes:
+		node.kill()
+	return elapsed, requests
+
+
+def poll(args, base_port):
+	nodes = [Node._build_and_run(port=base_port + i, tracker=args.tracker) for i in range(args.peers)]
+	stop = threading.Event()
+
+	def poller(node):
+		while not stop.wait(args.interval):
+			node.sync_peers()
+
+	threads = [threading.Thread(target=poller, args=(node,)) for node in nodes]
+	for thread in threads:
+		thread.start()
+	time.sleep(args.duration)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	requests = get_peers_requests(nodes)
+	for node in nodes:
+		node.kill()
+	return requests
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--tracker', default='http://127.0.0.1:8000')
+	parser.add_argument('--peers', type=int, default=20)
+	parser.add_argument('--fanout', type=int, nargs='+', default=[1, 2, 3])
+	parser.add_argument('--interval', type=float, default=0.2)
+	parser.add_argument('--duration', type=float, default=5)
+	parser.add_argument('--port', type=int, default=1200)
+	args = parser.parse_args()
+
+	results = []
+	for i, fanout in enumerate(args.fanout):
+		results.append((fanout,) + converge(args, fanout, args.port + i * args.peers))
+	polled = poll(args, args.port + len(args.fanout) * args.peers)
+
+	print(f"{'fanout':>6} {'converged s':>12} {'/get_peers requests':>20}")
+	for fanout, elapsed, requests in results:
+		print(f"{fanout:>6} {elapsed:>12.2f} {requests:>20}")
+	print(f"polling the tracker every {args.interval}s for {args.duration}s: {polled} /get_peers requests")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,70 @@
+"""
+	- Chunk hashing throughput in MB/s for growing payload sizes.
+	- legacy: the old per-chunk slice/encode/hexdigest loop
+	- serial: hashing.generate_hashes on one core
+	- parallel: hashing.generate_hashes with the process pool (HASH_WORKERS processes)
+	- Every mode has to produce the same hashes, the benchmark fails otherwise.
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_hashing.py
+"""
+import argparse
+import hashlib
+import random
+import string
+import time
+
+import hashing
+
+SIZES = [64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+
+
+def legacy_hashes(payload_string, chunk_size):
+	hashes = []
+	for i in range(0, len(payload_string), chunk_size):
+		hashes.append(hashlib.sha224(payload_string[i:i+chunk_size].encode()).hexdigest())
+	return hashes, hashlib.sha224(''.join(hashes).encode()).hexdigest()
+
+
+def serial_hashes(payload_string, chunk_size):
+	threshold, hashing.PARALLEL_THRESHOLD = hashing.PARALLEL_THRESHOLD, float('inf')
+	try:
+		return hashing.generate_hashes(payload_string, chunk_size)
+	finally:
+		hashing.PARALLEL_THRESHOLD = threshold
+
+
+def parallel_hashes(payload_string, chunk_size):
+	return hashing.generate_hashes(payload_string, chunk_size)
+
+
+def measure(generate, payload_string, chunk_size, repeat):
+	best = float('inf')
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = generate(payload_string, chunk_size)
+		best = min(best, time.perf_counter() - start)
+	return result, len(payload_string) / best / 2 ** 20
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Payload sizes in characters')
+	parser.add_argument('--chunk-size', type=int, default=hashing.CHUNK_SIZE)
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	modes = {'legacy': legacy_hashes, 'serial': serial_hashes, 'parallel': parallel_hashes}
+	print(f"workers: {hashing.HASH_WORKERS}, parallel above {hashing.PARALLEL_THRESHOLD} bytes")
+	print(f"{'size':>10} {'mode':>10} {'MB/s':>8}")
+	for size in args.sizes:
+		payload_string = ''.join(random.choices(string.ascii_letters, k=size))
+		expected = None
+		for mode, generate in modes.items():
+			result, mb_per_sec = measure(generate, payload_string, args.chunk_size, args.repeat)
+			expected = expected or result
+			assert result == expected, f"{mode} hashes differ from legacy"
+			print(f"{size:>10} {mode:>10} {mb_per_sec:>8.2f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,60 @@
+"""
+	- Cost of Node.log_activities on the calling thread.
+	- sync: the old way, a LPUSH + LTRIM + INCR pipeline per log
+	- shipped: the log goes on the LogShipper queue, the time to write everything out is reported too
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_logging.py
+"""
+import argparse
+import contextlib
+import io
+import time
+from datetime import datetime
+
+from node import Node, SEVERITY
+
+
+def log_sync(node, message, severity):
+	postfix = f"{node.host}:{node.port}.{node.id}:{severity.name}"
+	pipe = node.conn.pipeline()
+	pipe.lpush(f"p2p:{postfix}", datetime.strftime(datetime.now(), "%y/%m/%d %H:%M:%S") + message)
+	pipe.ltrim(f"p2p:{postfix}", 0, node.trim)
+	pipe.incr(f"counter:{postfix}")
+	pipe.execute()
+
+
+def measure(log, count):
+	latencies = []
+	for i in range(count):
+		start = time.perf_counter()
+		log(f"verification {i}", SEVERITY.VERIFY_CLAIM)
+		latencies.append(time.perf_counter() - start)
+	latencies.sort()
+	return sum(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--count', type=int, default=20000, help='Logs per mode')
+	parser.add_argument('--port', type=int, default=2080)
+	args = parser.parse_args()
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		node = Node('127.0.0.1', args.port)
+	rows = [('sync', *measure(lambda m, s: log_sync(node, m, s), args.count))]
+	total, p50, p99 = measure(node.log_activities, args.count)
+	start = time.perf_counter()
+	node.log_shipper.flush(timeout=60)
+	rows.append(('shipped', total, p50, p99))
+	drained = time.perf_counter() - start
+
+	print(f"{'mode':>8} {'logs/s':>10} {'p50 us':>8} {'p99 us':>8}")
+	for mode, total, p50, p99 in rows:
+		print(f"{mode:>8} {args.count / total:>10.0f} {p50 * 1e6:>8.1f} {p99 * 1e6:>8.1f}")
+	print(f"shipper wrote the last logs {drained * 1000:.1f} ms later, dropped {node.log_shipper.dropped}")
+	with contextlib.redirect_stdout(io.StringIO()):
+		node.kill()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,70 @@
+"""
+	- Node.metrics latency as the number of other keys in Redis grows.
+	- keys: the old way, KEYS for every severity followed by a GET per counter
+	- hash: one HMGET on the counter hash of the peer (or of its host with --ignore-id)
+	- The filler keys are removed at the end.
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_metrics.py
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from node import Node, SEVERITY
+
+FILLERS = [0, 10000, 100000, 1000000]
+
+
+def keys_metrics(node, ignore_id):
+	data = {}
+	for severity in SEVERITY:
+		prefix = f"counter:{node.host}:{node.port}"
+		prefix = f"{prefix}.*:{severity.name}" if ignore_id else f"{prefix}.{node.id}:{severity.name}"
+		data[severity.name] = sum(int(node.conn.get(k)) for k in node.conn.keys(prefix))
+	return data
+
+
+def fill(conn, start, end):
+	for first in range(start, end, 10000):
+		pipe = conn.pipeline(transaction=False)
+		for i in range(first, min(end, first + 10000)):
+			pipe.set(f"bench:filler:{i}", i)
+		pipe.execute()
+
+
+def measure(metrics, repeat):
+	start = time.perf_counter()
+	for _ in range(repeat):
+		metrics()
+	return (time.perf_counter() - start) / repeat
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--fillers', type=int, nargs='+', default=FILLERS, help='Other keys in Redis')
+	parser.add_argument('--repeat', type=int, default=10)
+	parser.add_argument('--ignore-id', action='store_true')
+	parser.add_argument('--port', type=int, default=2090)
+	args = parser.parse_args()
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		node = Node('127.0.0.1', args.port)
+	filled = 0
+	print(f"{'other keys':>12} {'keys ms':>10} {'hash ms':>10}")
+	try:
+		for fillers in sorted(args.fillers):
+			fill(node.conn, filled, fillers)
+			filled = max(filled, fillers)
+			old = measure(lambda: keys_metrics(node, args.ignore_id), args.repeat)
+			new = measure(lambda: node.metrics(ignore_id=args.ignore_id), args.repeat)
+			print(f"{fillers:>12} {old * 1000:>10.2f} {new * 1000:>10.2f}")
+	finally:
+		for first in range(0, filled, 10000):
+			node.conn.delete(*[f"bench:filler:{i}" for i in range(first, min(filled, first + 10000))])
+		with contextlib.redirect_stdout(io.StringIO()):
+			node.kill()
+
+
+if __name__ == "__main__":
+	main()
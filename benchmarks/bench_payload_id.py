@@ -0,0 +1,111 @@
+"""
+	- Payload Ids: the 12 letter Id of the old upload path (its own pass over the payload, before hashing)
+	vs derive_id (the first 32 hex characters of the full hash, which the upload computes anyway).
+	- cost: ms per MiB to hash a payload, and to hash it and derive the Id both ways
+	- collisions: Ids shared by different documents among --versions versions of a 4 KiB document, each
+	one a copy of the previous with one character changed at a random position
+	- lookup: /upload_payload of new 1 KiB payloads through server.ingest_payloads, with payload_filter vs
+	a filter that knows every payload (the Redis lookup is always made), and of payloads already stored
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_payload_id.py
+"""
+import argparse
+import asyncio
+import random
+import string
+import time
+
+import server
+from hashing import generate_digests, full_hash
+
+
+def legacy_id(text):
+	# Every character of the Id only depends on the characters at its position modulo 12
+	x = [i for i in range(12)]
+	if len(text) < 12:
+		text += ''.join([str(i) for i in range(12 - len(text))])
+	for j in range(12):
+		for c in map(ord, text[j::12]):
+			x[j] = 65 + x[j] * c % 25
+	return f"payload_{''.join([chr(k) for k in x])}"
+
+
+class KnowsEverything:
+	def __contains__(self, item):
+		return True
+
+	def add(self, item):
+		pass
+
+
+def timed(call, repeat):
+	start = time.perf_counter()
+	for _ in range(repeat):
+		call()
+	return (time.perf_counter() - start) / repeat * 1000
+
+
+def cost(size, repeat):
+	payload = ''.join(random.choices(string.ascii_letters, k=size))
+	hashing = timed(lambda: full_hash(generate_digests(payload)), repeat)
+	legacy = timed(lambda: (legacy_id(payload), full_hash(generate_digests(payload))), repeat)
+	derived = timed(lambda: server.derive_id(full_hash(generate_digests(payload))), repeat)
+	scale = 2 ** 20 / size
+	print(f"cost ms/MiB: hashing {hashing * scale:.1f}, legacy Id + hashing {legacy * scale:.1f},"
+		f" derived Id {derived * scale:.1f}")
+
+
+def collisions(versions):
+	document = random.choices(string.ascii_letters, k=4096)
+	texts, legacy, derived = set(), set(), set()
+	for _ in range(versions):
+		document[random.randrange(len(document))] = random.choice(string.ascii_letters)
+		text = ''.join(document)
+		texts.add(text) # an edit can put back the character that was there
+		legacy.add(legacy_id(text))
+		derived.add(server.derive_id(full_hash(generate_digests(text))))
+	print(f"collisions over {len(texts)} distinct versions: legacy {len(texts) - len(legacy)},"
+		f" derived {len(texts) - len(derived)}")
+
+
+async def lookup(count):
+	await server.connect_redis()
+	payloadIds = []
+	try:
+		results = {}
+		real = server.payload_filter
+		for name, bloom in [('no filter', KnowsEverything()), ('payload_filter', real)]:
+			server.payload_filter = bloom
+			payloads = [''.join(random.choices(string.ascii_letters, k=1024)) for _ in range(count)]
+			start = time.perf_counter()
+			for payload in payloads:
+				payloadIds += await server.ingest_payloads([payload])
+			results[f'new, {name}'] = time.perf_counter() - start
+		start = time.perf_counter()
+		for payload in payloads:
+			await server.ingest_payloads([payload])
+		results['already stored'] = time.perf_counter() - start
+		server.payload_filter = real
+		for name, seconds in results.items():
+			print(f"lookup {name}: {count / seconds:.0f} uploads/s, {seconds / count * 1000:.3f} ms per upload")
+	finally:
+		for payloadId in payloadIds:
+			await server.delete_payload(server.PayloadId(id=payloadId))
+		await server.close_redis()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--size', type=int, default=1024 * 1024)
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--versions', type=int, default=10000)
+	parser.add_argument('--uploads', type=int, default=2000)
+	args = parser.parse_args()
+
+	cost(args.size, args.repeat)
+	collisions(args.versions)
+	asyncio.run(lookup(args.uploads))
+
+
+if __name__ == "__main__":
+	main()
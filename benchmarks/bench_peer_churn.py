@@ -0,0 +1,58 @@
+"""
+	- Registry size under churn: every round --join peers register and --crash peers stop without
+	deregistering, the live ones renew their leases with a single /heartbeat/ call. Without leases the
+	registry only grows, with them it follows the live peer count, a lease TTL behind.
+	- Start the tracker with a short lease so that the benchmark runs in seconds:
+	TRACKER_PEER_LEASE_TTL=2 TRACKER_REAP_INTERVAL=0.5
+
+	Usage: export PYTHONPATH=src; TRACKER_PEER_LEASE_TTL=2 TRACKER_REAP_INTERVAL=0.5 python3 src/server.py &
+	python3 benchmarks/bench_peer_churn.py
+"""
+import argparse
+import random
+import time
+
+import redis
+import requests
+
+import server
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--tracker', default='http://127.0.0.1:8000')
+	parser.add_argument('--rounds', type=int, default=20)
+	parser.add_argument('--interval', type=float, default=0.5, help="seconds between two rounds")
+	parser.add_argument('--join', type=int, default=50)
+	parser.add_argument('--crash', type=int, default=40)
+	args = parser.parse_args()
+
+	conn = redis.StrictRedis()
+	session = requests.Session()
+	live, crashed, joined = [], 0, 0
+	print(f"{'round':>6} {'live':>6} {'crashed':>8} {'registered':>11} {'heartbeat ms':>13}")
+	try:
+		for round in range(args.rounds):
+			for _ in range(args.join):
+				peer = {'peer_id': f"churn_{joined}", 'hostaddr': "10.0.0.2", 'port': str(joined)}
+				session.post(f"{args.tracker}/register/", json=peer).raise_for_status()
+				live.append(peer)
+				joined += 1
+			random.shuffle(live)
+			crashing = min(args.crash, len(live))
+			live, crashed = live[crashing:], crashed + crashing
+
+			start = time.perf_counter()
+			r = session.post(f"{args.tracker}/heartbeat/", json={'peer_ids': [p['peer_id'] for p in live]})
+			r.raise_for_status()
+			elapsed = time.perf_counter() - start
+			registered = sum(1 for _ in conn.sscan_iter(server.PEER_LIST, match="churn_*", count=1000))
+			print(f"{round:>6} {len(live):>6} {crashed:>8} {registered:>11} {elapsed * 1000:>13.2f}")
+			time.sleep(args.interval)
+	finally:
+		for peer in live:
+			session.delete(f"{args.tracker}/deregister", json=peer)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,63 @@
+"""
+	- Cost of keeping a peer list up to date as the number of registered peers grows: the whole list
+	from /get_peers vs the changes since the last version (/get_peers?since=), with no change and with
+	--churn registrations between two polls.
+	- The peers are seeded and removed the same way as in bench_register.
+
+	Usage: export PYTHONPATH=src; python3 src/server.py & python3 benchmarks/bench_peer_sync.py
+"""
+import argparse
+import time
+
+import requests
+
+from bench_register import seed, cleanup
+
+LEVELS = [0, 1000, 10000]
+
+
+def timed(call, samples):
+	start = time.perf_counter()
+	for _ in range(samples):
+		call()
+	return (time.perf_counter() - start) / samples
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--tracker', default='http://127.0.0.1:8000')
+	parser.add_argument('--levels', type=int, nargs='+', default=LEVELS)
+	parser.add_argument('--samples', type=int, default=20)
+	parser.add_argument('--churn', type=int, default=10)
+	args = parser.parse_args()
+
+	session = requests.Session()
+	url = f"{args.tracker}/get_peers/"
+
+	def full():
+		r = session.get(url)
+		r.raise_for_status()
+		return int(r.headers['X-Peers-Version'])
+
+	def delta(since):
+		session.get(url, params={'since': since}).raise_for_status()
+
+	seeded = 0
+	print(f"{'peers':>8} {'full ms':>10} {'delta ms':>10} {'churn ms':>10}")
+	try:
+		for level in args.levels:
+			seed(seeded, level)
+			seeded = max(seeded, level)
+			full_time = timed(full, args.samples)
+			version = full()
+			delta_time = timed(lambda: delta(version), args.samples)
+			seed(seeded, seeded + args.churn)
+			seeded += args.churn
+			churn_time = timed(lambda: delta(version), args.samples)
+			print(f"{level:>8} {full_time * 1000:>10.2f} {delta_time * 1000:>10.2f} {churn_time * 1000:>10.2f}")
+	finally:
+		cleanup()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,81 @@
+"""
+	- Verifications per second between two peers.
+	- reconnect: the old way, an EOM connection and ID exchange for every verification
+	- persistent: one framed channel, one verification in flight at a time
+	- pipelined: one framed channel, --window verifications in flight at a time
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_pipelined_verify.py
+"""
+import argparse
+import collections
+import contextlib
+import io
+import random
+import string
+import time
+
+from node import Node
+
+
+def run_reconnect(client, target, payloadId, duration):
+	client.framing = False
+	ops = 0
+	deadline = time.perf_counter() + duration
+	while time.perf_counter() < deadline:
+		client.connect_to_node(target.host, target.port)
+		client.verify_payload(payloadId)
+		ops += 1
+	client.framing = True
+	client.connected_peers.clear()
+	return ops
+
+
+def run_pipelined(client, target, payloadId, duration, window):
+	channel = client.connect_to_node(target.host, target.port)
+	in_flight = collections.deque()
+	ops = 0
+	deadline = time.perf_counter() + duration
+	while time.perf_counter() < deadline:
+		while len(in_flight) < window:
+			in_flight.append(client.request_verification(payloadId, peer_id=channel.target_id))
+		in_flight.popleft().result()
+		ops += 1
+	for f in in_flight:
+		f.result()
+	return ops
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--duration', type=float, default=3.0, help='Seconds per mode')
+	parser.add_argument('--window', type=int, default=32, help='Verifications in flight when pipelining')
+	parser.add_argument('--payload-size', type=int, default=1024)
+	parser.add_argument('--port', type=int, default=2060)
+	parser.add_argument('--asyncio', action='store_true', help='Serve the target peer in asyncio mode')
+	args = parser.parse_args()
+
+	payload = ''.join(random.choice(string.ascii_letters) for _ in range(args.payload_size))
+	payloadId = 'payload_bench'
+	results = {}
+	with contextlib.redirect_stdout(io.StringIO()):
+		target = Node('127.0.0.1', args.port, use_asyncio=args.asyncio)
+		target.daemon = True
+		target.start()
+		client = Node('127.0.0.1', args.port + 1)
+		for peer in (target, client):
+			peer.available_payloads[payloadId] = payload
+
+		results['reconnect'] = run_reconnect(client, target, payloadId, args.duration)
+		results['persistent'] = run_pipelined(client, target, payloadId, args.duration, 1)
+		results[f'pipelined x{args.window}'] = run_pipelined(client, target, payloadId, args.duration, args.window)
+
+		client.kill()
+		target.kill()
+
+	print(f"{'mode':>16} {'verifications/s':>16}")
+	for mode, ops in results.items():
+		print(f"{mode:>16} {ops / args.duration:>16.1f}")
+
+
+if __name__ == "__main__":
+	main()
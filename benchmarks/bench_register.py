@@ -0,0 +1,85 @@
+"""
+	- /register latency as the number of registered peers grows.
+	- The registry is filled straight through Redis up to each level, then --samples registrations are
+	timed through the tracker. Every timed registration reuses the address of an already registered
+	peer, so the stale entry replacement is part of what is measured.
+	- All the peers this benchmark creates are removed at the end.
+
+	Usage: export PYTHONPATH=src; python3 src/server.py & python3 benchmarks/bench_register.py
+"""
+import argparse
+import time
+
+import redis
+import requests
+
+import server
+
+conn = redis.StrictRedis()
+register_script = conn.register_script(server.REGISTER_PEER_LUA)
+
+LEVELS = [0, 1000, 10000, 100000]
+
+
+def seed(start, stop):
+	pipe = conn.pipeline(transaction=False)
+	expiry = time.time() + 86400 # not reaped while the benchmark runs
+	for i in range(start, stop):
+		peer_id = f"bench_{i}"
+		register_script(keys=server.peer_keys(peer_id),
+			args=[peer_id, "10.0.0.1", str(i), f"10.0.0.1:{i}", server.PEER_CHANGES_SIZE, server.PEER_CHANNEL, expiry],
+			client=pipe)
+		if i % 1000 == 999:
+			pipe.execute()
+	pipe.execute()
+
+
+def cleanup():
+	pipe = conn.pipeline(transaction=False)
+	for peer_id in conn.sscan_iter(server.PEER_LIST, match="bench_*", count=1000):
+		peer_id = peer_id.decode()
+		pipe.hmget(f"peer:{peer_id}", "hostaddr", "port")
+		pipe.delete(f"peer:{peer_id}")
+		pipe.srem(server.PEER_LIST, peer_id)
+		pipe.zrem(server.PEER_LEASES, peer_id)
+	results = pipe.execute()
+	addresses = [f"{h.decode()}:{p.decode()}" for h, p in results[::4] if h is not None]
+	for i in range(0, len(addresses), 1000):
+		conn.hdel(server.PEER_ADDR_INDEX, *addresses[i:i + 1000])
+	# The removals are not in the change log, peers that sync from it get the whole list again
+	conn.delete(server.PEER_CHANGES)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--tracker', default='http://127.0.0.1:8000')
+	parser.add_argument('--levels', type=int, nargs='+', default=LEVELS)
+	parser.add_argument('--samples', type=int, default=200)
+	args = parser.parse_args()
+
+	session = requests.Session()
+	seeded = 0
+	print(f"{'peers':>8} {'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10}")
+	try:
+		for level in args.levels:
+			seed(seeded, level)
+			seeded = max(seeded, level)
+			latencies = []
+			for i in range(args.samples):
+				# Take over the address of one of the seeded peers (or a new one at level 0)
+				port = i % level if level else 100000 + i
+				message = {'peer_id': f"bench_new_{level}_{i}", 'hostaddr': "10.0.0.1", 'port': str(port)}
+				start = time.perf_counter()
+				session.post(f"{args.tracker}/register/", json=message).raise_for_status()
+				latencies.append(time.perf_counter() - start)
+			latencies.sort()
+			mean = sum(latencies) / len(latencies)
+			p50 = latencies[len(latencies) // 2]
+			p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+			print(f"{level:>8} {mean * 1000:>10.2f} {p50 * 1000:>10.2f} {p99 * 1000:>10.2f}")
+	finally:
+		cleanup()
+
+
+if __name__ == "__main__":
+	main()
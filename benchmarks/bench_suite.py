@@ -0,0 +1,257 @@
+"""
+	- Microbenchmarks of the tracker endpoints and of P2P verification, written out as JSON so that two
+	versions can be compared: run it before and after a change and pass the first file to --compare.
+	- The tracker app runs in this process through httpx.ASGITransport, so no tracker has to be started.
+	It uses the Redis of TRACKER_REDIS_HOST/TRACKER_REDIS_PORT, or fakeredis with --fake, in which case no
+	redis-server is needed either. Everything the suite adds to a real Redis is removed at the end.
+	Only compare runs made against the same kind of Redis, fakeredis is a lot slower.
+	- Needs httpx, and fakeredis with lupa for --fake: pip3 install -r requirements-bench.txt
+	- Cases:
+		register, get_peers and get_peers_delta (with --peer-counts registered peers),
+		upload_payload, get_payload and get_payload_range (100 bytes of it, for every --sizes),
+		verify_payload between two peers (for every --sizes) and verify_payload_many (64 KiB payload,
+		with every --peer-counts up to 9 peers)
+	- Every tracker case sends --requests requests, --concurrency at a time, and records the throughput
+	and the latency percentiles.
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_suite.py --fake --output before.json
+	       python3 benchmarks/bench_suite.py --fake --compare before.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import platform
+import random
+import string
+import subprocess
+import sys
+import time
+
+import httpx
+
+import server
+from node import Node
+
+SIZES = [1024, 64 * 1024, 1024 * 1024]
+FAKE_SIZES = [1024, 64 * 1024] # fakeredis takes seconds per MiB
+PEER_COUNTS = [1, 3, 9, 1000]
+MAX_VERIFY_PEERS = 9
+
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def record(name, params, latencies, seconds, concurrency=1):
+	return {
+		'name': name,
+		'params': params,
+		'count': len(latencies),
+		'concurrency': concurrency,
+		'seconds': seconds,
+		'ops_per_sec': len(latencies) / seconds if seconds else 0.0,
+		'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+		'p50_ms': percentile(latencies, 50) * 1000,
+		'p90_ms': percentile(latencies, 90) * 1000,
+		'p99_ms': percentile(latencies, 99) * 1000,
+	}
+
+
+async def run_requests(send, count, concurrency):
+	"""
+		- Call send(i) count times, concurrency at a time, returns (latencies, seconds)
+	"""
+	latencies = []
+	semaphore = asyncio.Semaphore(concurrency)
+
+	async def one(i):
+		async with semaphore:
+			start = time.perf_counter()
+			r = await send(i)
+			latencies.append(time.perf_counter() - start)
+			r.raise_for_status()
+
+	start = time.perf_counter()
+	await asyncio.gather(*[one(i) for i in range(count)])
+	return latencies, time.perf_counter() - start
+
+
+async def tracker_cases(args, results):
+	if args.fake:
+		import fakeredis.aioredis
+		await server.init_redis(fakeredis.aioredis.FakeRedis())
+	else:
+		await server.connect_redis()
+
+	peers, payloadIds = [], []
+	transport = httpx.ASGITransport(app=server.app)
+	client = httpx.AsyncClient(transport=transport, base_url="http://tracker", timeout=60)
+	n, c = args.requests, args.concurrency
+	try:
+		def register(i):
+			peer = {'peer_id': f"bench_suite_{len(peers)}", 'hostaddr': "10.0.0.3", 'port': str(len(peers))}
+			peers.append(peer)
+			return client.post("/register/", json=peer)
+
+		for count in sorted(set(args.peer_counts)):
+			while len(peers) < count:
+				await register(0)
+			version = int((await client.get("/get_peers/")).headers[server.PEER_VERSION_HEADER])
+			latencies = await run_requests(lambda i: client.get("/get_peers/"), n, c)
+			results.append(record('get_peers', {'peers': count}, *latencies, concurrency=c))
+			latencies = await run_requests(lambda i: client.get("/get_peers/", params={'since': version}), n, c)
+			results.append(record('get_peers_delta', {'peers': count}, *latencies, concurrency=c))
+
+		results.append(record('register', {}, *await run_requests(register, n, c), concurrency=c))
+
+		for size in args.sizes:
+			payloads = [''.join(random.choices(string.ascii_letters, k=size)) for _ in range(min(n, 8))]
+			responses = []
+
+			async def upload(i):
+				r = await client.post("/upload_payload/", json={'payload': payloads[i % len(payloads)] + str(i)})
+				responses.append(r)
+				return r
+
+			results.append(record('upload_payload', {'size': size}, *await run_requests(upload, n, c), concurrency=c))
+			ids = [r.json()['payloadId'] for r in responses]
+			payloadIds.extend(ids)
+			latencies = await run_requests(lambda i: client.post("/get_payload/", json={'id': ids[i % len(ids)]}), n, c)
+			results.append(record('get_payload', {'size': size}, *latencies, concurrency=c))
+			# 100 bytes from the middle, should not depend on the payload size
+			middle = {'offset': size // 2, 'length': 100}
+			latencies = await run_requests(lambda i: client.post("/get_payload/", json={'id': ids[i % len(ids)], **middle}), n, c)
+			results.append(record('get_payload_range', {'size': size}, *latencies, concurrency=c))
+	finally:
+		if not args.fake:
+			for peer in peers:
+				await client.request('DELETE', "/deregister", json=peer)
+			for payloadId in payloadIds:
+				await client.request('DELETE', "/delete_payload/", json={'id': payloadId})
+		await client.aclose()
+		await server.close_redis()
+
+
+def verify_cases(args, results):
+	port = args.port
+	conn = None
+	if args.fake:
+		import fakeredis
+		conn = fakeredis.FakeStrictRedis()
+
+	def nodes(count):
+		nonlocal port
+		created = [Node('127.0.0.1', port + i) for i in range(count)]
+		port += count
+		for node in created:
+			if conn is not None:
+				node.conn = node.log_shipper.conn = conn
+			node.daemon = True
+			node.start()
+		return created
+
+	def measure(call):
+		latencies = []
+		start = time.perf_counter()
+		for _ in range(args.requests):
+			begin = time.perf_counter()
+			call()
+			latencies.append(time.perf_counter() - begin)
+		return latencies, time.perf_counter() - start
+
+	for size in args.sizes:
+		payload = ''.join(random.choices(string.ascii_letters, k=size))
+		with contextlib.redirect_stdout(io.StringIO()):
+			a, b = nodes(2)
+			a.available_payloads['payload_suite'] = b.available_payloads['payload_suite'] = payload
+			peer_id = a.connect_to_node(b.host, b.port).target_id
+			latencies = measure(lambda: a.verify_payload('payload_suite', peer_id=peer_id, timeout=30))
+			a.kill(), b.kill()
+		results.append(record('verify_payload', {'size': size}, *latencies))
+
+	payload = ''.join(random.choices(string.ascii_letters, k=64 * 1024))
+	for count in sorted(set(min(p, MAX_VERIFY_PEERS) for p in args.peer_counts)):
+		with contextlib.redirect_stdout(io.StringIO()):
+			verifier, *others = nodes(count + 1)
+			for node in [verifier] + others:
+				node.available_payloads['payload_suite'] = payload
+			ids = [verifier.connect_to_node(node.host, node.port).target_id for node in others]
+			latencies = measure(lambda: verifier.verify_payload_many('payload_suite', peer_ids=ids, timeout=30))
+			for node in [verifier] + others:
+				node.kill()
+		results.append(record('verify_payload_many', {'peers': count, 'size': 64 * 1024}, *latencies))
+
+
+def version():
+	try:
+		return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True).stdout.strip()
+	except OSError:
+		return None
+
+
+def compare(old, new, threshold):
+	"""
+		- Print the change of every case that is in both runs, returns the number of regressions: cases
+		whose p50 latency grew or whose throughput dropped by more than threshold percent
+	"""
+	before = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in old['results']}
+	regressions = 0
+	print(f"{'case':<40} {'p50 ms':>18} {'ops/s':>20}")
+	for r in new['results']:
+		key = (r['name'], json.dumps(r['params'], sort_keys=True))
+		if key not in before:
+			continue
+		o = before[key]
+		p50 = (r['p50_ms'] / o['p50_ms'] - 1) * 100 if o['p50_ms'] else 0.0
+		ops = (r['ops_per_sec'] / o['ops_per_sec'] - 1) * 100 if o['ops_per_sec'] else 0.0
+		regressed = p50 > threshold or ops < -threshold
+		regressions += regressed
+		case = f"{r['name']} {' '.join(f'{k}={v}' for k, v in r['params'].items())}"
+		print(f"{case:<40} {r['p50_ms']:>9.2f} ({p50:+6.1f}%) {r['ops_per_sec']:>10.0f} ({ops:+6.1f}%)"
+			+ ("  REGRESSION" if regressed else ""))
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--fake', action='store_true', help="run the tracker on fakeredis")
+	parser.add_argument('--sizes', type=int, nargs='+', help=f"payload sizes, default {SIZES} ({FAKE_SIZES} with --fake)")
+	parser.add_argument('--peer-counts', type=int, nargs='+', default=PEER_COUNTS)
+	parser.add_argument('--requests', type=int, default=50)
+	parser.add_argument('--concurrency', type=int, default=8)
+	parser.add_argument('--port', type=int, default=1400)
+	parser.add_argument('--output', help="write the results to this file instead of stdout")
+	parser.add_argument('--compare', help="results of an earlier run, exit with 1 if a case regressed")
+	parser.add_argument('--threshold', type=float, default=10, help="percent change that counts as a regression")
+	args = parser.parse_args()
+	if args.sizes is None:
+		args.sizes = FAKE_SIZES if args.fake else SIZES
+
+	results = []
+	with contextlib.redirect_stdout(io.StringIO()):
+		asyncio.run(tracker_cases(args, results))
+	verify_cases(args, results)
+	report = {
+		'version': version(),
+		'python': platform.python_version(),
+		'redis': 'fakeredis' if args.fake else f"{server.REDIS_HOST}:{server.REDIS_PORT}",
+		'timestamp': time.time(),
+		'results': results,
+	}
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=1)
+	elif not args.compare:
+		json.dump(report, sys.stdout, indent=1)
+		print()
+
+	if args.compare:
+		with open(args.compare) as f:
+			sys.exit(1 if compare(json.load(f), report, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,55 @@
+"""
+	- Calls to the tracker per second from many simulated peers, a new connection per call (the module
+	level requests.get) vs the keep-alive pool of TrackerClient.
+	- Every peer is a thread that calls /get_peers back to back for --duration seconds.
+
+	Usage: export PYTHONPATH=src; python3 src/server.py & python3 benchmarks/bench_tracker_client.py
+"""
+import argparse
+import threading
+import time
+
+import requests
+
+from tracker_client import TrackerClient
+
+PEERS = [1, 16, 64]
+
+
+def run(tracker, peers, duration, get):
+	calls = [0] * peers
+	stop = threading.Event()
+
+	def peer(i):
+		while not stop.is_set():
+			get(f"{tracker}/get_peers/").raise_for_status()
+			calls[i] += 1
+
+	threads = [threading.Thread(target=peer, args=(i,)) for i in range(peers)]
+	for thread in threads:
+		thread.start()
+	time.sleep(duration)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	return sum(calls) / duration
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--tracker', default='http://127.0.0.1:8000')
+	parser.add_argument('--peers', type=int, nargs='+', default=PEERS)
+	parser.add_argument('--duration', type=float, default=5)
+	args = parser.parse_args()
+
+	print(f"{'peers':>6} {'new conn/s':>12} {'pooled/s':>10}")
+	for peers in args.peers:
+		unpooled = run(args.tracker, peers, args.duration, requests.get)
+		client = TrackerClient(pool_size=peers)
+		pooled = run(args.tracker, peers, args.duration, lambda url: client.request('GET', url))
+		client.close()
+		print(f"{peers:>6} {unpooled:>12.0f} {pooled:>10.0f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,71 @@
+"""
+	- /get_peers latency as the number of concurrent clients grows.
+	- Every client is a thread with its own keep-alive session that calls /get_peers back to back.
+	- With --upload-size, one more thread keeps uploading payloads of that size at the same time, to show
+	whether slow requests hold up the fast ones.
+
+	Usage: export PYTHONPATH=src; python3 src/server.py & python3 benchmarks/bench_tracker_concurrency.py
+"""
+import argparse
+import random
+import string
+import threading
+import time
+
+import requests
+
+CONCURRENCY = [1, 4, 16, 64]
+
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def run_level(tracker, clients, duration, upload_size):
+	latencies = [[] for _ in range(clients)]
+	stop = threading.Event()
+
+	def client(i):
+		session = requests.Session()
+		while not stop.is_set():
+			start = time.perf_counter()
+			session.get(f"{tracker}/get_peers/").raise_for_status()
+			latencies[i].append(time.perf_counter() - start)
+
+	def uploader():
+		session = requests.Session()
+		while not stop.is_set():
+			payload = ''.join(random.choices(string.ascii_letters, k=upload_size))
+			session.post(f"{tracker}/upload_payload/", json={'payload': payload})
+
+	threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+	if upload_size:
+		threads.append(threading.Thread(target=uploader))
+	for t in threads:
+		t.start()
+	time.sleep(duration)
+	stop.set()
+	for t in threads:
+		t.join()
+
+	flat = [l for per_client in latencies for l in per_client]
+	return len(flat) / duration, percentile(flat, 50) * 1000, percentile(flat, 99) * 1000
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--tracker', default='http://127.0.0.1:8000')
+	parser.add_argument('--concurrency', type=int, nargs='+', default=CONCURRENCY)
+	parser.add_argument('--duration', type=float, default=5.0, help='Seconds per concurrency level')
+	parser.add_argument('--upload-size', type=int, default=0, help='Characters per background upload, 0 for none')
+	args = parser.parse_args()
+
+	print(f"{'clients':>8} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+	for clients in args.concurrency:
+		rate, p50, p99 = run_level(args.tracker, clients, args.duration, args.upload_size)
+		print(f"{clients:>8} {rate:>10.1f} {p50:>10.2f} {p99:>10.2f}")
+
+
+if __name__ == "__main__":
+	main()
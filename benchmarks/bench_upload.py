@@ -0,0 +1,130 @@
+"""
+	- Payload ingestion throughput in payloads/s and MB/s.
+	- legacy: the old /upload_payload write path, one HSET round trip per chunk
+	- pipelined: server.ingest_payloads, one transaction per batch of payloads
+	- With --tracker, /upload_payload (one request per payload) is also compared with /upload_payloads and
+	with /upload_payload_stream (one streamed request per payload).
+	- Every payload is random, so nothing is deduplicated. The payloads are removed at the end.
+
+	Usage: export PYTHONPATH=src; python3 benchmarks/bench_upload.py
+"""
+import argparse
+import asyncio
+import random
+import string
+import time
+
+import redis
+import requests
+
+import server
+from hashing import generate_hashes
+
+conn = redis.StrictRedis()
+
+SIZES = [1024, 64 * 1024, 1024 * 1024]
+
+
+def legacy_encode(string_par):
+	# The payload Id of the old write path, one pass over the payload before the hashing
+	if len(string_par) < 12:
+		string_par = string_par + ''.join([str(i) for i in range(12-len(string_par))])
+	x = [i for i in range(12)]
+	for i in range(len(string_par)):
+		x[i % len(x)] = x[i % len(x)] * ord(string_par[i])
+		x[i % len(x)] = 65 + x[i % len(x)] % 25
+	return f"payload_{''.join([chr(k) for k in x])}"
+
+
+def legacy_ingest(payload_strings):
+	payloadIds = []
+	for payload in payload_strings:
+		payloadId = legacy_encode(payload)
+		payloadIds.append(payloadId)
+		if conn.sismember(server.PAYLOAD_LIST, payloadId):
+			continue
+		hash_chunks, full_hash = generate_hashes(payload)
+		for i, h in enumerate(hash_chunks):
+			conn.hset(f'chunks:{payloadId}', f'{i}', h)
+		conn.hset(f'hash:{payloadId}', 'rootHash', full_hash)
+		conn.hset(f'hash:{payloadId}', 'claimedString', payload)
+		conn.hset(f'hash:{payloadId}', 'chunks', f'chunks:{payloadId}')
+		conn.sadd(server.PAYLOAD_LIST, payloadId)
+	return payloadIds
+
+
+def pipelined_ingest(payload_strings):
+	async def ingest():
+		await server.connect_redis()
+		try:
+			return await server.ingest_payloads(payload_strings)
+		finally:
+			await server.close_redis()
+	return asyncio.run(ingest())
+
+
+def http_single(tracker, payload_strings):
+	session = requests.Session()
+	return [session.post(f"{tracker}/upload_payload/", json={'payload': p}).json()['payloadId']
+		for p in payload_strings]
+
+
+def http_batch(tracker, payload_strings):
+	message = {'payloads': [{'payload': p} for p in payload_strings]}
+	return requests.post(f"{tracker}/upload_payloads/", json=message).json()['payloadIds']
+
+
+def http_stream(tracker, payload_strings):
+	session = requests.Session()
+	return [session.post(f"{tracker}/upload_payload_stream/", data=p.encode()).json()['payloadId']
+		for p in payload_strings]
+
+
+def remove(payloadIds):
+	# Through the tracker code, so that the references to the block store are dropped too
+	async def delete():
+		await server.connect_redis()
+		try:
+			for payloadId in set(payloadIds):
+				await server.delete_payload(server.PayloadId(id=payloadId))
+		finally:
+			await server.close_redis()
+	asyncio.run(delete())
+
+
+def random_payloads(count, size):
+	return [''.join(random.choices(string.ascii_letters, k=size)) for _ in range(count)]
+
+
+def measure(ingest, payload_strings):
+	start = time.perf_counter()
+	payloadIds = ingest(payload_strings)
+	elapsed = time.perf_counter() - start
+	remove(payloadIds)
+	size = sum(len(p) for p in payload_strings)
+	return len(payload_strings) / elapsed, size / elapsed / 2 ** 20
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Payload sizes in characters')
+	parser.add_argument('--total', type=int, default=4 * 1024 * 1024, help='Characters uploaded per size')
+	parser.add_argument('--tracker', default=None, help='e.g. http://127.0.0.1:8000')
+	args = parser.parse_args()
+
+	modes = {'legacy': legacy_ingest, 'pipelined': pipelined_ingest}
+	if args.tracker:
+		modes['http single'] = lambda p: http_single(args.tracker, p)
+		modes['http batch'] = lambda p: http_batch(args.tracker, p)
+		modes['http stream'] = lambda p: http_stream(args.tracker, p)
+
+	print(f"{'size':>10} {'mode':>12} {'payloads/s':>12} {'MB/s':>8}")
+	for size in args.sizes:
+		payload_strings = random_payloads(max(1, args.total // size), size)
+		for mode, ingest in modes.items():
+			per_sec, mb_per_sec = measure(ingest, payload_strings)
+			print(f"{size:>10} {mode:>12} {per_sec:>12.1f} {mb_per_sec:>8.2f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -1,22 +1,22 @@
+"""
+	- Without arguments: a few peers doing random actions against the tracker, one every two seconds.
+	- With --load: an open-loop load generator, see load() and --help.
+"""
 import node
 from node import SEVERITY
 from node import Node
+from hashing import CHUNK_SIZE
+from histogram import Histogram
+import argparse
+import contextlib
+import heapq
+import math
+import os
+import threading
 import time
 import random
 import string
-
-print('='*20 + "Creating Peers" + '='*20)
-node_1 = Node._build_and_run(port=1060)
-node_2 = Node._build_and_run(port=1061)
-node_3 = Node._build_and_run(port=1062)
-node_4 = Node._build_and_run(port=1063)
-
-unused_port_num = 1064
-
-actions = node.SEVERITY
-actions_list = list(node.SEVERITY)
-
-active_peers = [node_1, node_2, node_3, node_4]
+from concurrent.futures import ThreadPoolExecutor
 
 vocabulary = string.ascii_letters + string.digits
 def generate_random_payload():
@@ -27,93 +27,301 @@ def generate_random_payload():
 	payload = ''.join(payload_l)
 	return payload
 
-while True: 
-	if len(active_peers) < 2:
-		print(f"Not enough peers. creating one")
-		node_temp = Node('127.0.0.1',unused_port_num)
-		node_temp.daemon = True
-		node_temp.start()
-		node_temp.register_peer('http://127.0.0.1:8000')
-		unused_port_num += 1
-		active_peers.append(node_temp)
-		time.sleep(2)
-		print("="*80)
-		print()
-		continue
-
-	action = random.choice(actions_list)
-	if action == SEVERITY.KILL:
-		node_a = active_peers.pop()
-		node_a.kill()
-		print(f"Killing the node: {node_a.hostname}")
-		print("="*80)
-		print()
-		time.sleep(2)
-
-	if action == SEVERITY.VERIFY_CLAIM:
-		node_a = active_peers.pop()
-		node_b = active_peers.pop()
-
-		print(f"Verify Payload")
+def simulate():
+	print('='*20 + "Creating Peers" + '='*20)
+	node_1 = Node._build_and_run(port=1060, heartbeat=False)
+	node_2 = Node._build_and_run(port=1061, heartbeat=False)
+	node_3 = Node._build_and_run(port=1062, heartbeat=False)
+	node_4 = Node._build_and_run(port=1063, heartbeat=False)
+
+	unused_port_num = 1064
+
+	actions = node.SEVERITY
+	actions_list = list(node.SEVERITY)
+
+	active_peers = [node_1, node_2, node_3, node_4]
+
+	while True: 
+		# Renew the leases of the peers that are still registered, in one request
+		node.send_heartbeats(active_peers)
+		if len(active_peers) < 2:
+			print(f"Not enough peers. creating one")
+			node_temp = Node('127.0.0.1',unused_port_num)
+			node_temp.daemon = True
+			node_temp.start()
+			node_temp.register_peer('http://127.0.0.1:8000', heartbeat=False)
+			unused_port_num += 1
+			active_peers.append(node_temp)
+			time.sleep(2)
+			print("="*80)
+			print()
+			continue
+
+		action = random.choice(actions_list)
+		if action == SEVERITY.KILL:
+			node_a = active_peers.pop()
+			node_a.kill()
+			print(f"Killing the node: {node_a.hostname}")
+			print("="*80)
+			print()
+			time.sleep(2)
+
+		if action == SEVERITY.VERIFY_CLAIM:
+			node_a = active_peers.pop()
+			node_b = active_peers.pop()
+
+			print(f"Verify Payload")
 		
-		if len(node_a.available_payloads) == 0:
-			node_a.upload_payload(generate_random_payload())
-			print(f"No payload exists to verify, uploading a payload")
+			if len(node_a.available_payloads) == 0:
+				node_a.upload_payload(generate_random_payload())
+				print(f"No payload exists to verify, uploading a payload")
 
-		payloadId = random.choice(list(node_a.available_payloads.keys()))
+			payloadId = random.choice(list(node_a.available_payloads.keys()))
 
-		if payloadId not in node_b.available_payloads.keys():
-			node_b.querry_payload(payloadId)
+			if payloadId not in node_b.available_payloads.keys():
+				node_b.querry_payload(payloadId)
 		
-		print(f"Using payload: {payloadId} for verifying chunks")
-		node_a.connect_to_node(node_b.host, node_b.port)
-		if random.choice([0,1]) == 0:
-			print(f"Verifying in proper order")
-			print(node_a.verify_payload(payloadId))
-		else:
-			print(f"Verifying in random order")
-			positions = list(range(len(node_a.available_payloads[payloadId]) // 4))
-			prefix, postfix = positions[:5], positions[5:]
-			random.shuffle(prefix)
-			positions = prefix + postfix
-			print(node_a.verify_payload(payloadId, positions))
-
-		#node_a.live_channel.join()
+			print(f"Using payload: {payloadId} for verifying chunks")
+			node_a.connect_to_node(node_b.host, node_b.port)
+			if random.choice([0,1]) == 0:
+				print(f"Verifying in proper order")
+				print(node_a.verify_payload(payloadId))
+			else:
+				print(f"Verifying in random order")
+				positions = list(range(len(node_a.available_payloads[payloadId]) // CHUNK_SIZE))
+				prefix, postfix = positions[:5], positions[5:]
+				random.shuffle(prefix)
+				positions = prefix + postfix
+				print(node_a.verify_payload(payloadId, positions))
+
+			#node_a.live_channel.join()
 		
-		print("="*80)
-		print()
-		active_peers.append(node_a)
-		active_peers.append(node_b)
-		time.sleep(2)
-
-	if action == SEVERITY.GET_PEERS:
-		print(f"Get peer list from the sever")
-		peer = random.choice(active_peers)
-		data = peer.get_peers()
-		for p in data:
-			print(p, data[p])
-		print("="*80)
-		print()
-		time.sleep(2)
-
-	if action == SEVERITY.QUERRY_PAYLOAD:
-		print(f"Querry a payload and get chunks")
-		peer = random.choice(active_peers)
-		if len(peer.available_payloads) == 0:
-			peer.upload_payload(generate_random_payload())
-			print(f"No payload exists to querry, uploading a payload")
-		payloadId = list(peer.available_payloads.keys())[0]
-		dd = peer.querry_payload(payloadId)
-		print(f"claimedString: {dd['claimedString']}")
-		print(f"Root Hash: {dd['rootHash']}")
-		print("="*80)
-		print()
-		time.sleep(2)
-
-	if action == SEVERITY.DEREGISTER_PEER:
-		print(f"Deregister a peer")
-		peer = active_peers.pop()
-		peer.deregister_peer()
-		print("="*80)
-		print()
-		time.sleep(2)
+			print("="*80)
+			print()
+			active_peers.append(node_a)
+			active_peers.append(node_b)
+			time.sleep(2)
+
+		if action == SEVERITY.GET_PEERS:
+			print(f"Get peer list from the sever")
+			peer = random.choice(active_peers)
+			data = peer.get_peers()
+			for p in data:
+				print(p, data[p])
+			print("="*80)
+			print()
+			time.sleep(2)
+
+		if action == SEVERITY.QUERRY_PAYLOAD:
+			print(f"Querry a payload and get chunks")
+			peer = random.choice(active_peers)
+			if len(peer.available_payloads) == 0:
+				peer.upload_payload(generate_random_payload())
+				print(f"No payload exists to querry, uploading a payload")
+			payloadId = list(peer.available_payloads.keys())[0]
+			dd = peer.querry_payload(payloadId)
+			print(f"claimedString: {dd['claimedString']}")
+			print(f"Root Hash: {dd['rootHash']}")
+			print("="*80)
+			print()
+			time.sleep(2)
+
+		if action == SEVERITY.DEREGISTER_PEER:
+			print(f"Deregister a peer")
+			peer = active_peers.pop()
+			peer.deregister_peer()
+			print("="*80)
+			print()
+			time.sleep(2)
+
+
+""" Actions the load generator can run, they all leave the set of peers as it is """
+LOAD_ACTIONS = [SEVERITY.VERIFY_CLAIM, SEVERITY.UPLOAD_PAYLOAD, SEVERITY.QUERRY_PAYLOAD,
+	SEVERITY.REGISTER_PEER, SEVERITY.GET_PEERS, SEVERITY.QUERRY_PROOF]
+DEFAULT_RATES = {SEVERITY.VERIFY_CLAIM: 20, SEVERITY.QUERRY_PAYLOAD: 10, SEVERITY.UPLOAD_PAYLOAD: 5,
+	SEVERITY.GET_PEERS: 5}
+
+def parse_rate(text):
+	name, _, rate = text.partition('=')
+	try:
+		action = SEVERITY[name.upper()]
+	except KeyError:
+		raise argparse.ArgumentTypeError(f"unknown action {name}")
+	if action not in LOAD_ACTIONS:
+		raise argparse.ArgumentTypeError(f"{name} cannot be generated, use one of {[a.name for a in LOAD_ACTIONS]}")
+	return action, float(rate)
+
+def parse_sizes(text):
+	"""
+		- fixed:N, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA, returns a function that draws a payload size
+	"""
+	kind, *values = text.split(':')
+	try:
+		values = [float(v) for v in values]
+		if kind == 'fixed' and len(values) == 1:
+			return lambda: int(values[0])
+		if kind == 'uniform' and len(values) == 2:
+			return lambda: random.randint(int(values[0]), int(values[1]))
+		if kind == 'lognormal' and len(values) == 2:
+			return lambda: max(1, int(random.lognormvariate(math.log(values[0]), values[1])))
+	except ValueError:
+		pass
+	raise argparse.ArgumentTypeError(f"invalid payload sizes {text}")
+
+def random_payload(size):
+	return ''.join(random.choices(vocabulary, k=size))
+
+class ActionStats:
+	"""
+		- Outcome of one kind of action. The latency of a request is counted from the time it was
+		scheduled, not from when a worker got to it, so the time spent waiting for a worker is included.
+	"""
+
+	def __init__(self):
+		self.requested = 0
+		self.completed = 0
+		self.errors = 0
+		self.error = None # last error
+		self.latency = Histogram()
+		self.max = 0.0
+		self.lock = threading.Lock()
+
+	def done(self, seconds, error=None):
+		self.latency.observe(seconds)
+		with self.lock:
+			self.completed += 1
+			self.max = max(self.max, seconds)
+			if error is not None:
+				self.errors += 1
+				self.error = error
+
+def load(args):
+	"""
+		- Open-loop load: every action of args.rates is started at random times (Poisson arrivals at its
+		rate) for args.duration seconds whether or not the earlier ones are done, on args.workers threads
+		shared by --nodes peers. A report of what was achieved is printed at the end.
+	"""
+	sink = open(os.devnull, 'w')
+	quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(sink)
+	stats = {action: ActionStats() for action in args.rates}
+	payloads = [] # ids of the payloads held by every peer
+	payloads_lock = threading.Lock()
+
+	with quiet:
+		# The leases of every peer are renewed together by heartbeats() below
+		peers = [Node._build_and_run(port=args.port + i, tracker=args.tracker, heartbeat=False) for i in range(args.nodes)]
+		shared = peers[0].upload_payloads([random_payload(args.sizes()) for _ in range(args.shared)])
+		for peer in peers[1:]:
+			for payloadId in shared:
+				peer.querry_payload(payloadId)
+		payloads.extend(shared)
+
+	def verify():
+		a, b = random.sample(peers, 2)
+		channel = a.connect_to_node(b.host, b.port)
+		if channel is None:
+			raise ConnectionError(f"Could not connect to {b.hostname}")
+		result = a.verify_payload(random.choice(payloads), peer_id=channel.target_id, timeout=60)
+		if not result.get('chunk_available'):
+			raise Exception("The payload is not available")
+
+	def upload():
+		peer = random.choice(peers)
+		# payload_sent[-1] could be the upload of another thread, and the payload only goes to payloads
+		# once every peer has it, verify() and proof() pick from there
+		payloadId = peer.upload_payload(random_payload(args.sizes()))
+		for other in peers:
+			if other is not peer:
+				other.querry_payload(payloadId)
+		with payloads_lock:
+			payloads.append(payloadId)
+
+	def proof():
+		payloadId = random.choice(payloads)
+		peer = random.choice(peers)
+		chunks = peer.available_payloads.chunks(payloadId)
+		index = random.randrange(len(chunks))
+		if not peer.verify_chunk(payloadId, index, chunks[index]):
+			raise Exception("The chunk proof did not verify")
+
+	run = {
+		SEVERITY.VERIFY_CLAIM: verify,
+		SEVERITY.UPLOAD_PAYLOAD: upload,
+		SEVERITY.QUERRY_PAYLOAD: lambda: random.choice(peers).querry_payload(random.choice(payloads)),
+		SEVERITY.REGISTER_PEER: lambda: random.choice(peers).register_peer(args.tracker, heartbeat=False),
+		SEVERITY.GET_PEERS: lambda: random.choice(peers).get_peers(),
+		SEVERITY.QUERRY_PROOF: proof,
+	}
+
+	def job(action, scheduled):
+		try:
+			run[action]()
+			error = None
+		except Exception as e:
+			error = f"{type(e).__name__}: {e}"
+		stats[action].done(time.perf_counter() - scheduled, error)
+
+	stop = threading.Event()
+
+	def heartbeats():
+		while not stop.wait(10):
+			node.send_heartbeats(peers)
+
+	with quiet:
+		threading.Thread(target=heartbeats, daemon=True).start()
+		executor = ThreadPoolExecutor(max_workers=args.workers)
+		start = time.perf_counter()
+		end = start + args.duration
+		arrivals = [(start + random.expovariate(rate), action.value, action) for action, rate in args.rates.items()]
+		heapq.heapify(arrivals)
+		while arrivals:
+			scheduled, order, action = heapq.heappop(arrivals)
+			if scheduled >= end:
+				continue
+			delay = scheduled - time.perf_counter()
+			if delay > 0:
+				time.sleep(delay)
+			stats[action].requested += 1
+			executor.submit(job, action, scheduled)
+			heapq.heappush(arrivals, (scheduled + random.expovariate(args.rates[action]), order, action))
+		executor.shutdown(wait=True)
+		elapsed = time.perf_counter() - start
+		stop.set()
+		for peer in peers:
+			peer.kill()
+
+	print(f"{args.nodes} peers, {args.workers} workers, {args.duration:.0f}s, drained after {elapsed:.1f}s")
+	print(f"{'action':<16} {'target/s':>9} {'done/s':>8} {'requested':>10} {'errors':>7} "
+		f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+	for action, s in stats.items():
+		summary = s.latency.summary()
+		# Percentiles are interpolated inside log-scale buckets, keep them under the largest latency seen
+		ms = [f"{min(summary[p] or 0, s.max) * 1000:>9.1f}" for p in ('p50', 'p90', 'p99')]
+		print(f"{action.name:<16} {args.rates[action]:>9.1f} {s.completed / elapsed:>8.1f} {s.requested:>10} "
+			f"{s.errors:>7} {' '.join(ms)} {s.max * 1000:>9.1f}")
+	for action, s in stats.items():
+		if s.error is not None:
+			print(f"{action.name}: last error: {s.error}")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--load', action='store_true', help="run the load generator instead of the random actions")
+	parser.add_argument('--tracker', default="http://127.0.0.1:8000")
+	parser.add_argument('--nodes', type=int, default=8)
+	parser.add_argument('--rate', type=parse_rate, action='append', dest='rates', metavar='ACTION=RATE',
+		help=f"requests per second of an action ({', '.join(a.name for a in LOAD_ACTIONS)}), can be repeated, "
+		f"default {', '.join(f'{a.name}={r}' for a, r in DEFAULT_RATES.items())}")
+	parser.add_argument('--workers', type=int, default=16, help="actions that can run at the same time")
+	parser.add_argument('--duration', type=float, default=30, help="seconds new actions are started for")
+	parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes('uniform:32:100'),
+		help="payload sizes: fixed:N, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA (default uniform:32:100)")
+	parser.add_argument('--shared', type=int, default=8, help="payloads held by every peer from the start")
+	parser.add_argument('--port', type=int, default=1500, help="port of the first peer")
+	parser.add_argument('--verbose', action='store_true', help="keep the output of the peers")
+	args = parser.parse_args()
+	args.rates = dict(args.rates) if args.rates else dict(DEFAULT_RATES)
+
+	if args.load:
+		load(args)
+	else:
+		simulate()
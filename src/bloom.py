@@ -0,0 +1,40 @@
+"""
+	- An in-process Bloom filter: a set of strings that can only grow, kept as a bit array.
+
+	- An item that was added is always found. An item that was not added is found by mistake with a
+	probability of about error_rate while the filter holds at most capacity items, more when it holds more.
+	So a miss is a definite answer and a hit has to be checked where the items really are.
+"""
+import hashlib
+import math
+
+
+class BloomFilter:
+
+	def __init__(self, capacity, error_rate=0.01):
+		"""
+			args:
+				capacity - Number of items the filter is sized for
+				error_rate - Chance that an item that was never added is found, at capacity items
+		"""
+		self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2)) # bits
+		self.hashes = max(1, round(self.size / capacity * math.log(2)))
+		self.bits = bytearray(-(-self.size // 8))
+		self.count = 0 # items added, an item added twice counts twice
+
+	def _positions(self, item):
+		# Double hashing: the bit positions are h1 + i * h2 for two halves of one digest
+		digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+		h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+		return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+	def add(self, item):
+		for p in self._positions(item):
+			self.bits[p >> 3] |= 1 << (p & 7)
+		self.count += 1
+
+	def __contains__(self, item):
+		return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+	def __len__(self):
+		return self.count
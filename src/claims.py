@@ -0,0 +1,212 @@
+"""
+	- Binary encoding of claims (MSG_BINARY_CLAIMS) and their results.
+
+	- A claim says that a chunk of a payload is at a given position. The JSON claims are a list of
+	{'chunk', 'position'} dicts, here the claims of a request are three packed arrays instead:
+
+		request:  payload id length (2) | claim count (4) | payload id | positions (4 * count) |
+		          chunk ends (4 * count) | chunk buffer
+		response: status (1) | claim count (4) | bitmap
+
+	all in network byte order. The chunks are concatenated (utf-8) in the chunk buffer, chunk i ends at
+	chunk ends[i]. Bit i of the bitmap, most significant bit first, is set if claim i is correct.
+
+	- The receiver builds the buffer it expects from its own copy of the payload and compares it with the
+	chunk buffer in blocks of COMPARE_BLOCK chunks, only a block that differs is compared chunk by chunk.
+	When every claim is correct this is a single comparison of the two buffers.
+"""
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate
+
+CLAIMS_HEADER = struct.Struct("!HI")
+RESULTS_HEADER = struct.Struct("!BI")
+
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+COMPARE_BLOCK = 64
+
+# Response status
+STATUS_UNAVAILABLE = 0 # the peer does not hold the payload
+STATUS_CHECKED = 1
+STATUS_CORRUPTED = 2 # the request could not be decoded
+
+
+def _pack(values):
+	values = array(UINT32, values)
+	if sys.byteorder == 'little':
+		values.byteswap()
+	return values.tobytes()
+
+
+def _unpack(data):
+	values = array(UINT32)
+	values.frombytes(data)
+	if sys.byteorder == 'little':
+		values.byteswap()
+	return values
+
+
+def _bitmap(count):
+	bitmap = bytearray(b'\xff' * (count // 8))
+	if count % 8:
+		bitmap.append((0xff << (8 - count % 8)) & 0xff)
+	return bitmap
+
+
+def encode_claims(payloadId, positions, chunks):
+	"""
+		- The body of a MSG_BINARY_CLAIMS request that claims chunks[i] is at positions[i].
+		- chunks is the ChunkView of the payload, the claims are for its first len(positions) chunks, so the
+		chunk buffer is a prefix of the payload.
+	"""
+	count = len(positions)
+	text = chunks.payload[:count * chunks.chunk_size]
+	if text.isascii():
+		buffer = text.encode('ascii')
+		ends = list(range(chunks.chunk_size, count * chunks.chunk_size + 1, chunks.chunk_size))
+		if ends:
+			ends[-1] = len(buffer)
+	else:
+		encoded = [chunks[i].encode() for i in range(count)]
+		buffer = b''.join(encoded)
+		ends = accumulate(map(len, encoded))
+	payloadId = payloadId.encode()
+	return b''.join([CLAIMS_HEADER.pack(len(payloadId), count), payloadId, _pack(positions), _pack(ends), buffer])
+
+
+def decode_claims(body):
+	"""
+		- Returns (payloadId, positions, chunk ends, chunk buffer), raises ValueError if body is not a
+		valid request
+	"""
+	body = memoryview(body)
+	try:
+		id_length, count = CLAIMS_HEADER.unpack_from(body)
+	except struct.error:
+		raise ValueError("Claims header is truncated")
+	start = CLAIMS_HEADER.size + id_length
+	positions_end = start + 4 * count
+	ends_end = positions_end + 4 * count
+	if len(body) < ends_end:
+		raise ValueError("Claims are truncated")
+	payloadId = str(body[CLAIMS_HEADER.size:start], 'utf-8')
+	positions = _unpack(body[start:positions_end])
+	ends = _unpack(body[positions_end:ends_end])
+	buffer = body[ends_end:]
+	if (ends and ends[-1] != len(buffer)) or any(a > b for a, b in zip(ends, ends[1:])):
+		raise ValueError("Chunk ends do not match the chunk buffer")
+	return payloadId, positions, ends, buffer
+
+
+def check_claims(chunks, positions, ends, buffer):
+	"""
+		- The bitmap of the claims against the ChunkView of the payload held by this peer
+	"""
+	count = len(positions)
+	size = chunks.chunk_size
+	payload = chunks.payload
+	ascii = payload.isascii()
+	data = payload.encode('ascii') if ascii else None
+	invalid = [i for i, p in enumerate(positions) if p >= len(chunks)] if count and max(positions) >= len(chunks) else []
+
+	if ascii and not invalid and count and positions == array(UINT32, range(positions[0], positions[0] + count)):
+		# Claims for consecutive chunks, the expected buffer is a single slice of the payload
+		first = positions[0] * size
+		expected = data[first:first + count * size]
+		expected_ends = array(UINT32, range(size, count * size + 1, size))
+		expected_ends[-1] = len(expected)
+		pieces = None
+	else:
+		if ascii:
+			pieces = [data[p * size:(p + 1) * size] for p in positions]
+		else:
+			pieces = [chunks[p].encode() if p < len(chunks) else b'' for p in positions]
+		for i in invalid:
+			pieces[i] = b''
+		expected = b''.join(pieces)
+		expected_ends = array(UINT32, accumulate(map(len, pieces)))
+
+	bitmap = _bitmap(count)
+
+	def check_one(i):
+		start = ends[i - 1] if i else 0
+		if pieces is None:
+			# The held chunk, not the slice at the claimed ends: those are not the expected ones in this branch
+			held_start = expected_ends[i - 1] if i else 0
+			matches = buffer[start:ends[i]] == expected[held_start:expected_ends[i]]
+		else:
+			matches = buffer[start:ends[i]] == pieces[i]
+		if not matches:
+			bitmap[i >> 3] &= ~(0x80 >> (i & 7))
+
+	if expected_ends == ends:
+		if buffer != expected:
+			for block in range(0, count, COMPARE_BLOCK):
+				last = min(block + COMPARE_BLOCK, count) - 1
+				start = ends[block - 1] if block else 0
+				if buffer[start:ends[last]] != expected[start:ends[last]]:
+					for i in range(block, last + 1):
+						check_one(i)
+	else:
+		for i in range(count):
+			check_one(i)
+
+	for i in invalid:
+		bitmap[i >> 3] &= ~(0x80 >> (i & 7))
+	return bytes(bitmap)
+
+
+def encode_results(status, count=0, bitmap=b''):
+	return RESULTS_HEADER.pack(status, count) + bitmap
+
+
+class ClaimResults(Sequence):
+	"""
+		- The results of binary claims, result i is True if claim i was correct.
+		- Reads the bits of the bitmap on access, all() checks the whole bitmap at once.
+	"""
+	__slots__ = ('bitmap', 'count')
+
+	def __init__(self, bitmap, count):
+		self.bitmap = bitmap
+		self.count = count
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(self.count))]
+		if index < 0:
+			index += self.count
+		if not 0 <= index < self.count:
+			raise IndexError("claim index out of range")
+		return bool(self.bitmap[index >> 3] & (0x80 >> (index & 7)))
+
+	def __repr__(self):
+		return repr(list(self))
+
+	def all(self):
+		return self.bitmap == bytes(_bitmap(self.count))
+
+	def valid(self):
+		"""
+			- Number of correct claims
+		"""
+		return bin(int.from_bytes(self.bitmap, 'big')).count('1')
+
+
+def decode_results(body):
+	"""
+		- The response to binary claims in the same shape as the JSON response:
+		{'chunk_available': bool, 'results': ClaimResults}
+	"""
+	status, count = RESULTS_HEADER.unpack_from(body)
+	if status == STATUS_CORRUPTED:
+		raise ValueError("The peer could not decode the claims")
+	if status == STATUS_UNAVAILABLE:
+		return {'chunk_available': False}
+	return {'chunk_available': True, 'results': ClaimResults(bytes(body[RESULTS_HEADER.size:]), count)}
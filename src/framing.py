@@ -0,0 +1,217 @@
+"""
+	- Wire format of the messages exchanged over a P2PChannel.
+
+	- A framed message is a fixed size header followed by the body:
+		magic (4) | flags (1) | message type (1) | request id (4) | body length (8) | body
+	all in network byte order.
+
+	- The request id lets one channel carry many requests at once. A response carries the id of the
+	request it answers and has FLAG_RESPONSE set, so responses can come back in any order.
+
+	- Old peers terminate every message with END_BYTE instead. A reader looks at the first 4 bytes of
+	every message to tell the two apart, so a framed peer can still talk to an EOM peer while the
+	framing is being rolled out.
+
+	- Whether the other peer understands frames is negotiated during the ID exchange: a framed peer
+	appends CAPABILITY_SEP + "framed" to the ID it sends, and only answers with the capability if it
+	was offered. An old acceptor will keep the suffix as part of our ID, which only shows up in its logs.
+	Capabilities that need frames, like message types added later (CAPABILITY_BINARY_CLAIMS), are
+	offered the same way, as a comma separated list after "framed".
+
+	- A message is read whole before it is handled, so its length is capped at MAX_FRAME_SIZE (the
+	P2P_MAX_FRAME_SIZE environment variable). A longer one, or a length in the header that is that
+	large, closes the channel instead of being allocated.
+"""
+import asyncio
+import os
+import struct
+from collections import namedtuple
+
+FRAME_MAGIC = b"P2F\x01"
+FRAME_HEADER = struct.Struct("!4sBBIQ")
+END_BYTE = b"EOM\x01"
+MAX_FRAME_SIZE = int(os.environ.get("P2P_MAX_FRAME_SIZE", 64 * 1024 * 1024)) # bytes of a message body
+
+FLAG_RESPONSE = 0x01
+
+# Message types
+MSG_CLAIMS = 0
+MSG_BINARY_CLAIMS = 1 # see claims.py, only sent to peers with CAPABILITY_BINARY_CLAIMS
+MSG_GOSSIP = 2 # peer list digests, see Node.gossip_round, only sent to peers with CAPABILITY_GOSSIP
+
+FrameInfo = namedtuple('FrameInfo', ['framed', 'flags', 'msg_type', 'request_id'])
+LEGACY_FRAME = FrameInfo(False, 0, MSG_CLAIMS, 0) # EOM messages carry no header, they are always claims
+
+CAPABILITY_SEP = "\x00"
+CAPABILITY_FRAMED = "framed"
+CAPABILITY_BINARY_CLAIMS = "binary-claims"
+CAPABILITY_GOSSIP = "gossip"
+
+
+class ChannelClosed(ConnectionError):
+	""" The other peer closed the connection in the middle of (or before) a message """
+
+
+class FrameTooLarge(ChannelClosed):
+	""" A message of more than MAX_FRAME_SIZE bytes, the channel cannot be read any further """
+
+
+def check_length(length):
+	if length > MAX_FRAME_SIZE:
+		raise FrameTooLarge(f"Message of {length} bytes, more than MAX_FRAME_SIZE ({MAX_FRAME_SIZE})")
+
+
+def encode_hello(node_id, framed=True, capabilities=()):
+	"""
+		- The bytes a peer sends during the ID exchange, capabilities are only sent along with framing
+	"""
+	if framed:
+		return f"{node_id}{CAPABILITY_SEP}{','.join([CAPABILITY_FRAMED, *capabilities])}".encode()
+	return node_id.encode()
+
+
+def decode_capabilities(data):
+	"""
+		- Split the ID exchange into the node id and the set of capabilities of the other peer
+	"""
+	node_id, _, capabilities = data.decode().partition(CAPABILITY_SEP)
+	capabilities = set(capabilities.split(',')) if capabilities else set()
+	if CAPABILITY_FRAMED not in capabilities:
+		return node_id, set()
+	return node_id, capabilities
+
+
+def decode_hello(data):
+	"""
+		- Split the ID exchange into the node id and whether the other peer speaks frames
+	"""
+	node_id, capabilities = decode_capabilities(data)
+	return node_id, CAPABILITY_FRAMED in capabilities
+
+
+def frame_buffers(body, request_id=0, flags=0, msg_type=MSG_CLAIMS):
+	"""
+		- The buffers that make up one framed message, body is not copied
+	"""
+	return [FRAME_HEADER.pack(FRAME_MAGIC, flags, msg_type, request_id, len(body)), body]
+
+
+def send_message(sock, body, framed=True, request_id=0, flags=0, msg_type=MSG_CLAIMS):
+	"""
+		- Send a single message in either wire format.
+		- A framed message is written with one gathered sendmsg call instead of concatenating
+		header and body.
+	"""
+	if not framed:
+		sock.sendall(bytes(body) + END_BYTE)
+		return
+
+	buffers = [memoryview(b).cast('B') for b in frame_buffers(body, request_id, flags, msg_type)]
+	while buffers:
+		sent = sock.sendmsg(buffers)
+		while buffers and sent >= len(buffers[0]):
+			sent -= len(buffers[0])
+			buffers.pop(0)
+		if buffers and sent:
+			buffers[0] = buffers[0][sent:]
+
+
+class FrameReader:
+	"""
+		- Reads messages of a blocking socket with recv_into, into a single buffer that is reused for
+		every message on the channel.
+		- read_message returns a memoryview into that buffer, it is only valid until the next call.
+	"""
+
+	def __init__(self, sock, buffer_size=64 * 1024):
+		self.sock = sock
+		self.buffer = bytearray(buffer_size)
+		self.view = memoryview(self.buffer)
+		self.start = 0 # unread data is self.buffer[self.start:self.end]
+		self.end = 0
+
+	def _reserve(self, size):
+		"""
+			- Make room for size unread bytes, moving the unread data to the front of the buffer
+			and growing it only if the message does not fit.
+		"""
+		unread = self.end - self.start
+		if size > len(self.buffer):
+			buffer = bytearray(max(size, 2 * len(self.buffer)))
+			buffer[:unread] = self.view[self.start:self.end]
+			self.buffer = buffer
+			self.view = memoryview(self.buffer)
+		elif self.start + size > len(self.buffer):
+			self.buffer[:unread] = bytes(self.view[self.start:self.end])
+		else:
+			return
+		self.start, self.end = 0, unread
+
+	def _recv(self):
+		if self.end == len(self.buffer):
+			self._reserve(self.end - self.start + 1)
+		n = self.sock.recv_into(self.view[self.end:])
+		if n == 0:
+			raise ChannelClosed("The other peer closed the connection")
+		self.end += n
+
+	def _fill(self, size):
+		self._reserve(size)
+		while self.end - self.start < size:
+			self._recv()
+
+	def read_message(self):
+		"""
+			- Read the next message, whichever wire format it is in.
+			- Returns (body, FrameInfo)
+		"""
+		self._fill(len(FRAME_MAGIC))
+		if self.view[self.start:self.start + len(FRAME_MAGIC)] == FRAME_MAGIC:
+			self._fill(FRAME_HEADER.size)
+			_, flags, msg_type, request_id, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+			self.start += FRAME_HEADER.size
+			check_length(length)
+			self._fill(length)
+			body = self.view[self.start:self.start + length]
+			self.start += length
+			return body, FrameInfo(True, flags, msg_type, request_id)
+
+		# EOM terminated message, only the newly received bytes are searched for the end byte
+		scanned = 0
+		while True:
+			index = self.buffer.find(END_BYTE, self.start + scanned, self.end)
+			if index != -1:
+				body = self.view[self.start:index]
+				self.start = index + len(END_BYTE)
+				return body, LEGACY_FRAME
+			scanned = max(0, self.end - self.start - len(END_BYTE) + 1)
+			check_length(scanned)
+			self._recv()
+
+
+async def read_message_async(reader):
+	"""
+		- read_message for an asyncio StreamReader
+		- Returns (body, FrameInfo)
+	"""
+	magic = await reader.readexactly(len(FRAME_MAGIC))
+	if magic == FRAME_MAGIC:
+		header = magic + await reader.readexactly(FRAME_HEADER.size - len(FRAME_MAGIC))
+		_, flags, msg_type, request_id, length = FRAME_HEADER.unpack(header)
+		# readexactly does not go by the limit of the reader
+		check_length(length)
+		return await reader.readexactly(length), FrameInfo(True, flags, msg_type, request_id)
+
+	# EOM terminated message. The end byte may have started inside the 4 bytes that were already read,
+	# so read byte by byte while the tail of the message could be the start of an end byte.
+	message = magic
+	while not message.endswith(END_BYTE):
+		check_length(len(message))
+		if any(message.endswith(END_BYTE[:k]) for k in range(1, len(END_BYTE))):
+			message += await reader.readexactly(1)
+			continue
+		try:
+			message += await reader.readuntil(END_BYTE)
+		except asyncio.LimitOverrunError as e:
+			raise FrameTooLarge(f"Message of more than {e.consumed} bytes without an end byte") from e
+	return message[:-len(END_BYTE)], LEGACY_FRAME
@@ -0,0 +1,158 @@
+"""
+	- Chunk hashing shared by the tracker and the peers.
+
+	- A payload is split into chunks of CHUNK_SIZE characters and every chunk is hashed with sha224.
+	The chunk size can be changed with the P2P_CHUNK_SIZE environment variable, the tracker and the peers
+	have to use the same value.
+
+	- ASCII payloads (the common case) are encoded once and hashed from memoryview slices of the encoded
+	bytes. Payloads of PARALLEL_THRESHOLD bytes or more are split into ranges that are hashed on a pool of
+	HASH_WORKERS processes, hashlib keeps the GIL for inputs this small so threads would not help.
+	- The pool is started with forkserver (spawn where there is no forkserver): the tracker hashes from
+	its threadpool, a forked worker would inherit the locks of the other threads in whatever state they are.
+"""
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+CHUNK_SIZE = int(os.environ.get("P2P_CHUNK_SIZE", 4))
+DIGEST_SIZE = hashlib.sha224().digest_size
+HEX_SIZE = 2 * DIGEST_SIZE
+
+PARALLEL_THRESHOLD = int(os.environ.get("P2P_HASH_PARALLEL_THRESHOLD", 1 << 20))
+HASH_WORKERS = int(os.environ.get("P2P_HASH_WORKERS", os.cpu_count() or 1))
+
+_pool = None
+_pool_lock = threading.Lock() # the first payloads to go parallel can be hashed from several threads
+
+
+def _get_pool():
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+			_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context(method))
+	return _pool
+
+
+def _workers(size):
+	"""
+		- The number of processes a payload of size bytes is hashed on, 1 for the calling thread alone
+	"""
+	return min(HASH_WORKERS, size // PARALLEL_THRESHOLD + 1)
+
+
+def _digest_range(data, chunk_size):
+	"""
+		- Packed sha224 digests of the chunks of data, data has to start on a chunk boundary
+	"""
+	sha224 = hashlib.sha224
+	view = memoryview(data)
+	return b''.join([sha224(view[i:i + chunk_size]).digest() for i in range(0, len(view), chunk_size)])
+
+
+def generate_digests(payload_string, chunk_size=CHUNK_SIZE):
+	"""
+		- The sha224 digests of every chunk of the payload, packed back to back in one bytes object
+	"""
+	if not payload_string.isascii():
+		# Chunks are counted in characters, which are not a fixed number of bytes here
+		sha224 = hashlib.sha224
+		return b''.join([sha224(payload_string[i:i + chunk_size].encode()).digest()
+			for i in range(0, len(payload_string), chunk_size)])
+
+	data = payload_string.encode('ascii')
+	workers = _workers(len(data))
+	if workers <= 1:
+		return _digest_range(data, chunk_size)
+
+	step = -(-len(data) // workers // chunk_size) * chunk_size # range size rounded up to whole chunks
+	ranges = [data[i:i + step] for i in range(0, len(data), step)]
+	return b''.join(_get_pool().map(_digest_range, ranges, [chunk_size] * len(ranges)))
+
+
+def generate_hashes(payload_string, chunk_size=CHUNK_SIZE):
+	"""
+		- The string will be split into a list of new strings with chunk_size characters each
+		- Each of those new strings will be hashed
+		- Every single hash of the new strings will be added and hashed together to
+		create a new hash string which will be returned along with the list of chunks
+	"""
+	sha224 = hashlib.sha224
+	if not payload_string.isascii():
+		hashes = [sha224(payload_string[i:i + chunk_size].encode()).hexdigest()
+			for i in range(0, len(payload_string), chunk_size)]
+	elif _workers(len(payload_string)) <= 1:
+		# One hexdigest per chunk, the packed digests would take one more pass to hex and split them
+		view = memoryview(payload_string.encode('ascii'))
+		hashes = [sha224(view[i:i + chunk_size]).hexdigest() for i in range(0, len(view), chunk_size)]
+	else:
+		return hex_hashes(generate_digests(payload_string, chunk_size))
+	return hashes, sha224(''.join(hashes).encode()).hexdigest()
+
+
+def hex_hashes(packed):
+	"""
+		- The (hashes, full_hash) pair of generate_hashes for the output of generate_digests
+	"""
+	hex_digests = packed.hex()
+	return split_hex(hex_digests), hashlib.sha224(hex_digests.encode()).hexdigest()
+
+
+def full_hash(packed):
+	"""
+		- The full hash of generate_hashes for the output of generate_digests, it is over the concatenated
+		hex digests, which is the hex of the packed digests.
+	"""
+	return hashlib.sha224(packed.hex().encode()).hexdigest()
+
+
+def split_hex(hex_digests):
+	"""
+		- The individual hex digests of packed.hex()
+	"""
+	return [hex_digests[i:i + HEX_SIZE] for i in range(0, len(hex_digests), HEX_SIZE)]
+
+
+def split_digests(packed):
+	"""
+		- The individual digests of the output of generate_digests
+	"""
+	return [packed[i:i + DIGEST_SIZE] for i in range(0, len(packed), DIGEST_SIZE)]
+
+
+class StreamHasher:
+	"""
+		- generate_hashes for a payload that arrives in pieces of any size.
+		- update() returns the packed digests of the chunks completed by the piece, the characters of an
+		unfinished chunk are kept until the next piece. finish() hashes the last, short chunk.
+		- full_hash is only final after finish().
+	"""
+
+	def __init__(self, chunk_size=CHUNK_SIZE):
+		self.chunk_size = chunk_size
+		self.carry = ''
+		self.full = hashlib.sha224()
+		self.count = 0 # number of chunks hashed so far
+
+	def update(self, text):
+		text = self.carry + text
+		cut = len(text) - len(text) % self.chunk_size
+		self.carry = text[cut:]
+		return self._digest(text[:cut])
+
+	def finish(self):
+		text, self.carry = self.carry, ''
+		return self._digest(text)
+
+	def _digest(self, text):
+		packed = generate_digests(text, self.chunk_size)
+		self.full.update(packed.hex().encode())
+		self.count += len(packed) // DIGEST_SIZE
+		return packed
+
+	@property
+	def full_hash(self):
+		return self.full.hexdigest()
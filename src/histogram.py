@@ -0,0 +1,128 @@
+"""
+	- Latency histograms with fixed log-scale buckets, shared by the tracker and the peers.
+
+	- Bucket i counts the observations up to BUCKETS[i] seconds, the bounds double from 10us up to about
+	80s and a last bucket takes everything above. Recording is a bisect and an increment, so it can be
+	done around every request. Percentiles are estimated by interpolating inside the bucket they fall in.
+
+	- Histograms are kept in a Registry by name and labels, which can render all of them in the
+	Prometheus text format.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+BUCKETS = tuple(1e-5 * 2 ** i for i in range(24))
+
+
+class Histogram:
+
+	def __init__(self, bounds=BUCKETS):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def observe(self, seconds):
+		index = bisect_left(self.bounds, seconds)
+		with self.lock:
+			self.counts[index] += 1
+			self.sum += seconds
+			self.count += 1
+
+	@contextmanager
+	def time(self):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start)
+
+	def percentile(self, p):
+		"""
+			- Estimate of the p-th percentile (0-100) in seconds, None if nothing has been observed
+		"""
+		with self.lock:
+			counts, total = list(self.counts), self.count
+		if not total:
+			return None
+		rank = total * p / 100
+		seen = 0
+		for index, count in enumerate(counts):
+			if count and seen + count >= rank:
+				lower = self.bounds[index - 1] if index else 0.0
+				upper = self.bounds[index] if index < len(self.bounds) else self.bounds[-1] * 2
+				return lower + (upper - lower) * (rank - seen) / count
+			seen += count
+		return self.bounds[-1] * 2
+
+	def summary(self):
+		return {
+			'count': self.count,
+			'mean': self.sum / self.count if self.count else None,
+			'p50': self.percentile(50),
+			'p90': self.percentile(90),
+			'p99': self.percentile(99),
+		}
+
+
+def _labels(labels, extra=()):
+	pairs = list(labels) + list(extra)
+	if not pairs:
+		return ''
+	return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Registry:
+	"""
+		- The histograms of one process, a histogram is created the first time its name and labels are used
+	"""
+
+	def __init__(self):
+		self.families = {} # name -> (help, {labels: Histogram})
+		self.lock = threading.Lock()
+
+	def histogram(self, name, help='', **labels):
+		key = tuple(sorted(labels.items()))
+		family = self.families.get(name)
+		if family is None or key not in family[1]:
+			with self.lock:
+				family = self.families.setdefault(name, (help, {}))
+				family[1].setdefault(key, Histogram())
+		return family[1][key]
+
+	def observe(self, name, seconds, **labels):
+		self.histogram(name, **labels).observe(seconds)
+
+	def time(self, name, **labels):
+		return self.histogram(name, **labels).time()
+
+	def summary(self):
+		"""
+			- {name: {labels: summary}} of every histogram, see Histogram.summary
+		"""
+		return {name: {_labels(key): h.summary() for key, h in list(histograms.items())}
+			for name, (_, histograms) in list(self.families.items())}
+
+	def prometheus(self):
+		"""
+			- All the histograms in the Prometheus text format
+		"""
+		lines = []
+		for name, (help, histograms) in list(self.families.items()):
+			if help:
+				lines.append(f"# HELP {name} {help}")
+			lines.append(f"# TYPE {name} histogram")
+			for key, h in list(histograms.items()):
+				with h.lock:
+					counts, total, sum_ = list(h.counts), h.count, h.sum
+				cumulative = 0
+				for bound, count in zip(h.bounds, counts):
+					cumulative += count
+					lines.append(f"{name}_bucket{_labels(key, [('le', f'{bound:g}')])} {cumulative}")
+				lines.append(f"{name}_bucket{_labels(key, [('le', '+Inf')])} {total}")
+				lines.append(f"{name}_sum{_labels(key)} {sum_}")
+				lines.append(f"{name}_count{_labels(key)} {total}")
+		return '\n'.join(lines) + '\n'
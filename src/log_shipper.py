@@ -0,0 +1,153 @@
+"""
+	- Ships the activity logs of a peer to Redis from a background thread.
+
+	- Node.log_activities only puts the log on a bounded queue. The shipper thread takes the logs off the
+	queue in batches and writes every batch with one pipeline: one LPUSH and LTRIM per log list and one
+	HINCRBY per counter, instead of a round trip per log on the thread that is doing the work.
+
+	- A batch is written once it has LOG_BATCH_SIZE logs or LOG_FLUSH_INTERVAL seconds after its first log.
+	- When Redis cannot keep up and the queue is full, the policy decides what happens to new logs:
+	POLICY_DROP drops them (they are counted in dropped), POLICY_BLOCK makes the caller wait for room.
+"""
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+POLICY_DROP = "drop"
+POLICY_BLOCK = "block"
+
+LOG_QUEUE_SIZE = int(os.environ.get("P2P_LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = int(os.environ.get("P2P_LOG_BATCH_SIZE", 500))
+LOG_FLUSH_INTERVAL = float(os.environ.get("P2P_LOG_FLUSH_INTERVAL", 0.2))
+LOG_POLICY = os.environ.get("P2P_LOG_POLICY", POLICY_DROP)
+
+
+class LogShipper(threading.Thread):
+
+	def __init__(self, conn, max_queue=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+			flush_interval=LOG_FLUSH_INTERVAL, policy=LOG_POLICY):
+		"""
+			args:
+				conn - The Redis connection the logs are written with
+				max_queue - Logs that can wait on the queue before the policy kicks in
+				batch_size - Logs written per pipeline at most
+				flush_interval - Seconds a log waits at most for its batch to fill up
+				policy - POLICY_DROP or POLICY_BLOCK
+		"""
+		super(LogShipper, self).__init__(daemon=True)
+		if policy not in (POLICY_DROP, POLICY_BLOCK):
+			raise ValueError(f"Unknown log policy: {policy}")
+		self.conn = conn
+		self.queue = queue.Queue(maxsize=max_queue)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.policy = policy
+		self.closed = False
+
+		self.shipped = 0
+		self.dropped = 0 # logs dropped because the queue was full or Redis failed
+
+		self._timestamps = (None, None) # last second formatted and its timestamp string
+
+	def ship(self, destination, counters, message, trim=None):
+		"""
+			- Queue a log for the list destination and a +1 for every (hash, field) counter in counters.
+			The list is trimmed to trim + 1 logs.
+		"""
+		log = (destination, counters, trim, time.time(), message)
+		if self.closed:
+			# Logs of a peer that has been killed are written right away
+			self.write([log])
+			return
+		if self.policy == POLICY_BLOCK:
+			self.queue.put(log)
+			return
+		try:
+			self.queue.put_nowait(log)
+		except queue.Full:
+			self.dropped += 1
+
+	def flush(self, timeout=5):
+		"""
+			- Wait until every log queued before the call has been written, returns False on timeout
+		"""
+		if self.closed or not self.is_alive():
+			return True
+		done = threading.Event()
+		try:
+			self.queue.put(done, timeout=timeout)
+		except queue.Full:
+			return False
+		return done.wait(timeout)
+
+	def close(self, timeout=5):
+		"""
+			- Write what is left on the queue and stop the thread
+		"""
+		if self.closed:
+			return
+		self.flush(timeout)
+		self.closed = True
+		self.queue.put(None)
+		self.join(timeout)
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			batch, waiters = [], []
+			deadline = time.monotonic() + self.flush_interval
+			while True:
+				if isinstance(item, threading.Event):
+					waiters.append(item)
+					break
+				if item is None:
+					self.write(batch)
+					return
+				batch.append(item)
+				if len(batch) >= self.batch_size:
+					break
+				try:
+					item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+				except queue.Empty:
+					break
+			self.write(batch)
+			for waiter in waiters:
+				waiter.set()
+
+	def _timestamp(self, ts):
+		second = int(ts)
+		if self._timestamps[0] != second:
+			self._timestamps = (second, datetime.strftime(datetime.fromtimestamp(second), "%y/%m/%d %H:%M:%S"))
+		return self._timestamps[1]
+
+	def write(self, batch):
+		"""
+			- Write a batch of logs with one pipeline
+		"""
+		if not batch:
+			return
+		lists = OrderedDict()
+		counters = OrderedDict()
+		for destination, log_counters, trim, ts, message in batch:
+			lists.setdefault(destination, [trim, []])[1].append(self._timestamp(ts) + message)
+			for counter in log_counters:
+				counters[counter] = counters.get(counter, 0) + 1
+
+		pipe = self.conn.pipeline()
+		for destination, (trim, messages) in lists.items():
+			pipe.lpush(destination, *messages)
+			if trim and isinstance(trim, int):
+				pipe.ltrim(destination, 0, trim)
+		for (key, field), count in counters.items():
+			pipe.hincrby(key, field, count)
+		try:
+			pipe.execute()
+			self.shipped += len(batch)
+		except Exception as e:
+			self.dropped += len(batch)
+			print(f"Could not write {len(batch)} logs to Redis: {e}")
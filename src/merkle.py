@@ -0,0 +1,116 @@
+"""
+	- Merkle tree over the chunk hashes of a payload, shared by the tracker and the peers.
+
+	- Level 0 holds the sha224 digests of the chunks, in order. Every next level pairs up the nodes of the
+	level below: the parent is sha224(NODE_PREFIX + left + right). A node left without a sibling (the last
+	node of a level with an odd number of nodes) is carried up to the next level unchanged.
+
+	- The tree of a payload with n chunks has ceil(log2(n)) + 1 levels, an inclusion proof for a chunk
+	is one sibling digest per level it is not carried up on.
+"""
+import hashlib
+
+DIGEST_SIZE = hashlib.sha224().digest_size
+NODE_PREFIX = b"\x01" # keeps a parent from ever being mistaken for a chunk digest
+
+
+def hash_pair(left, right):
+	return hashlib.sha224(NODE_PREFIX + left + right).digest()
+
+
+class MerkleBuilder:
+	"""
+		- Builds the tree from leaves that are added one at a time, in order.
+		- Only one node per level is kept to wait for its sibling, the levels themselves are collected in
+		self.levels and can be taken out with flush() while the tree is being built.
+	"""
+
+	def __init__(self):
+		self.pending = [] # pending[level] is the node waiting for its right sibling, or None
+		self.levels = [] # levels[level] are the nodes of that level built since the last flush
+		self.root = None
+
+	def add(self, digest, level=0):
+		while True:
+			if level == len(self.pending):
+				self.pending.append(None)
+				self.levels.append([])
+			self.levels[level].append(digest)
+			if self.pending[level] is None:
+				self.pending[level] = digest
+				return
+			digest = hash_pair(self.pending[level], digest)
+			self.pending[level] = None
+			level += 1
+
+	def flush(self):
+		"""
+			- Return the nodes built since the last flush, as one list per level
+		"""
+		levels, self.levels = self.levels, [[] for _ in self.pending]
+		return levels
+
+	def finish(self):
+		"""
+			- Carry the leftover nodes up and return the root digest (None for an empty tree)
+		"""
+		level = 0
+		while level < len(self.pending) - 1:
+			node = self.pending[level]
+			if node is not None:
+				self.pending[level] = None
+				# node is already part of this level, it only has to be added to the next one
+				self.add(node, level + 1)
+			level += 1
+		self.root = self.pending[-1] if self.pending else None
+		return self.root
+
+
+def merkle_levels(leaves):
+	"""
+		- All the levels of the tree over the given leaf digests, from the leaves up to the root
+	"""
+	builder = MerkleBuilder()
+	for leaf in leaves:
+		builder.add(leaf)
+	builder.finish()
+	return builder.flush()
+
+
+def level_sizes(count):
+	"""
+		- Number of nodes on every level of a tree with count leaves
+	"""
+	sizes = [count]
+	while sizes[-1] > 1:
+		sizes.append((sizes[-1] + 1) // 2)
+	return sizes
+
+
+def proof_path(index, count):
+	"""
+		- The nodes that make up the inclusion proof of leaf index in a tree with count leaves.
+		- Yields (level, sibling index, sibling is on the left), levels where the node is carried up
+		are skipped.
+	"""
+	for level, size in enumerate(level_sizes(count)[:-1]):
+		sibling = index ^ 1
+		if sibling < size:
+			yield level, sibling, sibling < index
+		index //= 2
+
+
+def verify_proof(leaf, index, count, proof, root):
+	"""
+		- Check that leaf is the digest at position index of the tree with count leaves and the given root.
+		- proof is the list of sibling digests in the order given by proof_path.
+	"""
+	if not 0 <= index < count:
+		return False
+	path = list(proof_path(index, count))
+	if len(path) != len(proof):
+		return False
+	node = leaf
+	for (_, _, left), sibling in zip(path, proof):
+		node = hash_pair(sibling, node) if left else hash_pair(node, sibling)
+	return node == root
@@ -0,0 +1,108 @@
+"""
+	- Moves the chunk digests of the payloads uploaded before the packed layout from their chunks:payloadId
+	hash (one 56 character hex digest per chunk, in a field named after its index) to merkle:payloadId:0
+	(the 28 byte digests back to back, see server.store_merkle).
+
+	- The tracker reads both layouts, so the migration can run while it serves requests, and can be run
+	again: it only looks at the chunks:* hashes that are left. Payloads are converted BATCH at a time, the
+	hashes of a batch are read with one pipeline and replaced with one transaction that WATCHes them. A
+	payload deleted in the meantime makes the batch start over.
+
+	Usage: export PYTHONPATH=src; python3 src/migrate_chunks.py [--dry-run]
+"""
+import argparse
+
+import redis
+
+from merkle import DIGEST_SIZE
+from server import REDIS_HOST, REDIS_PORT
+
+BATCH = 100
+
+
+def pack(chunks):
+	"""
+		- The packed digests of a chunks:payloadId hash, as returned by HGETALL
+	"""
+	return bytes.fromhex(b''.join([chunks[k] for k in sorted(chunks, key=int)]).decode())
+
+
+def migrate_batch(conn, keys, dry_run=False):
+	"""
+		- Convert the chunks:payloadId hashes in keys, returns (payloads converted, bytes the hashes took,
+		bytes the packed digests take). With dry_run nothing is written and the last one is the size of
+		the digests alone.
+		- Keys that are not hashes are skipped, SCAN only filters by type from Redis 6 on.
+	"""
+	types = conn.pipeline(transaction=False)
+	for key in keys:
+		types.type(key)
+	keys = [key for key, kind in zip(keys, types.execute()) if kind == b'hash']
+	if not keys:
+		return 0, 0, 0
+
+	with conn.pipeline(transaction=True) as pipe:
+		while True:
+			try:
+				pipe.watch(*keys)
+				reads = conn.pipeline(transaction=False)
+				for key in keys:
+					reads.hgetall(key)
+					reads.memory_usage(key)
+				results = reads.execute()
+				hashes = [(key, chunks, usage) for key, chunks, usage in zip(keys, results[::2], results[1::2]) if chunks]
+				before = sum(usage or 0 for _, _, usage in hashes)
+				if dry_run:
+					return len(hashes), before, sum(len(chunks) for _, chunks, _ in hashes) * DIGEST_SIZE
+
+				pipe.multi()
+				converted = []
+				for key, chunks, _ in hashes:
+					payloadId = key[len('chunks:'):]
+					converted.append(f'merkle:{payloadId}:0')
+					pipe.set(converted[-1], pack(chunks))
+					pipe.hset(f'hash:{payloadId}', 'chunks', converted[-1])
+					pipe.delete(key)
+				pipe.execute()
+				break
+			except redis.WatchError:
+				continue
+
+	reads = conn.pipeline(transaction=False)
+	for key in converted:
+		reads.memory_usage(key)
+	return len(converted), before, sum(usage or 0 for usage in reads.execute())
+
+
+def migrate(conn, batch=BATCH, dry_run=False):
+	"""
+		- Convert every chunks:payloadId hash, returns the totals of migrate_batch
+	"""
+	totals = [0, 0, 0]
+	keys = []
+	for key in conn.scan_iter(match='chunks:*', count=1000):
+		keys.append(key.decode())
+		if len(keys) == batch:
+			totals = [t + n for t, n in zip(totals, migrate_batch(conn, keys, dry_run))]
+			keys = []
+	if keys:
+		totals = [t + n for t, n in zip(totals, migrate_batch(conn, keys, dry_run))]
+	return tuple(totals)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--host', default=REDIS_HOST)
+	parser.add_argument('--port', type=int, default=REDIS_PORT)
+	parser.add_argument('--batch', type=int, default=BATCH, help="payloads converted per transaction")
+	parser.add_argument('--dry-run', action='store_true', help="only count the payloads to convert")
+	args = parser.parse_args()
+
+	conn = redis.StrictRedis(host=args.host, port=args.port)
+	payloads, before, after = migrate(conn, args.batch, args.dry_run)
+	print(f"{'Would convert' if args.dry_run else 'Converted'} {payloads} payloads: "
+		f"{before / 2 ** 20:.2f} MB of chunk hashes -> {after / 2 ** 20:.2f} MB of packed digests")
+
+
+if __name__ == "__main__":
+	main()
@@ -1,13 +1,27 @@
 import socket
 import threading
+import asyncio
 import time # for sleep function
 from datetime import datetime # for creating timestamp as datetime
-import requests
 import json
+import hashlib
+import itertools
+import random
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
 
 from enum import Enum
 import redis
 
+from merkle import verify_proof
+from payload_cache import PayloadCache
+from log_shipper import LogShipper
+from histogram import Registry
+from tracker_client import shared_client
+from framing import (FrameReader, ChannelClosed, FrameTooLarge, END_BYTE, MAX_FRAME_SIZE, FLAG_RESPONSE, MSG_CLAIMS, MSG_BINARY_CLAIMS, MSG_GOSSIP,
+	CAPABILITY_FRAMED, CAPABILITY_BINARY_CLAIMS, CAPABILITY_GOSSIP, encode_hello, decode_capabilities, send_message, frame_buffers, read_message_async)
+from claims import (STATUS_UNAVAILABLE, STATUS_CHECKED, STATUS_CORRUPTED, encode_claims, decode_claims,
+	check_claims, encode_results, decode_results)
+
 class SEVERITY(Enum):
 
 	# Activities/Communication with other peers
@@ -16,14 +30,17 @@ class SEVERITY(Enum):
 	SHUTDOWN_SOCK = 9
 	VERIFY_CLAIM = 10
 	PARSE_CLAIM = 13
+	GOSSIP_PEERS = 14
 	CONNECT_TO_NODE = 15
 
 	# Activities/Communication with the trusted server
 	UPLOAD_PAYLOAD = 20
+	DELETE_PAYLOAD = 21
 	QUERRY_PAYLOAD = 23
 	REGISTER_PEER = 25
 	DEREGISTER_PEER = 30
 	GET_PEERS = 33
+	QUERRY_PROOF = 35
 
 
 class Node(threading.Thread):
@@ -31,11 +48,17 @@ class Node(threading.Thread):
 		- This class represents a peer. 
 		- A peer is an instance of Node, capable of accepting connections from other peers.
 		- Send and recieve messages from other peers, and also broadcast a single message to all the 
-		other peers that are currently connected to it.
+		other peers that are currently connected to it (see verify_payload_many).
 		
 		NOTE:
-		- At a time, a peer can accept data from only a single other peer, even though this peer maybe be connected 
-		to many other peers.
+		- At a time, a peer can accept data from only a single EOM peer, even though this peer maybe be connected 
+		to many other peers. Framed channels are long lived and each one is served on its own thread.
+
+		- Unless the peer is started with use_asyncio=True, in which case every inbound channel is served 
+		concurrently on a single asyncio event loop.
+
+		- A framed channel is kept in connected_peers until either side closes it, and is reused by
+		connect_to_node and verify_payload instead of connecting again for every verification.
 
 		- If a peer wants to send data to another peer, it must first establish a connection to that peer and that connection
 		must be accepted at the target peer, only then the process of sending data can be started.
@@ -45,10 +68,14 @@ class Node(threading.Thread):
 		- Peer 2 peer communication will start with first exchanging each other's ID's
 	"""
 
-	def __init__(self, host, port):
+	def __init__(self, host, port, use_asyncio=False, tracker_client=None):
 		"""
 			host(str): The host from which the socket can accept connections from.
 			port(int): The port to which it can listen to or send to.
+			use_asyncio(bool): Serve inbound channels concurrently on an asyncio event loop instead of 
+			accepting and serving one channel at a time.
+			tracker_client(TrackerClient): The pooled HTTP client the calls to the tracker are sent with,
+			by default the one shared by all the peers of the process.
 		"""
 		super(Node,self).__init__() # Initialize the Thread class
 
@@ -61,7 +88,7 @@ class Node(threading.Thread):
 		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		#self.sock.settimeout(0.2)
 		self.sock.bind(self.hostname)
-		self.sock.listen(10)
+		self.sock.listen(socket.SOMAXCONN) # Concurrent verifiers must not overflow the accept queue
 
 		""" Initialized Id """
 		self.id = datetime.strftime(datetime.now(), "%y%m%d_%H%M%S%f")
@@ -76,16 +103,38 @@ class Node(threading.Thread):
 		""" peer_list is dictionary with a key and value pair representing id and hostname respectively for the peer """
 		""" This peer_list will be updated every time the peer requests the server for a peer_list """   
 		self.peer_list = {}
+		self.peers_version = None # version of peer_list on the tracker, see sync_peers
+		self._peers_lock = threading.Lock()
 		
 
 		""" Keep track of all the payloads that have been sent to the server """
 		self.payload_sent = []
-		self.available_payloads = {}
+		self.available_payloads = PayloadCache(loader=self._refetch_payload) # payloadId -> claimed string
+		self.merkle_roots = {} # merkle roots of the payloads querried from the tracker
+		self.payload_etags = {} # ETags of the payloads querried from the tracker
 
 		self.tracker = None
+		self.lease_ttl = None # seconds the registration lasts without a heartbeat, see start_heartbeat
+		self._heartbeat_thread = None
+		self.tracker_client = tracker_client or shared_client()
 		self.stop_thread = 0
 		self._stop_event = threading.Event()
 
+		""" Event loop state, only used when the peer is serving in asyncio mode """
+		self.use_asyncio = use_asyncio
+		self._loop = None
+		self._async_stop = None
+
+		""" Offer length prefixed framing to other peers, set it to False to talk EOM to every peer """
+		self.framing = True
+		""" Send claims as MSG_BINARY_CLAIMS to the peers that support it """
+		self.binary_claims = True
+		""" Answer the peer list digests of other peers, see start_gossip """
+		self.gossip = True
+
+		""" Requests that come in on framed channels are answered on this pool """
+		self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix=f"peer-{self.port}")
+
 		""" 
 			- Each peer will have different modes of severity which will be used for logging their data 
 			and keeping track of its activities/communications. Along with that each peer will get multiple 
@@ -94,11 +143,21 @@ class Node(threading.Thread):
 		"""
 		self.conn = redis.StrictRedis()
 		self.trim = 100 # This will tell how many recent logs to keep. Set it as None to so that all logs will be kept
+		self.counters = f"counters:{self.host}:{self.port}.{self.id}"
+		self.host_counters = f"counters:{self.host}:{self.port}"
+		self.log_shipper = LogShipper(self.conn) # Writes the logs to Redis in the background
+		self.stats = Registry() # latency histograms, see metrics(percentiles=True)
+		self.log_shipper.start()
 		log_message = f"Peer initialized with id: {self.id}, listening at {self.hostname}"
 		self.log_activities(log_message, SEVERITY.PEER_INTIALIZED)
 		
 	
 	def shutdown(self):
+		if self._loop is not None:
+			# The listening socket is owned by the event loop, let the loop close it
+			self._loop.call_soon_threadsafe(self._async_stop.set)
+			if threading.current_thread() is not self:
+				self.join(1)
 		try:
 			""" 
 				- Each socket can be forcefully shutdown before closing it 
@@ -123,17 +182,22 @@ class Node(threading.Thread):
 	def kill(self):
 		self._stop_event.set()
 		self.deregister_peer()
+		for channel in list(self.connected_peers.values()):
+			if isinstance(channel, P2PChannel):
+				channel.close()
 		self.shutdown()
+		self.executor.shutdown(wait=False)
 		log_message = f"Peer has been killed"
 		self.log_activities(log_message, SEVERITY.KILL)
+		self.log_shipper.close()
 
 	@classmethod
 	def _build_and_run(cls, server="127.0.0.1", port=1060,
-			tracker="http://127.0.0.1:8000"):
-		node = cls(server, port)
+			tracker="http://127.0.0.1:8000", use_asyncio=False, heartbeat=True):
+		node = cls(server, port, use_asyncio=use_asyncio)
 		node.daemon = True
 		node.start()
-		node.register_peer(tracker)
+		node.register_peer(tracker, heartbeat=heartbeat)
 		return node
 
 	def log_activities(self, message, severity_level):
@@ -147,9 +211,12 @@ class Node(threading.Thread):
 			- All activities/communications with the trusted server will be saved into a Redis List with key:
 			http:host:port.peer_id:SEVERITY_LEVEL
 
-			- Along with these lists, each peer with have its own counters for every severity level with key:
-			counter:host:port.peer_id:SEVERITY_LEVEL
+			- Along with these lists, each peer with have its own counters for every severity level, as the
+			SEVERITY_LEVEL fields of the hash counters:host:port.peer_id. The counts of every peer id that
+			used the same host and port are added up in the hash counters:host:port.
 
+			- The log is only queued here, self.log_shipper writes it to Redis in the background together
+			with the other logs of its batch.
 		"""
 
 		# Check if that severity_level exists
@@ -162,25 +229,16 @@ class Node(threading.Thread):
 			self.printh(f"The severity level {severity_level} does not exist. The message will not be logged")
 
 		
-		postfix = f"{self.host}:{self.port}.{self.id}:{SEVERITY(severity_level).name}"
-		counter_dest = f"counter:{postfix}"
+		name = SEVERITY(severity_level).name
+		postfix = f"{self.host}:{self.port}.{self.id}:{name}"
 		destination = ""
 		if severity_level <= SEVERITY.CONNECT_TO_NODE.value:
 			destination = f"p2p:{postfix}"
 		else:
 			destination = f"http:{postfix}"
-		pipe = self.conn.pipeline()
-
-		# Log the message
-		timestamp = datetime.strftime(datetime.now(), "%y/%m/%d %H:%M:%S")
-		message = timestamp + message
-		pipe.lpush(destination, message)
-		if self.trim and isinstance(self.trim, int):
-			pipe.ltrim(destination, 0, self.trim)
 
-		# increase counters
-		pipe.incr(counter_dest)
-		pipe.execute()
+		# Log the message and increase the counter
+		self.log_shipper.ship(destination, [(self.counters, name), (self.host_counters, name)], message, self.trim)
 
 	def run(self):
 		"""
@@ -190,49 +248,148 @@ class Node(threading.Thread):
 			- Creates a P2P channel with the target node
 		"""
 
-		while not self._stop_event.wait(0.1):
+		if self.use_asyncio:
+			asyncio.run(self._serve_async())
+			return
+
+		while not self._stop_event.is_set():
 			try:
 				client_sock, client_addr = self.sock.accept()
-				client_node_id = client_sock.recv(4096).decode()
-				client_sock.sendall(self.id.encode())
+				client_node_id, capabilities = decode_capabilities(client_sock.recv(4096))
+				capabilities &= self.capabilities()
+				framed = bool(capabilities)
+				client_sock.sendall(encode_hello(self.id, framed, capabilities - {CAPABILITY_FRAMED}))
 				self.printh(f"IDs exchanged with: {client_addr}")
 
-				p2pchannel = P2PChannel(self, client_sock, client_node_id, *client_addr)
+				p2pchannel = P2PChannel(self, client_sock, client_node_id, *client_addr, framed=framed,
+					capabilities=capabilities)
 				self.connected_peers[client_node_id] = p2pchannel
-				self.live_channel = p2pchannel
-				self.live_channel.start()
-				self.live_channel.join()
+				if framed:
+					p2pchannel.start()
+				else:
+					self.live_channel = p2pchannel
+					self.live_channel.start()
+					self.live_channel.join()
 
 			except socket.timeout:
 				self.printh(f"Connection timeout")
 			except OSError:
 				self.printh(f"The socket has been shutdown")
+				if self.sock.fileno() == -1:
+					break
 
-
-	def connect_to_node(self, host, port):
+	async def _serve_async(self):
+		"""
+			- Accept connections on the event loop of this thread.
+			- Every accepted connection is served by its own AsyncP2PChannel coroutine, so a slow
+			verifier does not hold up the others.
+		"""
+		self._loop = asyncio.get_running_loop()
+		self._async_stop = asyncio.Event()
+		self.sock.setblocking(False)
+		server = await asyncio.start_server(self._accept_async, sock=self.sock,
+			limit=AsyncP2PChannel.read_limit)
+		async with server:
+			await self._async_stop.wait()
+		self.printh(f"The socket has been shutdown")
+
+	async def _accept_async(self, reader, writer):
+		"""
+			- Same ID exchange as run(), followed by serving the channel until the other peer hangs up.
+		"""
+		client_addr = writer.get_extra_info('peername')
+		try:
+			client_node_id, capabilities = decode_capabilities(await reader.read(4096))
+			capabilities &= self.capabilities()
+			framed = bool(capabilities)
+			writer.write(encode_hello(self.id, framed, capabilities - {CAPABILITY_FRAMED}))
+			await writer.drain()
+			self.printh(f"IDs exchanged with: {client_addr}")
+
+			p2pchannel = AsyncP2PChannel(self, reader, writer, client_node_id, *client_addr[:2], framed=framed,
+				capabilities=capabilities)
+			self.connected_peers[client_node_id] = p2pchannel
+			await p2pchannel.serve()
+		except FrameTooLarge as e:
+			self.printh(f"Closing the connection with {client_addr}: {e}")
+		except (ConnectionError, asyncio.IncompleteReadError):
+			self.printh(f"Connection with {client_addr} was lost")
+		except asyncio.CancelledError:
+			# The peer is shutting down, this is the outermost task of the connection
+			pass
+		finally:
+			writer.close()
+
+
+	def capabilities(self):
+		"""
+			- The capabilities offered during the ID exchange, an empty set for an EOM peer
+		"""
+		if not self.framing:
+			return set()
+		capabilities = {CAPABILITY_FRAMED}
+		if self.binary_claims:
+			capabilities.add(CAPABILITY_BINARY_CLAIMS)
+		if self.gossip:
+			capabilities.add(CAPABILITY_GOSSIP)
+		return capabilities
+
+	def connect_to_node(self, host, port, make_live=True, timeout=None):
 		"""
 			- This function is reponsible for establishing a connection with a seperate node.
+			- An open framed channel to the same node is reused, no new connection is made.
+
+			args:
+				make_live - Make the channel the live_channel (the one verify_payload uses by default). Gossip
+				connects with make_live=False, its channels are not counted in verify_payload_many either
+				until they are connected to with make_live=True.
+				timeout - Seconds to wait for the connection and the ID exchange, None waits as long as the OS does
 		"""
 		
+		for channel in list(self.connected_peers.values()):
+			if channel.framed and not channel.closed and (channel.main_host, channel.main_port) == (host, port):
+				if make_live:
+					self.live_channel = channel
+					channel.gossip_only = False
+				return channel
+
 		try:
 			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.settimeout(timeout)
 			sock.connect((host,port))
-			sock.sendall(self.id.encode())
+			capabilities = self.capabilities()
+			sock.sendall(encode_hello(self.id, bool(capabilities), capabilities - {CAPABILITY_FRAMED}))
 
-			target_node_id = sock.recv(4096).decode()
+			target_node_id, capabilities = decode_capabilities(sock.recv(4096))
+			sock.settimeout(None)
+			framed = bool(capabilities)
 			self.printh(f"IDs exchanged with: {(host,port)}")
 
-			p2pchannel = P2PChannel(self, sock, target_node_id, host, port)
+			p2pchannel = P2PChannel(self, sock, target_node_id, host, port, framed=framed, capabilities=capabilities)
+			p2pchannel.gossip_only = not make_live
 			self.connected_peers[target_node_id] = p2pchannel
-			self.live_channel = p2pchannel
-			#self.live_channel.start()
+			if make_live:
+				self.live_channel = p2pchannel
+			if framed:
+				# Framed channels have a reader thread that matches responses to requests
+				p2pchannel.start()
 			log_message = f"Connected to node: {(host, port)} with id: {target_node_id}"
 			self.log_activities(log_message, SEVERITY.CONNECT_TO_NODE.value)
+			return p2pchannel
 
 		except Exception as e:
 			self.printh(e)
 
-	def register_peer(self, api):
+	def tracker_request(self, method, path, api=None, **kwargs):
+		"""
+			- Send a request to the tracker (or to api) over the keep-alive connections of tracker_client and
+			return the response.
+			- The time until the response is recorded in the tracker_request_seconds histogram of the path.
+		"""
+		with self.stats.time('tracker_request_seconds', path=path):
+			return self.tracker_client.request(method, f"{api or self.tracker}{path}", **kwargs)
+
+	def register_peer(self, api, heartbeat=True):
 		"""
 			- This function will register itself with the trusted server or the tracker
 
@@ -240,6 +397,9 @@ class Node(threading.Thread):
 				api: str - this is the address to the api,
 				for example: http://127.0.0.1:8000/,
 							http://11.3.7.5,
+				heartbeat: bool - renew the registration lease from a background thread (start_heartbeat),
+				pass False when the leases are renewed some other way, for example with send_heartbeats for
+				many peers at once
 
 		"""
 		message = {}
@@ -248,12 +408,41 @@ class Node(threading.Thread):
 		message['port'] = self.port
 		if api[-1] == '/':
 			api = api[:-1]
-		r = requests.post(f'{api}/register', json=message)
+		r = self.tracker_request('POST', '/register/', json=message, api=api)
 		if (r.status_code == 200):
 			self.tracker = api
+			self.lease_ttl = r.json().get('ttl')
 			self.printh(r.text)
 			log_message = f"Registered to tracker(trusted server): {self.tracker}"
 			self.log_activities(log_message, SEVERITY.REGISTER_PEER.value)
+			if heartbeat:
+				self.start_heartbeat()
+
+	def heartbeat(self):
+		"""
+			- Renew the registration lease of this peer, see send_heartbeats
+		"""
+		return send_heartbeats([self])
+
+	def start_heartbeat(self, interval=None):
+		"""
+			- Renew the lease every interval seconds (a third of the lease by default) from a background
+			thread, until the peer is killed or deregistered. Returns the thread, the one already running if
+			there is one.
+		"""
+		if self._heartbeat_thread is not None and self._heartbeat_thread.is_alive():
+			return self._heartbeat_thread
+
+		def beat():
+			while not self._stop_event.wait(interval or (self.lease_ttl or 60) / 3) and self.tracker is not None:
+				try:
+					self.heartbeat()
+				except Exception as e:
+					self.printh(f"Heartbeat failed: {e}")
+
+		self._heartbeat_thread = threading.Thread(target=beat, daemon=True, name=f"heartbeat-{self.port}")
+		self._heartbeat_thread.start()
+		return self._heartbeat_thread
 
 	def deregister_peer(self):
 		"""
@@ -262,9 +451,10 @@ class Node(threading.Thread):
 		"""
 		if self.tracker is None:
 			self.printh(f"The peer is not registered with any tracker")
+			return
 
 		message = {"peer_id": self.id, 'hostaddr': self.host, 'port': str(self.port)}
-		r = requests.delete(f"{self.tracker}/deregister", json=message)
+		r = self.tracker_request('DELETE', '/deregister', json=message)
 		if r.status_code == 200:
 			self.printh(r.text)
 			log_message = f"De-Registered with tracker(trusted server): {self.tracker}"
@@ -274,7 +464,7 @@ class Node(threading.Thread):
 
 	def upload_payload(self, payload_string: str, desc:str =None):
 		"""
-			- This function is responsible for uploading the payload to the server
+			- This function is responsible for uploading the payload to the server, returns its payloadId
 		"""
 		if self.tracker is None:
 			raise Exception(f"No tracker is registered yet")
@@ -283,18 +473,106 @@ class Node(threading.Thread):
 		if desc is not None:
 			message['desc'] = desc
 
-		r = requests.post(f'{self.tracker}/upload_payload', json=message)
+		r = self.tracker_request('POST', '/upload_payload/', json=message)
 		if r.status_code != 200:
 			raise Exception(f"There was an error while sending the payload string")
-		else:
-			self.printh(f"Successfully upload payload")
-			self.printh(f"PayloadId: {r.json()['payloadId']}")
-			log_message = f"Uploaded payload: {r.json()['payloadId']} to server: {self.tracker}"
-			self.log_activities(log_message, SEVERITY.UPLOAD_PAYLOAD)
+		payloadId = r.json()['payloadId']
+		self.printh(f"Successfully upload payload")
+		self.printh(f"PayloadId: {payloadId}")
+		log_message = f"Uploaded payload: {payloadId} to server: {self.tracker}"
+		self.log_activities(log_message, SEVERITY.UPLOAD_PAYLOAD)
+
+		if payloadId not in self.payload_sent:
+			self.payload_sent.append(payloadId)
+			self.available_payloads[payloadId] = payload_string
+		return payloadId
+
+	def upload_payload_stream(self, source, keep=True, piece_size=64 * 1024):
+		"""
+			- Upload a payload without building the whole request in memory, the payload is sent with
+			chunked transfer encoding to /upload_payload_stream.
+			- source is a string, an iterable of str/bytes pieces (e.g. a generator) or a file object
+			opened in text or binary mode, which is read piece_size at a time.
+			- With keep=False the payload is not kept in available_payloads, so it is never held in memory
+			as a whole. It can still be fetched back with querry_payload.
+		"""
+		if self.tracker is None:
+			raise Exception(f"No tracker is registered yet")
+
+		if isinstance(source, (str, bytes)):
+			source = [source]
+		elif hasattr(source, 'read'):
+			read = source.read
+			source = iter(lambda: read(piece_size), read(0))
+		kept = []
+
+		def body():
+			for piece in source:
+				if keep:
+					kept.append(piece)
+				yield piece.encode() if isinstance(piece, str) else piece
+
+		r = self.tracker_request('POST', '/upload_payload_stream/', data=body(),
+			headers={'Content-Type': 'text/plain; charset=utf-8'})
+		if r.status_code != 200:
+			raise Exception(f"There was an error while sending the payload string")
+
+		payloadId = r.json()['payloadId']
+		self.printh(f"Successfully upload payload")
+		self.printh(f"PayloadId: {payloadId}")
+		log_message = f"Uploaded payload: {payloadId} to server: {self.tracker}"
+		self.log_activities(log_message, SEVERITY.UPLOAD_PAYLOAD)
 
-		if r.json()['payloadId'] not in self.payload_sent:
-			self.payload_sent.append(r.json()['payloadId'])
-			self.available_payloads[r.json()['payloadId']] = payload_string
+		if payloadId not in self.payload_sent:
+			self.payload_sent.append(payloadId)
+			if keep:
+				pieces = [p.encode() if isinstance(p, str) else p for p in kept]
+				self.available_payloads[payloadId] = b''.join(pieces).decode()
+		return payloadId
+
+	def upload_payloads(self, payload_strings: list):
+		"""
+			- Upload many payloads to the server in a single request, returns their payloadIds in order
+		"""
+		if self.tracker is None:
+			raise Exception(f"No tracker is registered yet")
+
+		message = {'payloads': [{'payload': payload} for payload in payload_strings]}
+		r = self.tracker_request('POST', '/upload_payloads/', json=message)
+		if r.status_code != 200:
+			raise Exception(f"There was an error while sending the payload strings")
+
+		payloadIds = r.json()['payloadIds']
+		self.printh(f"Successfully uploaded {len(payloadIds)} payloads")
+		log_message = f"Uploaded {len(payloadIds)} payloads to server: {self.tracker}"
+		self.log_activities(log_message, SEVERITY.UPLOAD_PAYLOAD)
+
+		for payloadId, payload_string in zip(payloadIds, payload_strings):
+			if payloadId not in self.payload_sent:
+				self.payload_sent.append(payloadId)
+				self.available_payloads[payloadId] = payload_string
+		return payloadIds
+
+	def delete_payload(self, payloadId):
+		"""
+			- Delete a payload from the tracker, returns the number of bytes it freed in the block store or
+			None if the tracker does not have the payload. The local copy is kept.
+		"""
+		if self.tracker is None:
+			raise Exception(f"No tracker is registered yet")
+
+		r = self.tracker_request('DELETE', '/delete_payload/', json={'id': payloadId})
+		if r.status_code != 200:
+			raise Exception(f"There was an error while deleting the payload")
+		data = r.json()
+		if data.get('valid_payload') is False:
+			return None
+		log_message = f"Deleted payload: {payloadId} from server: {self.tracker}"
+		self.log_activities(log_message, SEVERITY.DELETE_PAYLOAD)
+		if payloadId in self.payload_sent:
+			self.payload_sent.remove(payloadId)
+		self.payload_etags.pop(payloadId, None)
+		return data['freedBytes']
 
 	def get_peers(self):
 		"""
@@ -302,21 +580,186 @@ class Node(threading.Thread):
 		"""
 		if self.tracker is None:
 			raise Exception(f"No tracker is registered yet")
-		r = requests.get(f"{self.tracker}/get_peers")
+		r = self.tracker_request('GET', '/get_peers/')
 		log_message = f"Got the list of peers from server: {self.tracker}"
 		self.log_activities(log_message, SEVERITY.GET_PEERS)
-		return r.json()
+		peers = r.json()
+		with self._peers_lock:
+			self.peer_list = dict(peers)
+			if 'X-Peers-Version' in r.headers:
+				self.peers_version = int(r.headers['X-Peers-Version'])
+		return peers
+
+	def sync_peers(self, wait=0):
+		"""
+			- Bring peer_list up to date with only the changes since the last sync, the whole list is
+			fetched the first time (or when the tracker no longer has all the changes).
+			- With wait > 0 the tracker holds the request until something changes or wait seconds pass.
+			- Returns peer_list
+		"""
+		if self.tracker is None:
+			raise Exception(f"No tracker is registered yet")
+		if self.peers_version is None:
+			self.get_peers()
+			return self.peer_list
+
+		since = self.peers_version
+		r = self.tracker_request('GET', '/get_peers/', params={'since': since, 'wait': wait})
+		if r.status_code != 200:
+			raise Exception("There was an error at the server. The request was unsuccessfull")
+		delta = r.json()
+		with self._peers_lock:
+			if delta['full']:
+				self.peer_list = delta['added']
+				self.peers_version = delta['version']
+			elif self.peers_version == since:
+				# Otherwise gossip replaced peer_list in the meantime and the delta no longer applies to it
+				peer_list = dict(self.peer_list)
+				peer_list.update(delta['added'])
+				for peer_id in delta['removed']:
+					peer_list.pop(peer_id, None)
+				self.peer_list = peer_list
+				self.peers_version = delta['version']
+		if delta['version'] != since:
+			log_message = f"Peer list changed to version {delta['version']} on server: {self.tracker}"
+			self.log_activities(log_message, SEVERITY.GET_PEERS)
+		return self.peer_list
+
+	def watch_peers(self, wait=25):
+		"""
+			- Keep peer_list up to date from a background thread that long-polls the tracker with sync_peers,
+			until the peer is killed. Returns the thread.
+		"""
+		def watch():
+			while not self._stop_event.is_set() and self.tracker is not None:
+				try:
+					self.sync_peers(wait)
+				except Exception as e:
+					self.printh(f"Could not sync the peer list: {e}")
+					self._stop_event.wait(1)
+
+		thread = threading.Thread(target=watch, daemon=True, name=f"peers-{self.port}")
+		thread.start()
+		return thread
+
+	def _peer_view(self):
+		"""
+			- (peers_version, peer_list, digest) read together, the digest is a short hash of the peer ids
+		"""
+		with self._peers_lock:
+			version, peers = self.peers_version, self.peer_list
+		digest = hashlib.blake2b(','.join(sorted(peers)).encode(), digest_size=8).hexdigest()
+		return version, peers, digest
+
+	def _adopt_peers(self, version, peers):
+		"""
+			- Take the peer list of another peer if it is from a later version of the tracker's list
+		"""
+		with self._peers_lock:
+			if version is None or (self.peers_version is not None and version <= self.peers_version):
+				return False
+			self.peer_list = peers
+			self.peers_version = version
+		log_message = f"Peer list changed to version {version} by gossip"
+		self.log_activities(log_message, SEVERITY.GOSSIP_PEERS)
+		return True
+
+	def gossip_round(self, fanout=2, timeout=5):
+		"""
+			- Exchange peer list digests with fanout random peers of peer_list. Versions come from the
+			tracker, so the later version always wins: a peer with a later list sends it back and a peer
+			with an earlier one is sent ours. Nothing but the digests is sent when both are up to date.
+			- Two lists of the same version that differ are settled by asking the tracker again.
+			- Returns the number of peers that answered
+		"""
+		version, peers, digest = self._peer_view()
+		candidates = [peer for peer_id, peer in peers.items() if peer_id != self.id]
+		answered = 0
+		for peer in random.sample(candidates, min(fanout, len(candidates))):
+			channel = self.connect_to_node(peer['hostaddr'], int(peer['port']), make_live=False, timeout=timeout)
+			if channel is None or CAPABILITY_GOSSIP not in channel.capabilities:
+				continue
+			version, peers, digest = self._peer_view()
+			try:
+				reply = channel.request(json.dumps({'version': version, 'digest': digest}), MSG_GOSSIP).result(timeout)
+				answered += 1
+				if reply.get('peers') is not None:
+					self._adopt_peers(reply['version'], reply['peers'])
+				elif version is not None and (reply['version'] is None or reply['version'] < version):
+					message = {'version': version, 'digest': digest, 'peers': peers}
+					channel.request(json.dumps(message), MSG_GOSSIP).result(timeout)
+				elif reply['version'] == version and reply['digest'] != digest:
+					self.get_peers()
+			except Exception as e:
+				self.printh(f"Gossip with {channel.target_id} failed: {e}")
+		return answered
+
+	def parse_gossip(self, data, channel=None):
+		"""
+			- Answer the digest of another peer: our whole list if it is later, otherwise our digest.
+			A message that carries a later list than ours replaces peer_list.
+		"""
+		message = json.loads(data)
+		if message.get('peers') is not None:
+			self._adopt_peers(message['version'], message['peers'])
+		version, peers, digest = self._peer_view()
+		reply = {'version': version, 'digest': digest}
+		if version is not None and (message['version'] is None or version > message['version']):
+			reply['peers'] = peers
+		return json.dumps(reply)
+
+	def start_gossip(self, interval=1.0, fanout=2, tracker_interval=30):
+		"""
+			- Keep peer_list up to date by gossiping with other peers instead of polling the tracker.
+			- The tracker is only asked for the whole list once to start with, and for the changes every
+			tracker_interval seconds (None to never ask again), it stays the source of truth. Every interval
+			seconds a gossip_round is run with fanout peers, until the peer is killed. Returns the thread.
+		"""
+		if self.peers_version is None:
+			self.get_peers()
+
+		def gossip():
+			last_sync = time.monotonic()
+			while not self._stop_event.wait(interval) and self.tracker is not None:
+				try:
+					if tracker_interval is not None and time.monotonic() - last_sync >= tracker_interval:
+						self.sync_peers()
+						last_sync = time.monotonic()
+					self.gossip_round(fanout)
+				except Exception as e:
+					self.printh(f"Gossip round failed: {e}")
+
+		thread = threading.Thread(target=gossip, daemon=True, name=f"gossip-{self.port}")
+		thread.start()
+		return thread
 
 	def querry_payload(self, payloadId):
 		"""
 			- Create a post request with payloadId as data and get back the hashed chunks along with
 			full chunks
+
+			- Payloads never change, so a payload that is already held and was queried before is only
+			revalidated: the ETag from the last query is sent as If-None-Match and the tracker answers
+			with an empty 304. The returned data then comes from what is held locally and has no chunks.
 		"""
 		if self.tracker is None:
 			raise Exception(f"No tracker is registered yet")
 		
 		message = {'id': payloadId}
-		r = requests.post(f"{self.tracker}/get_payload", json=message)
+		headers = {}
+		if self.available_payloads.is_cached(payloadId) and payloadId in self.payload_etags:
+			headers['If-None-Match'] = self.payload_etags[payloadId]
+		r = self.tracker_request('POST', '/get_payload/', json=message, headers=headers)
+		if r.status_code == 304:
+			self.printh(f"{payloadId} is up to date")
+			log_message = f"{payloadId} not modified on server {self.tracker}"
+			self.log_activities(log_message, SEVERITY.QUERRY_PAYLOAD)
+			return {
+				'claimedString': self.available_payloads[payloadId],
+				'rootHash': self.payload_etags[payloadId].strip('"'),
+				'merkleRoot': self.merkle_roots[payloadId],
+				'notModified': True,
+			}
 		if r.status_code != 200:
 			raise Exception("There was an error at the server. The request was unsuccessfull")
 		else:
@@ -325,9 +768,60 @@ class Node(threading.Thread):
 			self.log_activities(log_message, SEVERITY.QUERRY_PAYLOAD)
 		response_data = r.json()
 		self.available_payloads[payloadId] = response_data['claimedString']
+		self.merkle_roots[payloadId] = response_data['merkleRoot']
+		if 'ETag' in r.headers:
+			self.payload_etags[payloadId] = r.headers['ETag']
 		return response_data
 
-	def verify_payload(self, payloadId, positions:list = None):
+	def _refetch_payload(self, payloadId):
+		"""
+			- Loader of available_payloads, gets a payload that was evicted from the cache again
+		"""
+		return self.querry_payload(payloadId)['claimedString']
+
+	def querry_payload_range(self, payloadId, start=None, end=None, offset=None, length=None):
+		"""
+			- Get part of a payload from the server without keeping it in available_payloads.
+			- start/end is a range of chunk indexes (end excluded), the response has those chunk hashes and
+			the part of claimedString they cover. offset/length is a range of bytes of claimedString.
+		"""
+		if self.tracker is None:
+			raise Exception(f"No tracker is registered yet")
+
+		message = {'id': payloadId, 'start': start, 'end': end, 'offset': offset, 'length': length}
+		r = self.tracker_request('POST', '/get_payload/', json=message)
+		if r.status_code != 200:
+			raise Exception("There was an error at the server. The request was unsuccessfull")
+		log_message = f"Got a range of {payloadId} from server {self.tracker}"
+		self.log_activities(log_message, SEVERITY.QUERRY_PAYLOAD)
+		return r.json()
+
+	def verify_chunk(self, payloadId, index, chunk):
+		"""
+			- Verify a single chunk of a payload against its merkle root, using an inclusion proof from
+			the tracker instead of downloading the whole payload.
+
+			- The root from an earlier querry_payload is used if there is one, otherwise the root sent along
+			with the proof.
+		"""
+		if self.tracker is None:
+			raise Exception(f"No tracker is registered yet")
+
+		r = self.tracker_request('POST', '/get_proof/', json={'id': payloadId, 'index': index})
+		if r.status_code != 200:
+			raise Exception("There was an error at the server. The request was unsuccessfull")
+		data = r.json()
+		log_message = f"Got the proof of chunk {index} of {payloadId} from server {self.tracker}"
+		self.log_activities(log_message, SEVERITY.QUERRY_PROOF)
+		if 'proof' not in data:
+			return False
+
+		root = self.merkle_roots.get(payloadId, data['merkleRoot'])
+		leaf = hashlib.sha224(chunk.encode()).digest()
+		proof = [bytes.fromhex(p) for p in data['proof']]
+		return verify_proof(leaf, index, data['chunkCount'], proof, bytes.fromhex(root))
+
+	def verify_payload(self, payloadId, positions:list = None, peer_id=None, timeout=None):
 		"""
 			- This function initiate the communication between the nodes for the payload verification.
 
@@ -336,14 +830,110 @@ class Node(threading.Thread):
 
 			- example: positions = [1,0,3] will say that chunk 0 is at position 1, chunk 1 is at position 0 
 			and chunk 2 is at position 3
+
+			- peer_id picks the connected peer to verify with, by default the live channel is used.
+		"""
+		return self.request_verification(payloadId, positions, peer_id).result(timeout)
+
+	def verify_payload_many(self, payloadId, positions:list = None, peer_ids=None, quorum=None, timeout=5):
+		"""
+			- Send the same claims to many connected peers at once and decide every chunk by quorum.
+
+			- peer_ids are the peers to ask, every open channel by default. quorum is the number of peers
+			that have to agree on a chunk, a majority of them by default.
+			- A chunk is valid once quorum peers said so and invalid once that can no longer happen. The
+			call returns as soon as every chunk is decided or after timeout seconds, so it takes as long as
+			the slowest peer that is needed, the other responses are not waited for.
+
+			- Returns {'results', 'valid', 'peers'}: results[i] is True/False for a decided chunk and None
+			if not enough peers answered in time, valid is True if every chunk is valid and peers maps
+			every peer to 'checked', 'unavailable' (it does not hold the payload), 'error' or 'pending'.
+		"""
+		if peer_ids is None:
+			peer_ids = [peer_id for peer_id, channel in list(self.connected_peers.items())
+				if not channel.closed and not channel.gossip_only]
+		if quorum is None:
+			quorum = len(peer_ids) // 2 + 1
+		chunks = self.available_payloads.chunks(payloadId)
+		if chunks is None:
+			raise Exception(f"Invalid Payload")
+		count = len(chunks) if positions is None else len(positions)
+
+		futures = {}
+		for peer_id in peer_ids:
+			channel = self.connected_peers.get(peer_id)
+			if channel is None:
+				continue
+			if channel.framed:
+				futures[self.request_verification(payloadId, positions, peer_id)] = peer_id
+			else:
+				# An EOM channel answers before request returns, wait for it on the executor instead
+				futures[self.executor.submit(self.verify_payload, payloadId, positions, peer_id)] = peer_id
+		status = {peer_id: 'pending' for peer_id in futures.values()}
+
+		unanimous = 0 # peers that said every claim is correct
+		votes = [0] * count # other votes for every claim
+		decided = [None] * count
+		pending = set(futures)
+		deadline = time.monotonic() + timeout
+		while pending:
+			done, pending = wait_futures(pending, max(0, deadline - time.monotonic()), FIRST_COMPLETED)
+			if not done:
+				break
+			for future in done:
+				peer_id = futures[future]
+				try:
+					response = future.result()
+				except Exception:
+					status[peer_id] = 'error'
+					continue
+				if not response.get('chunk_available'):
+					status[peer_id] = 'unavailable'
+					continue
+				status[peer_id] = 'checked'
+				results = response['results']
+				if results.all() if hasattr(results, 'all') else all(results):
+					unanimous += 1
+				else:
+					for i, result in enumerate(results):
+						votes[i] += result
+
+			undecided = 0
+			for i in range(count):
+				if decided[i] is None:
+					if unanimous + votes[i] >= quorum:
+						decided[i] = True
+					elif unanimous + votes[i] + len(pending) < quorum:
+						decided[i] = False
+					else:
+						undecided += 1
+			if not undecided:
+				break
+
+		return {'results': decided, 'valid': all(decided), 'peers': status}
+
+	def request_verification(self, payloadId, positions:list = None, peer_id=None):
+		"""
+			- Same as verify_payload, but returns a Future of the response instead of waiting for it.
+			- On a framed channel many verifications can be in flight at the same time.
+			- The claims are sent as MSG_BINARY_CLAIMS if the other peer agreed on it during the ID exchange,
+			the results are then a ClaimResults instead of a list.
 		"""
 	
-		if payloadId not in self.available_payloads.keys():
+		chunks = self.available_payloads.chunks(payloadId)
+		if chunks is None:
 			raise Exception(f"Invalid Payload")
-		chunks = []
-		for i in range(0, len(self.available_payloads[payloadId]), 4):
-			chunks.append(self.available_payloads[payloadId][i:i+4])
-		
+
+		channel = self.live_channel if peer_id is None else self.connected_peers[peer_id]
+		if positions is not None and len(positions) > len(chunks):
+			raise Exception(f"The lenght of list positions is larger than that of the chunks")
+		log_message = f"Sending data to {channel.peername} ({channel.target_id}) to verify data"
+		if CAPABILITY_BINARY_CLAIMS in channel.capabilities:
+			if positions is None:
+				positions = range(len(chunks))
+			self.log_activities(log_message, SEVERITY.VERIFY_CLAIM)
+			return self._timed_request(channel, encode_claims(payloadId, positions, chunks), MSG_BINARY_CLAIMS)
+
 		message = {}
 		message['claims'] = []
 		message['payloadId'] = f"{payloadId}"
@@ -351,33 +941,93 @@ class Node(threading.Thread):
 			for i, chunk in enumerate(chunks):
 				message['claims'].append({'chunk':chunk, 'position': i})
 		else:
-			if len(positions) <= len(chunks):
-				for i, p in enumerate(positions):
-					message['claims'].append({'chunk':chunks[i], 'position': p})
-			else:
-				raise Exception(f"The lenght of list positions is larger than that of the chunks")
+			for i, p in enumerate(positions):
+				message['claims'].append({'chunk':chunks[i], 'position': p})
 
-		log_message = f"Sending data to {self.live_channel.target_sock.getpeername()} ({self.live_channel.target_id}) to verify data"	
 		self.log_activities(log_message, SEVERITY.VERIFY_CLAIM)
-		data = self.live_channel.send_data(json.dumps(message))
-		return data
+		return self._timed_request(channel, json.dumps(message), MSG_CLAIMS)
+
+	def _timed_request(self, channel, message, msg_type):
+		"""
+			- channel.request, the round trip time is recorded in the verify_seconds histogram
+		"""
+		start = time.perf_counter()
+		future = channel.request(message, msg_type)
+		kind = 'binary' if msg_type == MSG_BINARY_CLAIMS else 'json'
+		future.add_done_callback(lambda f: self.stats.observe('verify_seconds', time.perf_counter() - start, claims=kind))
+		return future
+
+	def handle_request(self, msg_type, data, channel):
+		"""
+			- Answer a request that came in on one of the channels, returns the body of the response
+		"""
+		if msg_type == MSG_CLAIMS:
+			with self.stats.time('handle_request_seconds', claims='json'):
+				return self.parse_claims(str(data, 'utf-8'), channel).encode()
+		if msg_type == MSG_BINARY_CLAIMS:
+			with self.stats.time('handle_request_seconds', claims='binary'):
+				return self.parse_binary_claims(data, channel)
+		if msg_type == MSG_GOSSIP:
+			return self.parse_gossip(str(data, 'utf-8'), channel).encode()
+		raise ValueError(f"Unknown message type: {msg_type}")
+
+	def error_response(self, msg_type, error):
+		"""
+			- The response to a request that handle_request failed on, decode_response raises a ValueError
+			for it on the other side
+		"""
+		if msg_type == MSG_BINARY_CLAIMS:
+			return encode_results(STATUS_CORRUPTED)
+		return json.dumps({'error': f"{type(error).__name__}: {error}"}).encode()
 
-	def parse_claims(self, data):
+	def decode_response(self, msg_type, data):
+		"""
+			- Decode the response to a request of the given message type
+		"""
+		if msg_type == MSG_BINARY_CLAIMS:
+			return decode_results(data)
+		response = json.loads(data)
+		if isinstance(response, dict) and 'error' in response:
+			raise ValueError(f"The peer could not answer the request: {response['error']}")
+		return response
+
+	def parse_binary_claims(self, data, channel=None):
+		"""
+			- parse_claims for MSG_BINARY_CLAIMS, the results are sent back as a bitmap
+		"""
+		if channel is None:
+			channel = self.live_channel
+		try:
+			payloadId, positions, ends, buffer = decode_claims(data)
+		except ValueError:
+			return encode_results(STATUS_CORRUPTED)
+		chunks = self.available_payloads.chunks(payloadId)
+		if chunks is None:
+			return encode_results(STATUS_UNAVAILABLE)
+
+		bitmap = check_claims(chunks, positions, ends, buffer)
+		log_message = f"Parsing data recieved from {channel.peername} ({channel.target_id})"
+		self.log_activities(log_message, SEVERITY.PARSE_CLAIM)
+		return encode_results(STATUS_CHECKED, len(positions), bitmap)
+
+	def parse_claims(self, data, channel=None):
 		"""
 			- Get the payloadId and then retrieve that payload from the server
 			- get the chunked claimedString and then verify the data.
 			- return back the 
 
+			- channel is the channel the claims came in on, it defaults to the live channel.
 		"""
+		if channel is None:
+			channel = self.live_channel
 		data = json.loads(data)
 		if 'payloadId' not in data.keys():
 			return 'Corrupted Data recieved: ' + json.dumps(data)
 		payloadId = data['payloadId']
-		if payloadId not in self.available_payloads.keys():
+		chunks = self.available_payloads.chunks(payloadId)
+		if chunks is None:
 			return json.dumps({'chunk_available':False})
 
-		claimedString = self.available_payloads[payloadId]
-		chunks = [claimedString[i:i+4] for i in range(0, len(claimedString), 4)]
 		#print(self.available_payloads[payloadId])
 		#print(data)
 
@@ -387,16 +1037,26 @@ class Node(threading.Thread):
 		for claim in data['claims']:
 			message['results'].append(chunks[claim['position']] == claim['chunk'])
 
-		log_message = f"Parsing data recieved from {self.live_channel.target_sock.getpeername()} ({self.live_channel.target_id})"	
+		log_message = f"Parsing data recieved from {channel.peername} ({channel.target_id})"	
 		self.log_activities(log_message, SEVERITY.PARSE_CLAIM)
 		return json.dumps(message)
 
-	def metrics(self, metric_type=None, ignore_id=False):
+	def metrics(self, metric_type=None, ignore_id=False, percentiles=False):
 		"""
 			- Get the metrics of the peer
 			- metric_type will correspond to the SEVERITY of each log
 			- you can either get metrics of peer of current id or get all the metrics of peer by the current hostname of all id's
+
+			- The counters of a peer are the fields of one hash, self.counters, and every count is also added
+			to the rollup of all the ids at the same host and port, self.host_counters. Either is read with a
+			single HMGET whatever else is in Redis.
+
+			- With percentiles=True the latency histograms of this peer are added under LATENCY, as
+			{histogram: {labels: {count, mean, p50, p90, p99}}} with the times in seconds: verify_seconds
+			(verification round trips), handle_request_seconds (answering claims from other peers) and
+			tracker_request_seconds (HTTP calls to the tracker, per path).
 		"""
+		self.log_shipper.flush()
 
 		data = {}
 		if metric_type is None:
@@ -405,42 +1065,64 @@ class Node(threading.Thread):
 			if not isinstance(metric_type, list):
 				metric_type = [metric_type]
 
+		names = []
 		for severity in metric_type:
-			name = ""
 			if isinstance(severity, SEVERITY):
-				name = severity.name
+				names.append(severity.name)
 
 			elif isinstance(severity, int):
-				name = SEVERITY(severity).name
+				names.append(SEVERITY(severity).name)
 
 			else:
 				raise ValueError("Invalid metric_type, it can either be int, list or instance of SEVERITY")
 
-			data[name] = []
-			prefix = f"counter:{self.host}:{self.port}"
-			if ignore_id:
-				prefix = f"{prefix}.*:{name}"
-			else:
-				prefix = f"{prefix}.{self.id}:{name}"
-
-			keys = self.conn.keys(prefix)
-			for k in keys:
-				data[name].append(int(self.conn.get(k).decode()))
-
-			for k in data.keys():
-				try:
-						data[k] = sum(data[k])
-				except:
-					pass
+		counters = self.host_counters if ignore_id else self.counters
+		for name, value in zip(names, self.conn.hmget(counters, names)):
+			data[name] = int(value) if value is not None else 0
 
+		if metric_type == list(SEVERITY):
+			data['PAYLOAD_CACHE'] = self.available_payloads.stats()
+		if percentiles:
+			data['LATENCY'] = self.stats.summary()
 		return data
 		
+def send_heartbeats(nodes):
+	"""
+		- Renew the leases of many peers with one /heartbeat/ request per tracker. A peer whose lease
+		already expired registers again.
+		- Returns the number of leases renewed
+	"""
+	by_tracker = {}
+	for node in nodes:
+		if node.tracker is not None:
+			by_tracker.setdefault(node.tracker, []).append(node)
+	renewed = 0
+	for tracker, peers in by_tracker.items():
+		r = peers[0].tracker_request('POST', '/heartbeat/', json={'peer_ids': [p.id for p in peers]})
+		if r.status_code != 200:
+			raise Exception("There was an error at the server. The request was unsuccessfull")
+		data = r.json()
+		renewed += data['renewed']
+		unknown = set(data['unknown'])
+		for node in peers:
+			if node.id in unknown:
+				node.printh(f"The lease expired, registering again with {tracker}")
+				node.register_peer(tracker, heartbeat=False) # its own heartbeat thread, if any, keeps running
+	return renewed
+
+
 class P2PChannel(threading.Thread):
 	"""
 		- This class represents a channel through which both the peers will exchanged data with each other.
+
+		- A framed channel is long lived: either side can send requests over it at any time, every request
+		carries an id and the responses are matched to their requests by that id. Many requests can be
+		in flight at once and the other peer may answer them in any order.
+
+		- A channel with an EOM peer answers a single message, the same way the old peers do.
 	"""
 
-	def __init__(self, main_node, target_sock, target_id, main_host, main_port):
+	def __init__(self, main_node, target_sock, target_id, main_host, main_port, framed=False, capabilities=()):
 		"""
 			args:
 				main_node - The node that is being connected
@@ -448,9 +1130,12 @@ class P2PChannel(threading.Thread):
 				target_id - The id of the target node
 				main_host - hostname of the main node
 				main_port - the port of the main node
+				framed - Both peers agreed on length prefixed frames during the ID exchange
+				capabilities - The capabilities both peers agreed on during the ID exchange
 		"""
 		
 		super(P2PChannel, self).__init__()
+		self.daemon = True
 
 		self.main_node = main_node
 		self.target_sock = target_sock
@@ -458,9 +1143,19 @@ class P2PChannel(threading.Thread):
 		self.main_host = main_host
 		self.main_port = main_port
 
-		self.printh(f"Started P2P channel with node: {self.target_sock.getpeername()}")
+		self.framed = framed
+		self.capabilities = set(capabilities)
+		self.reader = FrameReader(self.target_sock)
+		self.closed = False
+		self.gossip_only = False # opened by gossip_round, see Node.connect_to_node
+
+		""" Requests sent on this channel that are still waiting for a response, keyed by request id """
+		self.pending = {}
+		self._request_ids = itertools.count(1)
+		self._send_lock = threading.Lock()
 
-		self.end_byte = b"EOM\x01"
+		self.peername = self.target_sock.getpeername()
+		self.printh(f"Started P2P channel with node: {self.peername}")
 
 	def printh(self,message):
 		print(f"({self.main_node.hostname})P2P: {message}")
@@ -469,38 +1164,220 @@ class P2PChannel(threading.Thread):
 	def run(self):
 		"""
 			- This is thread loop where the node keeps waiting for the data to come.
-			- The message should have a stop byte, which is same for all the nodes.
+			- The message is either framed or ends with the stop byte, which is same for all the nodes.
+			The response is sent back in the same format.
+			- Requests are answered on the executor of the node, so a slow request does not hold up the
+			ones behind it. Responses are handed to whoever is waiting on them.
 			- At the moment, this channel is not encrypted. 
 		"""
-		data = b""
-		message = b""
-		
-		while not data:
-			chunk = self.target_sock.recv(10000)
-			message += chunk
-			if self.end_byte in message:
-				data += message.rstrip(self.end_byte)
-		
-		data = data.decode()
-		message = self.main_node.parse_claims(data)		
-		self.target_sock.sendall(message.encode() + self.end_byte)
+		try:
+			while True:
+				data, info = self.reader.read_message()
+				if info.flags & FLAG_RESPONSE:
+					self._resolve(info.request_id, bytes(data), info.msg_type)
+				elif not info.framed:
+					self._answer(info, bytes(data))
+					return
+				else:
+					self.main_node.executor.submit(self._answer, info, bytes(data))
+		except FrameTooLarge as e:
+			self.printh(f"Closing the channel with {self.target_id}: {e}")
+		except (ChannelClosed, OSError):
+			self.printh(f"Channel closed by {self.target_id}")
+		finally:
+			self.close()
+
+	def _answer(self, info, data):
+		try:
+			response = self.main_node.handle_request(info.msg_type, data, self)
+		except Exception as e:
+			# Without a response the requester would wait for one forever
+			self.printh(f"Request {info.request_id} from {self.target_id} failed: {e!r}")
+			response = self.main_node.error_response(info.msg_type, e)
+		try:
+			self._send(response, info.framed, info.request_id, FLAG_RESPONSE, info.msg_type)
+		except OSError:
+			self.printh(f"Could not answer request {info.request_id} from {self.target_id}")
+
+	def _send(self, body, framed, request_id=0, flags=0, msg_type=MSG_CLAIMS):
+		with self._send_lock:
+			send_message(self.target_sock, body, framed, request_id, flags, msg_type)
+
+	def _resolve(self, request_id, data, msg_type=MSG_CLAIMS):
+		future = self.pending.pop(request_id, None)
+		if future is None:
+			self.printh(f"Dropping response to unknown request {request_id}")
+			return
+		try:
+			future.set_result(self.main_node.decode_response(msg_type, data))
+		except ValueError as e:
+			future.set_exception(e)
+
+	def request(self, message, msg_type=MSG_CLAIMS):
+		"""
+			- Send a request and return a concurrent.futures.Future of the decoded response.
+			- message is a str or, for the binary message types, bytes.
+			- On a framed channel this does not wait for the response, so requests can be pipelined.
+			- An EOM peer can only answer one message at a time, so the request is sent and answered
+			before returning.
+		"""
+		future = Future()
+		body = message.encode() if isinstance(message, str) else message
+		if not self.framed:
+			with self._send_lock:
+				send_message(self.target_sock, body, False)
+				response, _ = self.reader.read_message()
+			try:
+				future.set_result(self.main_node.decode_response(MSG_CLAIMS, bytes(response)))
+			except ValueError as e:
+				future.set_exception(e)
+			return future
+
+		if self.closed:
+			raise ChannelClosed(f"The channel with {self.target_id} is closed")
+		request_id = next(self._request_ids)
+		self.pending[request_id] = future
+		try:
+			self._send(body, True, request_id, 0, msg_type)
+		except OSError:
+			self.pending.pop(request_id, None)
+			raise
+		return future
 		
-	def send_data(self,message):
-
-		message_ = message.encode() + self.end_byte
-		self.target_sock.sendall(message_)
-		self.printh(f"Message sent to {self.target_id}")
-		response = b""
-		data = b""
-		while not response:
-			chunk = self.target_sock.recv(4096)
-			data += chunk
-			if self.end_byte in data:
-				response += data.rstrip(self.end_byte)
-
-		response = response.decode()
-		#self.target_sock.close()
-		data = json.loads(response)
+	def send_data(self, message, timeout=None):
+		data = self.request(message).result(timeout)
+		self.printh(f"Response recieved from {self.target_id}")
 		return data
 
+	def close(self):
+		"""
+			- Close the socket and fail every request that is still waiting for a response
+		"""
+		if self.closed:
+			return
+		self.closed = True
+		try:
+			self.target_sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.target_sock.close()
+		if self.main_node.connected_peers.get(self.target_id) is self:
+			del self.main_node.connected_peers[self.target_id]
+		pending, self.pending = self.pending, {}
+		for future in pending.values():
+			future.set_exception(ChannelClosed(f"The channel with {self.target_id} was closed"))
+
+
+class AsyncP2PChannel:
+	"""
+		- The asyncio counterpart of P2PChannel, used by a peer that is serving in asyncio mode.
+		- Unlike P2PChannel it keeps answering EOM messages too, until the other peer closes the connection.
+		- Requests can be sent from any thread with request(), the write is handed over to the event loop.
+	"""
+
+	read_limit = MAX_FRAME_SIZE # Largest message that can be buffered by the stream reader
+
+	def __init__(self, main_node, reader, writer, target_id, main_host, main_port, framed=False, capabilities=()):
+		"""
+			args:
+				main_node - The node that is being connected
+				reader, writer - The asyncio streams of the connection
+				target_id - The id of the target node
+				main_host - hostname of the main node
+				main_port - the port of the main node
+				framed - Both peers agreed on length prefixed frames during the ID exchange
+				capabilities - The capabilities both peers agreed on during the ID exchange
+		"""
+		self.main_node = main_node
+		self.reader = reader
+		self.writer = writer
+		self.target_id = target_id
+		self.main_host = main_host
+		self.main_port = main_port
+		self.framed = framed
+		self.capabilities = set(capabilities)
+		self.closed = False
+		self.gossip_only = False
+
+		self.pending = {}
+		self._request_ids = itertools.count(1)
+
+		self.peername = writer.get_extra_info('peername')
+		self.printh(f"Started P2P channel with node: {self.peername}")
+
+	def printh(self, message):
+		print(f"({self.main_node.hostname})P2P: {message}")
+
+	async def serve(self):
+		"""
+			- Read messages until the connection is closed.
+			- Every request is answered in its own task, handle_request talks to Redis so it is run in
+			the executor of the node to keep the loop free for the other channels.
+		"""
+		tasks = set()
+		try:
+			while True:
+				try:
+					data, info = await read_message_async(self.reader)
+				except asyncio.IncompleteReadError:
+					return
+				if info.flags & FLAG_RESPONSE:
+					self._resolve(info.request_id, data, info.msg_type)
+				elif not info.framed:
+					# EOM peers wait for every answer before sending the next message
+					await self._answer(info, data)
+				else:
+					task = asyncio.create_task(self._answer(info, data))
+					tasks.add(task)
+					task.add_done_callback(tasks.discard)
+		finally:
+			self.close()
+
+	async def _answer(self, info, data):
+		loop = asyncio.get_running_loop()
+		try:
+			response = await loop.run_in_executor(self.main_node.executor,
+				self.main_node.handle_request, info.msg_type, data, self)
+		except Exception as e:
+			self.printh(f"Request {info.request_id} from {self.target_id} failed: {e!r}")
+			response = self.main_node.error_response(info.msg_type, e)
+		self._write(response, info.framed, info.request_id, FLAG_RESPONSE, info.msg_type)
+		try:
+			await self.writer.drain()
+		except ConnectionError:
+			self.printh(f"Could not answer request {info.request_id} from {self.target_id}")
+
+	_resolve = P2PChannel._resolve
+
+	def _write(self, body, framed, request_id=0, flags=0, msg_type=MSG_CLAIMS):
+		if framed:
+			self.writer.writelines(frame_buffers(body, request_id, flags, msg_type))
+		else:
+			self.writer.write(body + END_BYTE)
 
+	def request(self, message, msg_type=MSG_CLAIMS):
+		"""
+			- Same as P2PChannel.request, only framed peers can be sent requests this way
+		"""
+		if not self.framed or self.closed:
+			raise ChannelClosed(f"Cannot send requests to {self.target_id} on this channel")
+		future = Future()
+		request_id = next(self._request_ids)
+		self.pending[request_id] = future
+		body = message.encode() if isinstance(message, str) else message
+		self.main_node._loop.call_soon_threadsafe(self._write, body, True, request_id, 0, msg_type)
+		return future
+
+	def send_data(self, message, timeout=None):
+		return self.request(message).result(timeout)
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		self.writer.close()
+		if self.main_node.connected_peers.get(self.target_id) is self:
+			del self.main_node.connected_peers[self.target_id]
+		pending, self.pending = self.pending, {}
+		for future in pending.values():
+			future.set_exception(ChannelClosed(f"The channel with {self.target_id} was closed"))
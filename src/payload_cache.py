@@ -0,0 +1,141 @@
+"""
+	- Payload store of a peer with a memory budget.
+
+	- PayloadCache is used as Node.available_payloads and behaves like the dict it replaces: it maps the
+	id of every payload the peer holds to its claimed string. Only the most recently used payloads are
+	kept in memory, up to max_bytes. A payload that has been evicted is still in the mapping and is
+	loaded again with the loader (Node.querry_payload) the next time it is used.
+
+	- Every cached payload has a ChunkView, a list-like view of its chunks that slices the payload on
+	access, so checking a claim never re-chunks the payload and the chunks take no extra memory.
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping, Sequence
+
+from hashing import CHUNK_SIZE
+
+PAYLOAD_CACHE_BYTES = int(os.environ.get("P2P_PAYLOAD_CACHE_BYTES", 256 * 2 ** 20))
+
+
+class ChunkView(Sequence):
+	"""
+		- The chunks of a payload, chunk i is payload[i*chunk_size:(i+1)*chunk_size]
+	"""
+	__slots__ = ('payload', 'chunk_size', 'count')
+
+	def __init__(self, payload, chunk_size=CHUNK_SIZE):
+		self.payload = payload
+		self.chunk_size = chunk_size
+		self.count = -(-len(payload) // chunk_size)
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(self.count))]
+		if index < 0:
+			index += self.count
+		if not 0 <= index < self.count:
+			raise IndexError("chunk index out of range")
+		start = index * self.chunk_size
+		return self.payload[start:start + self.chunk_size]
+
+
+class PayloadCache(MutableMapping):
+	"""
+		- LRU cache of payloads with a budget of max_bytes, see the module docstring.
+		- loader(payloadId) returns the claimed string of an evicted payload, it is called without holding
+		the lock. If it fails the payload counts as not available.
+		- Safe to use from the channel threads and the executor at the same time.
+	"""
+
+	def __init__(self, max_bytes=PAYLOAD_CACHE_BYTES, loader=None, chunk_size=CHUNK_SIZE):
+		self.max_bytes = max_bytes
+		self.loader = loader
+		self.chunk_size = chunk_size
+		self.entries = OrderedDict() # payloadId -> ChunkView, least recently used first
+		self.known = set() # ids of all the payloads held, cached or not
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	def __setitem__(self, payloadId, payload):
+		view = ChunkView(payload, self.chunk_size)
+		with self.lock:
+			old = self.entries.pop(payloadId, None)
+			if old is not None:
+				self.size -= sys.getsizeof(old.payload)
+			self.entries[payloadId] = view
+			self.known.add(payloadId)
+			self.size += sys.getsizeof(payload)
+			# The newest payload is kept even if it is larger than the whole budget
+			while self.size > self.max_bytes and len(self.entries) > 1:
+				_, evicted = self.entries.popitem(last=False)
+				self.size -= sys.getsizeof(evicted.payload)
+				self.evictions += 1
+
+	def __getitem__(self, payloadId):
+		view = self.chunks(payloadId)
+		if view is None:
+			raise KeyError(payloadId)
+		return view.payload
+
+	def __delitem__(self, payloadId):
+		with self.lock:
+			self.known.remove(payloadId)
+			view = self.entries.pop(payloadId, None)
+			if view is not None:
+				self.size -= sys.getsizeof(view.payload)
+
+	def __contains__(self, payloadId):
+		return payloadId in self.known
+
+	def __iter__(self):
+		return iter(list(self.known))
+
+	def __len__(self):
+		return len(self.known)
+
+	def is_cached(self, payloadId):
+		return payloadId in self.entries
+
+	def chunks(self, payloadId):
+		"""
+			- The ChunkView of a payload, loading it again if it was evicted. None if the payload is not
+			held or cannot be loaded.
+		"""
+		with self.lock:
+			view = self.entries.get(payloadId)
+			if view is not None:
+				self.entries.move_to_end(payloadId)
+				self.hits += 1
+				return view
+			if payloadId not in self.known:
+				return None
+			self.misses += 1
+
+		if self.loader is None:
+			return None
+		try:
+			payload = self.loader(payloadId)
+		except Exception:
+			return None
+		self[payloadId] = payload
+		return ChunkView(payload, self.chunk_size)
+
+	def stats(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'bytes': self.size,
+			'max_bytes': self.max_bytes,
+			'cached': len(self.entries),
+			'payloads': len(self.known),
+		}
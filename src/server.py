@@ -1,23 +1,332 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional, List
+from itertools import accumulate
 from datetime import datetime
 
-import redis
-import hashlib
+import redis.asyncio as redis
 import uvicorn
 import logging
+import asyncio
+import codecs
+import hashlib
+import json
+import struct
+import uuid
+import time
+import os
+
+from merkle import DIGEST_SIZE, MerkleBuilder, level_sizes, merkle_levels, proof_path
+from histogram import Registry
+from hashing import CHUNK_SIZE, StreamHasher, full_hash, generate_digests, split_hex, split_digests
+from bloom import BloomFilter
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 app = FastAPI()
 app.logger = logger
-conn = redis.StrictRedis(host='localhost', port=6379)
+
+stats = Registry() # latency histograms of the tracker, served by /metrics
+
+class RequestMetrics:
+	"""
+		- ASGI middleware that records the time spent on every request in the
+		tracker_http_request_seconds histogram, by path, method and status code.
+		- Requests that did not match a route are all recorded under the path "other".
+	"""
+
+	def __init__(self, app):
+		self.app = app
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http':
+			return await self.app(scope, receive, send)
+		start = time.perf_counter()
+		status = [500]
+
+		async def send_status(message):
+			if message['type'] == 'http.response.start':
+				status[0] = message['status']
+			await send(message)
+
+		try:
+			await self.app(scope, receive, send_status)
+		finally:
+			path = scope['path'] if 'endpoint' in scope else 'other'
+			stats.histogram('tracker_http_request_seconds', 'Time spent on a request',
+				path=path, method=scope['method'], status=status[0]).observe(time.perf_counter() - start)
+
+app.add_middleware(RequestMetrics)
+
+""" 
+	- The Redis client is created by the startup hook, on the event loop that serves the requests.
+	- Every handler awaits its Redis calls, so while one request waits on Redis the loop serves the others.
+	The pool is sized explicitly, a request that finds every connection busy waits for one to be released.
+"""
+REDIS_HOST = os.environ.get("TRACKER_REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("TRACKER_REDIS_PORT", 6379))
+REDIS_POOL_SIZE = int(os.environ.get("TRACKER_REDIS_POOL_SIZE", 64))
+REDIS_POOL_TIMEOUT = 5 # seconds to wait for a free connection
+conn = None
+register_script = None
+deregister_script = None
+heartbeat_script = None
+reap_script = None
+acquire_script = None
+release_script = None
+peer_watch = None
+reaper = None
+payload_filter = None
+
+PEER_LIST = "list:peers"
+PAYLOAD_LIST = "list:payloads"
+HSET_BATCH = 10000 # chunks or store blocks per HMGET command or store script call, all of them still go in one transaction
+PEER_ADDR_INDEX = "index:peers:addr" # hash of "hostaddr:port" -> peer_id, one entry per registered peer
+STREAM_BLOCK = 1 << 16 # characters of a streamed upload that are hashed and written to Redis at a time
+UPLOAD_TTL = 3600 # seconds an unfinished streamed upload is kept after its last block, see reap_uploads
+UPLOADS = "uploads:pending" # sorted set of the unfinished streamed uploads, scored by the time they expire
+
+"""
+	- A payload Id is derived from the full hash of the payload (see derive_id), which is computed in the
+	same pass over the data as the chunk hashes.
+	- Payloads uploaded before that have a 12 letter Id. PAYLOAD_HASH_INDEX maps their full hash to it, so
+	that uploading one of them again still returns the Id it is known by.
+	- payload_filter holds the derived Id of every payload on the server (for a legacy payload, the Id it
+	would get now). A payload it does not know is new and is written without asking Redis, the others
+	are looked up in PAYLOAD_LIST and PAYLOAD_HASH_INDEX.
+	- The filter only learns the payloads this process writes. One written by another tracker process
+	since the startup can be written again, which changes nothing: the keys get the same values and
+	ACQUIRE_BLOCKS_LUA takes no references for a payload that is already in PAYLOAD_LIST.
+"""
+PAYLOAD_ID_SIZE = 32 # hex characters of the full hash in a payload Id, 128 bits
+PAYLOAD_HASH_INDEX = "index:payloads:hash" # hash of full hash -> legacy payload Id
+PAYLOAD_FILTER_CAPACITY = int(os.environ.get("TRACKER_PAYLOAD_FILTER_CAPACITY", 1 << 20))
+PAYLOAD_FILTER_ERROR_RATE = 0.01
+
+"""
+	- Every change to PEER_LIST increments PEER_VERSION and is added to PEER_CHANGES, a sorted set of
+	[version, "+", peer_id, hostaddr, port] and [version, "-", peer_id] entries scored by version, so peers
+	can ask for what changed since the version they have instead of the whole list.
+	- Only the last PEER_CHANGES_SIZE changes are kept, a peer that is further behind gets the whole list.
+	- Every change is published on PEER_CHANNEL to wake up the peers waiting for one.
+"""
+PEER_VERSION = "peers:version"
+PEER_CHANGES = "peers:changes"
+PEER_CHANNEL = "peers:changed"
+PEER_CHANGES_SIZE = 10000
+PEER_VERSION_HEADER = "X-Peers-Version"
+MAX_PEER_WAIT = 30 # seconds a /get_peers long-poll waits for a change at most
+
+"""
+	- A registration is a lease of PEER_LEASE_TTL seconds, kept in PEER_LEASES: a sorted set of peer ids
+	scored by the time their lease expires. Peers renew it with /heartbeat/ (or by registering again).
+	- Every REAP_INTERVAL seconds the peers whose lease expired are removed like a deregistration, they
+	are read off the front of PEER_LEASES so the keyspace is never scanned.
+"""
+PEER_LEASES = "leases:peers"
+PEER_LEASE_TTL = float(os.environ.get("TRACKER_PEER_LEASE_TTL", 60))
+REAP_INTERVAL = float(os.environ.get("TRACKER_REAP_INTERVAL", 1))
+REAP_BATCH = 1000 # expired peers removed per script call
+
+LOG_PEER_CHANGE_LUA = """
+local function log_change(change)
+	local version = redis.call('INCR', KEYS[4])
+	table.insert(change, 1, version)
+	redis.call('ZADD', KEYS[5], version, cjson.encode(change))
+	redis.call('ZREMRANGEBYRANK', KEYS[5], 0, -tonumber(ARGV[5]) - 1)
+	redis.call('PUBLISH', ARGV[6], version)
+end
+"""
+
+""" 
+	- Registration replaces whichever peer was registered at the same host and port, the lookup and the
+	replacement have to happen atomically or two peers racing for the same address can both end up registered.
+	- Registering (again) also starts (or renews) the lease of the peer until the expiry time in ARGV[7].
+	- KEYS: see peer_keys
+	- ARGV: peer_id, hostaddr, port, hostaddr:port, PEER_CHANGES_SIZE, PEER_CHANNEL, lease expiry
+	- Returns 0 if the peer was already registered, 1 otherwise
+"""
+REGISTER_PEER_LUA = LOG_PEER_CHANGE_LUA + """
+if redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 1 then
+	redis.call('ZADD', KEYS[6], ARGV[7], ARGV[1])
+	return 0
+end
+local stale = redis.call('HGET', KEYS[2], ARGV[4])
+if stale then
+	redis.call('DEL', 'peer:' .. stale)
+	redis.call('SREM', KEYS[3], stale)
+	redis.call('ZREM', KEYS[6], stale)
+	log_change({'-', stale})
+end
+redis.call('HSET', KEYS[1], 'hostaddr', ARGV[2], 'port', ARGV[3])
+redis.call('HSET', KEYS[2], ARGV[4], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('ZADD', KEYS[6], ARGV[7], ARGV[1])
+log_change({'+', ARGV[1], ARGV[2], ARGV[3]})
+return 1
+"""
+
+"""
+	- Remove a peer if it is registered at the given host and port.
+	- KEYS: see peer_keys
+	- ARGV: peer_id, hostaddr:port, unused, unused, PEER_CHANGES_SIZE, PEER_CHANNEL
+	- Returns 1 if the peer was removed, 0 if it is registered at another address, -1 if it is not registered
+"""
+DEREGISTER_PEER_LUA = LOG_PEER_CHANGE_LUA + """
+if redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 0 then
+	return -1
+end
+if redis.call('HGET', KEYS[2], ARGV[2]) ~= ARGV[1] then
+	return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HDEL', KEYS[2], ARGV[2])
+redis.call('SREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[6], ARGV[1])
+log_change({'-', ARGV[1]})
+return 1
+"""
+
+"""
+	- Renew the leases of the peers in ARGV[2:] until the expiry time in ARGV[1]
+	- KEYS: PEER_LEASES
+	- Returns the ids that have no lease (never registered or already reaped), they have to register again
+"""
+HEARTBEAT_LUA = """
+local unknown = {}
+for i = 2, #ARGV do
+	if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+		redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+	else
+		table.insert(unknown, ARGV[i])
+	end
+end
+return unknown
+"""
+
+"""
+	- Remove up to ARGV[2] peers whose lease expired before ARGV[1], the same way as a deregistration
+	- KEYS: see peer_keys, with PEER_LEASES in place of the peer hash
+	- ARGV: now, REAP_BATCH, unused, unused, PEER_CHANGES_SIZE, PEER_CHANNEL
+	- Returns the number of peers removed
+"""
+REAP_PEERS_LUA = LOG_PEER_CHANGE_LUA + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[6], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, peer_id in ipairs(expired) do
+	local address = redis.call('HMGET', 'peer:' .. peer_id, 'hostaddr', 'port')
+	if address[1] and address[2] then
+		local key = address[1] .. ':' .. address[2]
+		if redis.call('HGET', KEYS[2], key) == peer_id then
+			redis.call('HDEL', KEYS[2], key)
+		end
+	end
+	redis.call('DEL', 'peer:' .. peer_id)
+	redis.call('ZREM', KEYS[6], peer_id)
+	if redis.call('SREM', KEYS[3], peer_id) == 1 then
+		log_change({'-', peer_id})
+	end
+end
+return #expired
+"""
+
+def peer_keys(peer_id):
+	"""
+		- The keys of the peer scripts: peer:peer_id, PEER_ADDR_INDEX, PEER_LIST, PEER_VERSION, PEER_CHANGES,
+		PEER_LEASES
+	"""
+	return [f"peer:{peer_id}", PEER_ADDR_INDEX, PEER_LIST, PEER_VERSION, PEER_CHANGES, PEER_LEASES]
+
+"""
+	- The payloads are stored in content addressed blocks of STORE_BLOCK chunks: BLOCK_STORE maps the
+	digest of every distinct block to its bytes and BLOCK_REFS to the number of references to it. A block
+	that appears in many payloads (or many times in one) is stored once. Payloads uploaded before the
+	store keep their claimed string in claimed:payloadId.
+	- The digest of a block is the sha224 of the digests of its chunks (see block_digests), so a payload
+	needs nothing more than its chunk digests in merkle:payloadId:0 (see store_merkle) to find its blocks.
+	- Every entry of the store costs about 150 bytes of Redis on top of its value, single chunks would
+	take many times the payload itself. A block of ascii chunks is a few bytes under a Redis allocation
+	size by default. The blocks are aligned on the payload start, an edit in place only changes the
+	block it falls in but an insertion changes every block after it.
+	- A block is removed from the store with its last reference. DEDUP_STATS keeps the bytes referenced
+	by the payloads and the bytes of the blocks actually stored, for /dedup_report.
+"""
+STORE_BLOCK = int(os.environ.get("TRACKER_STORE_BLOCK", (1024 - 8) // CHUNK_SIZE)) # chunks per store block
+BLOCK_STORE = "blocks:data"
+BLOCK_REFS = "blocks:refs"
+DEDUP_STATS = "blocks:stats"
+STORE_KEYS = [BLOCK_STORE, BLOCK_REFS, DEDUP_STATS]
+MEMORY_SAMPLES = 100 # hash fields sampled by MEMORY USAGE for the /dedup_report estimate
+
+"""
+	- KEYS: STORE_KEYS, PAYLOAD_LIST
+	- ARGV: payload Id, packed digests of the blocks, the blocks back to back, packed block ends (4 bytes
+	big endian, empty when every block is ARGV[5] bytes), ARGV[5], DIGEST_SIZE
+	- Every block gets one more reference and is stored if it had none. The blocks go packed rather than
+	as three arguments each, which would cost more to send than the script takes to run.
+	- Nothing is done for a payload that is already in PAYLOAD_LIST: two uploads of a new payload can race
+	to write it, only the first transaction takes references. Streamed uploads pass an empty payload Id.
+	- Returns the number of bytes added to the store
+"""
+ACQUIRE_BLOCKS_LUA = """
+if ARGV[1] ~= '' and redis.call('SISMEMBER', KEYS[4], ARGV[1]) == 1 then
+	return 0
+end
+local digests, data, ends = ARGV[2], ARGV[3], ARGV[4]
+local size, step = tonumber(ARGV[5]), tonumber(ARGV[6])
+local stored, start = 0, 1
+for i = 0, #digests / step - 1 do
+	local digest = string.sub(digests, i * step + 1, (i + 1) * step)
+	local stop = start + size - 1
+	if ends ~= '' then
+		local a, b, c, d = string.byte(ends, i * 4 + 1, i * 4 + 4)
+		stop = ((a * 256 + b) * 256 + c) * 256 + d
+	end
+	if redis.call('HINCRBY', KEYS[2], digest, 1) == 1 then
+		local block = string.sub(data, start, stop)
+		redis.call('HSET', KEYS[1], digest, block)
+		stored = stored + #block
+	end
+	start = stop + 1
+end
+redis.call('HINCRBY', KEYS[3], 'storedBytes', stored)
+redis.call('HINCRBY', KEYS[3], 'logicalBytes', #data)
+return stored
+"""
+
+"""
+	- KEYS: STORE_KEYS
+	- ARGV: packed digests of the blocks, DIGEST_SIZE
+	- Every block loses a reference, the blocks left without any are removed
+	- Returns the number of bytes removed from the store
+"""
+RELEASE_BLOCKS_LUA = """
+local digests, step = ARGV[1], tonumber(ARGV[2])
+local freed, logical = 0, 0
+for i = 1, #digests, step do
+	local digest = string.sub(digests, i, i + step - 1)
+	local size = redis.call('HSTRLEN', KEYS[1], digest)
+	logical = logical + size
+	if redis.call('HINCRBY', KEYS[2], digest, -1) <= 0 then
+		redis.call('HDEL', KEYS[1], digest)
+		redis.call('HDEL', KEYS[2], digest)
+		freed = freed + size
+	end
+end
+-- 0 - x rather than -x, Redis does not take -0 for an integer
+redis.call('HINCRBY', KEYS[3], 'storedBytes', 0 - freed)
+redis.call('HINCRBY', KEYS[3], 'logicalBytes', 0 - logical)
+return freed
+"""
 
 class StringPayload(BaseModel):
 	payload: str
 	desc: Optional[str] = None
 
+class StringPayloadBatch(BaseModel):
+	payloads: List[StringPayload]
+
 class StringHashPayload(BaseModel):
 	claimedString: str
 	rootHash: str
@@ -34,121 +343,913 @@ class Peer(BaseModel):
 	def __repr__(self):
 		return ', '.join([self.peer_id, self.hostaddr, self.port])
 
+	@property
+	def address(self):
+		return f"{self.hostaddr}:{self.port}"
+
+class Heartbeat(BaseModel):
+	peer_ids: List[str]
+
 class PayloadId(BaseModel):
 	id: str
+	start: Optional[int] = None # first chunk of a chunk range
+	end: Optional[int] = None # chunk after the last one of a chunk range
+	offset: Optional[int] = None # first byte of a byte range of the claimed string
+	length: Optional[int] = None # number of bytes of a byte range, the rest of the payload if not given
+
+class ProofQuery(BaseModel):
+	id: str
+	index: int
 
-def generate_hashes(payload_string):
+def hash_payload(payload_string):
 	"""
-		- The string will be split into a list of new strings with 4 characters each
-		- Each of those new strings will be hashed
-		- Every single hash of the new strings will be added and hashed together to
-		create a new hash string which will be returned along with the list of chunks
+		- The full hash of generate_hashes and the packed chunk digests of the payload, the only pass
+		over the data needed to derive its Id
 	"""
-	hashes = []
-	for i in range(0,len(payload_string), 4):
-		hash_ = hashlib.sha224(payload_string[i:i+4].encode()).hexdigest()
-		hashes.append(hash_)
-	
-	full_hash = hashlib.sha224(''.join(hashes).encode()).hexdigest()
-	return hashes, full_hash	
+	digests = generate_digests(payload_string)
+	return full_hash(digests), digests
 
+def layout_payload(payload_string, digests):
+	"""
+		- The levels of the merkle tree over the chunk digests and the block_batches of a new payload
+	"""
+	return merkle_levels(split_digests(digests)), block_batches(payload_string, digests)
 
-def custom_encode(string_par):
-	if len(string_par) < 12:
-		string_par = string_par + ''.join([str(i) for i in range(12-len(string_par))])
-	x = [i for i in range(12)]
-	for i in range(len(string_par)):
-		x[i % len(x)] = x[i % len(x)] * ord(string_par[i])
-		x[i % len(x)] = 65 + x[i % len(x)] % 25
-	
-	new_x = ''.join([chr(k) for k in x])
-	return f"payload_{new_x}"
+def block_digests(digests):
+	"""
+		- The packed digests of the store blocks of a payload, from the packed digests of its chunks
+	"""
+	step = STORE_BLOCK * DIGEST_SIZE
+	sha224 = hashlib.sha224
+	return b''.join([sha224(digests[i:i + step]).digest() for i in range(0, len(digests), step)])
 
-def get_id(payload_string):
+def block_batches(text, digests):
 	"""
-		- return a unique id for the payload
+		- The (digests, blocks, ends) arguments of ACQUIRE_BLOCKS_LUA for the store blocks of text, HSET_BATCH
+		blocks per script call. text starts on a block boundary and digests are the packed digests of its chunks.
+		- The blocks of ascii text are all STORE_BLOCK * CHUNK_SIZE bytes (but the last one), ends is left
+		empty for them.
 	"""
-	return f'payload_{hash(payload_string)}'
+	packed, size = block_digests(digests), STORE_BLOCK * CHUNK_SIZE
+	count = len(packed) // DIGEST_SIZE
+	if text.isascii():
+		data = text.encode('ascii')
+		return [(packed[first * DIGEST_SIZE:(first + HSET_BATCH) * DIGEST_SIZE],
+			data[first * size:(first + HSET_BATCH) * size], b'') for first in range(0, count, HSET_BATCH)]
+
+	batches = []
+	for first in range(0, count, HSET_BATCH):
+		blocks = [text[i * size:(i + 1) * size].encode() for i in range(first, min(count, first + HSET_BATCH))]
+		ends = struct.pack(f'!{len(blocks)}I', *accumulate(map(len, blocks)))
+		batches.append((packed[first * DIGEST_SIZE:(first + HSET_BATCH) * DIGEST_SIZE], b''.join(blocks), ends))
+	return batches
+
+async def acquire_blocks(pipe, batches, payloadId=''):
+	"""
+		- Queue the script calls that add the block_batches of a payload to the store on pipe
+	"""
+	for digests, blocks, ends in batches:
+		args = [payloadId, digests, blocks, ends, STORE_BLOCK * CHUNK_SIZE, DIGEST_SIZE]
+		await acquire_script(keys=STORE_KEYS + [PAYLOAD_LIST], args=args, client=pipe)
+
+async def release_blocks(pipe, digests):
+	"""
+		- Queue the script calls that drop the references of the store blocks of a payload on pipe, digests
+		are the packed digests of its chunks
+	"""
+	packed = block_digests(digests)
+	for first in range(0, len(packed), HSET_BATCH * DIGEST_SIZE):
+		batch = packed[first:first + HSET_BATCH * DIGEST_SIZE]
+		await release_script(keys=STORE_KEYS, args=[batch, DIGEST_SIZE], client=pipe)
+
+def store_merkle(pipe, payloadId, levels):
+	"""
+		- Queue the writes of a merkle tree on pipe.
+		- Every level is stored as one string of packed digests at merkle:payloadId:level, so a single node
+		can be read with GETRANGE. Level 0 are the chunk digests of the payload, in order, 28 bytes each
+		instead of a 56 character hex string in a hash field named after the index.
+		- Payloads uploaded before that have their chunk digests in the chunks:payloadId hash (see
+		read_digests), src/migrate_chunks.py converts them.
+	"""
+	for level, nodes in enumerate(levels):
+		pipe.set(f'merkle:{payloadId}:{level}', b''.join(nodes))
+	root = levels[-1][0].hex() if levels and levels[-1] else ''
+	pipe.hset(f'hash:{payloadId}', mapping={'merkleRoot': root, 'chunkCount': len(levels[0]) if levels else 0})
+
+def derive_id(rootHash):
+	"""
+		- The payload Id of the payload with the full hash rootHash: its first PAYLOAD_ID_SIZE hex characters
+	"""
+	return f'payload_{rootHash[:PAYLOAD_ID_SIZE]}'
+
+def is_legacy_id(payloadId):
+	"""
+		- True for the 12 letter Ids given before derive_id
+	"""
+	digest = payloadId[len('payload_'):]
+	return len(digest) != PAYLOAD_ID_SIZE or bool(digest.strip('0123456789abcdef'))
+
+async def find_payloads(rootHashes):
+	"""
+		- The Id every full hash in rootHashes is stored under, None for the payloads not on the server.
+		- Only the Ids payload_filter knows are looked up, in one pipeline. A payload that is there under
+		its derived Id and under a legacy one (uploaded again before the legacy Ids were indexed) is
+		returned under the derived Id.
+	"""
+	found = [None] * len(rootHashes)
+	maybe = [i for i, rootHash in enumerate(rootHashes) if derive_id(rootHash) in payload_filter]
+	if not maybe:
+		return found
+	pipe = conn.pipeline(transaction=False)
+	for i in maybe:
+		pipe.sismember(PAYLOAD_LIST, derive_id(rootHashes[i]))
+		pipe.hget(PAYLOAD_HASH_INDEX, rootHashes[i])
+	results = await pipe.execute()
+	for i, present, legacy in zip(maybe, results[::2], results[1::2]):
+		found[i] = derive_id(rootHashes[i]) if present else legacy.decode() if legacy else None
+	return found
+
+@app.on_event("startup")
+async def connect_redis():
+	pool = redis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT,
+		max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT)
+	await init_redis(redis.StrictRedis(connection_pool=pool))
+
+async def init_redis(connection):
+	"""
+		- Set the tracker up on an asyncio Redis client and start its background tasks. The startup event
+		calls it with the client of REDIS_HOST, the benchmarks also call it with a fakeredis client.
+	"""
+	global conn, register_script, deregister_script, heartbeat_script, reap_script, peer_watch, reaper
+	global acquire_script, release_script, payload_filter
+	conn = connection
+	register_script = conn.register_script(REGISTER_PEER_LUA)
+	deregister_script = conn.register_script(DEREGISTER_PEER_LUA)
+	heartbeat_script = conn.register_script(HEARTBEAT_LUA)
+	reap_script = conn.register_script(REAP_PEERS_LUA)
+	acquire_script = conn.register_script(ACQUIRE_BLOCKS_LUA)
+	release_script = conn.register_script(RELEASE_BLOCKS_LUA)
+	payload_filter = await load_payload_filter()
+	await build_peer_index()
+	await build_peer_leases()
+	peer_watch = PeerWatch()
+	peer_watch.start()
+	reaper = asyncio.ensure_future(reap_peers())
+
+@app.on_event("shutdown")
+async def close_redis():
+	reaper.cancel()
+	await peer_watch.stop()
+	await conn.aclose()
+	await conn.connection_pool.disconnect()
+
+async def load_payload_filter():
+	"""
+		- A payload_filter with every payload on the server. The legacy Ids are added to
+		PAYLOAD_HASH_INDEX the first time, the full hashes of the payloads are not read again after that.
+	"""
+	bloom = BloomFilter(PAYLOAD_FILTER_CAPACITY, PAYLOAD_FILTER_ERROR_RATE)
+	legacy = []
+	async for payloadId in conn.sscan_iter(PAYLOAD_LIST, count=1000):
+		payloadId = payloadId.decode()
+		if is_legacy_id(payloadId):
+			legacy.append(payloadId)
+		else:
+			bloom.add(payloadId)
+
+	if legacy and not await conn.exists(PAYLOAD_HASH_INDEX):
+		for first in range(0, len(legacy), HSET_BATCH):
+			ids = legacy[first:first + HSET_BATCH]
+			pipe = conn.pipeline(transaction=False)
+			for payloadId in ids:
+				pipe.hget(f'hash:{payloadId}', 'rootHash')
+			index = {rootHash: payloadId for payloadId, rootHash in zip(ids, await pipe.execute()) if rootHash}
+			if index:
+				await conn.hset(PAYLOAD_HASH_INDEX, mapping=index)
+	async for rootHash, _ in conn.hscan_iter(PAYLOAD_HASH_INDEX, count=1000):
+		bloom.add(derive_id(rootHash.decode()))
+	return bloom
+
+async def build_peer_index():
+	"""
+		- Peers registered before PEER_ADDR_INDEX existed are not in the index, add them once so that
+		their address is still replaced when a new peer registers at it.
+	"""
+	if await conn.exists(PEER_ADDR_INDEX) or not await conn.scard(PEER_LIST):
+		return
+	peer_ids = [p.decode() async for p in conn.sscan_iter(PEER_LIST, count=1000)]
+	pipe = conn.pipeline(transaction=False)
+	for peer_id in peer_ids:
+		pipe.hmget(f"peer:{peer_id}", "hostaddr", "port")
+	index = {}
+	for peer_id, (hostaddr, port) in zip(peer_ids, await pipe.execute()):
+		if hostaddr is not None and port is not None:
+			index[f"{hostaddr.decode()}:{port.decode()}"] = peer_id
+	if index:
+		await conn.hset(PEER_ADDR_INDEX, mapping=index)
+
+async def build_peer_leases():
+	"""
+		- Peers registered before PEER_LEASES existed have no lease, give them one so that they are reaped
+		if they do not heartbeat.
+	"""
+	if await conn.exists(PEER_LEASES) or not await conn.scard(PEER_LIST):
+		return
+	expiry = time.time() + PEER_LEASE_TTL
+	peer_ids = [p async for p in conn.sscan_iter(PEER_LIST, count=1000)]
+	for i in range(0, len(peer_ids), 1000):
+		await conn.zadd(PEER_LEASES, {peer_id: expiry for peer_id in peer_ids[i:i + 1000]}, nx=True)
+
+async def reap_peers():
+	"""
+		- Remove the peers whose lease expired and the streamed uploads that expired (see reap_uploads),
+		every REAP_INTERVAL seconds
+	"""
+	keys = [PEER_LEASES, *peer_keys(None)[1:]]
+	while True:
+		await asyncio.sleep(REAP_INTERVAL)
+		try:
+			args = [time.time(), REAP_BATCH, '', '', PEER_CHANGES_SIZE, PEER_CHANNEL]
+			while await reap_script(keys=keys, args=args) == REAP_BATCH:
+				pass
+			while await reap_uploads() == REAP_BATCH:
+				pass
+		except redis.RedisError as e:
+			logger.warning(f"Could not reap the expired peers or uploads: {e}")
 
 
 @app.post("/register/")
 async def register_peer(peer: Peer, request: Request):
+	"""
+		- Register the peer, replacing any other peer that is registered at the same host and port.
+		- The peer registered at an address is looked up in PEER_ADDR_INDEX, so the cost does not depend on
+		how many peers or payloads there are.
+	"""
 	try:
-		if not conn.sismember("list:peers", f"{peer.peer_id}"):
-			peers_connected = conn.keys("peer:*")
-			for single_peer in peers_connected:
-				data = conn.hgetall(f"{single_peer.decode()}")
-				if data[b'hostaddr'].decode() == peer.hostaddr and data[b'port'].decode() == peer.port:
-					conn.delete(single_peer)
-					conn.srem("list:peers",single_peer.decode().split(':')[-1])
-			conn.hset(f"peer:{peer.peer_id}", "hostaddr", f"{peer.hostaddr}")
-			conn.hset(f"peer:{peer.peer_id}", "port", f"{peer.port}")
-			conn.sadd(f"list:peers", f"{peer.peer_id}")
+		args = [peer.peer_id, peer.hostaddr, peer.port, peer.address, PEER_CHANGES_SIZE, PEER_CHANNEL,
+			time.time() + PEER_LEASE_TTL]
+		if await register_script(keys=peer_keys(peer.peer_id), args=args):
 			print(f"User ip: {request.client.host}")
 		else:
-			return {"message": "Peer already registered"}
+			return {"message": "Peer already registered", "ttl": PEER_LEASE_TTL}
 	except Exception as e:
 		print(f"{e}")
 		return {"message": "Due to an error at the backend, registration was unsuccessfull"}
 
-	return {"message": "Successfully Registered"}
+	return {"message": "Successfully Registered", "ttl": PEER_LEASE_TTL}
+
+@app.post("/heartbeat/")
+async def heartbeat(beat: Heartbeat):
+	"""
+		- Renew the leases of many peers at once for another PEER_LEASE_TTL seconds.
+		- unknown lists the peers that are not registered (anymore), they have to register again.
+	"""
+	unknown = await heartbeat_script(keys=[PEER_LEASES], args=[time.time() + PEER_LEASE_TTL, *beat.peer_ids])
+	return {'renewed': len(beat.peer_ids) - len(unknown), 'unknown': [p.decode() for p in unknown],
+		'ttl': PEER_LEASE_TTL}
+
+async def ingest_payloads(payload_strings):
+	"""
+		- Store every payload that is not already on the server and return the payload Ids in order.
+
+		- The lookups for all the payloads go in one pipeline and everything that has to be written goes in
+		one MULTI/EXEC transaction, so ingesting a batch costs two round trips to Redis no matter how many
+		payloads or chunks it has.
+
+		- Every payload is hashed once, the payload Id comes from the full hash (see derive_id). The lookup
+		round trip is skipped when payload_filter knows none of the payloads.
+
+		- Hashing is CPU bound, it runs in the threadpool so the event loop can keep serving the other
+		requests in the meantime.
+	"""
+	with stats.time('tracker_hash_seconds', upload='batch'):
+		hashed = await run_in_threadpool(lambda: [hash_payload(payload) for payload in payload_strings])
+	found = await find_payloads([rootHash for rootHash, _ in hashed])
+
+	pipe = conn.pipeline(transaction=True)
+	payloadIds, written = [], set()
+	for payload, (rootHash, digests), payloadId in zip(payload_strings, hashed, found):
+		payloadIds.append(payloadId or derive_id(rootHash))
+		if payloadId or payloadIds[-1] in written:
+			continue
+		payloadId = payloadIds[-1]
+		written.add(payloadId)
+
+		# Save the data as hashes
+		levels, batches = await run_in_threadpool(layout_payload, payload, digests)
+		pipe.hset(f'hash:{payloadId}', mapping={
+			'rootHash': rootHash,
+			'chunks': f'merkle:{payloadId}:0',
+			'ascii': int(payload.isascii()),
+		})
+		await acquire_blocks(pipe, batches, payloadId)
+		store_merkle(pipe, payloadId, levels)
+		pipe.sadd(PAYLOAD_LIST, payloadId)
+	if written:
+		await pipe.execute()
+		for payloadId in written:
+			payload_filter.add(payloadId)
+	return payloadIds
 
 @app.post("/upload_payload/")
 async def upload_payload(str_payload: StringPayload):
 	"""
 		- Accept a payload string, hash it and return its payload Id
 
-		- Check if the payload already exists in the database, if so then just return the payload Id. 
-		Check the set list:payloads for the list of payloads that have been uploaded to the trusted server.
+		- Generate hash_chunks and full_hash for the payload, the payload Id is derived from full_hash.
 
-		- if the payload is not already present, then generate hash_chunks and full_hash for the payload.
+		- Check if the payload already exists in the database, if so then just return the payload Id (the
+		legacy Id for a payload uploaded before the Ids were derived). Check the set list:payloads for the
+		list of payloads that have been uploaded to the trusted server.
 
-		- insert the chunked hashes into the chunks:payloadId hash. It is important to keep the order of the
-		chunks that occur in the payload string.
+		- insert the chunked hashes into merkle:payloadId:0, packed back to back. It is important to keep
+		the order of the chunks that occur in the payload string.
 
-		- Insert the full_hash, claimed string and chunksid into the hash:payloadId hash
+		- Insert the full_hash and chunksid into the hash:payloadId hash, the chunks themselves go to the
+		block store, a block that is already there only gets one more reference
 
 	"""
-	payloadId = custom_encode(str_payload.payload)
-	if conn.sismember('list:payloads', payloadId):
-		return {'payloadId':payloadId}
+	payloadId, = await ingest_payloads([str_payload.payload])
+	return {'payloadId':payloadId}
 
-	# Save the data as hashes
-	hash_chunks, full_hash = generate_hashes(str_payload.payload)
-	for i, h in enumerate(hash_chunks):
-		conn.hset(f'chunks:{payloadId}', f'{i}', h)
-	
-	conn.hset(f'hash:{payloadId}', 'rootHash', full_hash)
-	conn.hset(f'hash:{payloadId}', 'claimedString', str_payload.payload)
-	conn.hset(f'hash:{payloadId}', 'chunks', f'chunks:{payloadId}')
+@app.post("/upload_payloads/")
+async def upload_payloads(batch: StringPayloadBatch):
+	"""
+		- Same as /upload_payload for many payloads in one request, the payload Ids are returned in the
+		same order as the payloads.
+	"""
+	payloadIds = await ingest_payloads([p.payload for p in batch.payloads])
+	return {'payloadIds': payloadIds}
 
-	conn.sadd('list:payloads', payloadId)
-	return {'payloadId':payloadId}
+class PayloadStream:
+	"""
+		- One streamed upload. The payload is hashed and written to Redis one block at a time, so the
+		tracker never holds more than a block of it, and the chunk hashes, the full hash (and with it the
+		payload Id) and the merkle tree are all computed in the same pass over the data.
+
+		- Until the payload Id is known the data goes to temporary upload:token:* keys. commit() renames
+		them to the keys of the payload in one transaction, or drops them if the payload is already on the
+		server.
+		- The chunks go to the block store as soon as they fill a block, the references are taken by the
+		upload and passed on to the payload by commit(). discard() drops them again. The digests of the
+		chunks of the block being filled are held back from merkle:0 until then, so that merkle:0 always
+		lists the blocks the upload holds references to.
+		- The token is in UPLOADS until then, an upload that is neither committed nor discarded (the
+		tracker died in the middle of it) is discarded by reap_uploads UPLOAD_TTL seconds after its last block.
+	"""
+
+	def __init__(self):
+		self.token = uuid.uuid4().hex
+		self.hasher = StreamHasher()
+		self.merkle = MerkleBuilder()
+		self.written = {} # name -> temporary key, the name is the payload key without the payload Id
+		self.ascii = True
+		self.block_text = '' # hashed chunks of the store block being filled
+		self.block_digests = b''
+
+	def temp_key(self, name):
+		return self.written.setdefault(name, f'upload:{self.token}:{name}')
+
+	@staticmethod
+	def final_key(name, payloadId):
+		kind, _, level = name.partition(':')
+		return f'{kind}:{payloadId}:{level}' if level else f'{kind}:{payloadId}'
+
+	def hash_block(self, text, last):
+		self.ascii = self.ascii and text.isascii()
+		pending = self.hasher.carry + text
+		packed = self.hasher.update(text)
+		if last:
+			packed += self.hasher.finish()
+		for digest in split_digests(packed):
+			self.merkle.add(digest)
+		if last:
+			self.merkle.finish()
+		levels = self.merkle.flush()
+
+		self.block_text += pending[:len(pending) - len(self.hasher.carry)]
+		self.block_digests += packed
+		chunks = len(self.block_digests) // DIGEST_SIZE
+		if not last:
+			chunks -= chunks % STORE_BLOCK
+		text, digests = self.block_text[:chunks * CHUNK_SIZE], self.block_digests[:chunks * DIGEST_SIZE]
+		self.block_text, self.block_digests = self.block_text[len(text):], self.block_digests[len(digests):]
+		levels[:1] = [[digests]]
+		return levels, block_batches(text, digests)
+
+	async def write_block(self, text, last=False):
+		with stats.time('tracker_hash_seconds', upload='stream'):
+			levels, batches = await run_in_threadpool(self.hash_block, text, last)
+		# The references and the chunk digests they are released by go in together
+		pipe = conn.pipeline(transaction=True)
+		await acquire_blocks(pipe, batches)
+		for level, nodes in enumerate(levels):
+			if any(nodes):
+				pipe.append(self.temp_key(f'merkle:{level}'), b''.join(nodes))
+		pipe.zadd(UPLOADS, {self.token: time.time() + UPLOAD_TTL})
+		await pipe.execute()
+
+	async def commit(self):
+		"""
+			- Move the uploaded data to the payload keys and return the payload Id. The references of the
+			upload are dropped instead if the payload is already on the server.
+			- payload_filter is not used here: the payload is only checked once per upload, and a stream
+			committed twice would take its references twice.
+		"""
+		rootHash = self.hasher.full_hash
+		payloadId = derive_id(rootHash)
+		async with conn.pipeline(transaction=True) as pipe:
+			# Another upload of the same payload that commits first changes hash:payloadId
+			await pipe.watch(f'hash:{payloadId}')
+			present = await pipe.sismember(PAYLOAD_LIST, payloadId)
+			legacy = None if present else await pipe.hget(PAYLOAD_HASH_INDEX, rootHash)
+			if present or legacy:
+				await pipe.reset()
+				await self.discard()
+				return legacy.decode() if legacy else payloadId
+
+			pipe.multi()
+			for name, key in self.written.items():
+				pipe.rename(key, self.final_key(name, payloadId))
+			pipe.zrem(UPLOADS, self.token)
+			pipe.hset(f'hash:{payloadId}', mapping={
+				'rootHash': rootHash,
+				'chunks': f'merkle:{payloadId}:0',
+				'merkleRoot': self.merkle.root.hex() if self.merkle.root else '',
+				'chunkCount': self.hasher.count,
+				'ascii': int(self.ascii),
+			})
+			pipe.sadd(PAYLOAD_LIST, payloadId)
+			try:
+				await pipe.execute()
+				payload_filter.add(payloadId)
+			except redis.WatchError:
+				await self.discard()
+		return payloadId
+
+	async def discard(self):
+		pipe = conn.pipeline(transaction=True)
+		if 'merkle:0' in self.written:
+			await release_blocks(pipe, await conn.get(self.written['merkle:0']) or b'')
+		if self.written:
+			pipe.delete(*self.written.values())
+		pipe.zrem(UPLOADS, self.token)
+		await pipe.execute()
+
+async def reap_uploads():
+	"""
+		- Discard the streamed uploads that expired in UPLOADS, with the block store references they took.
+		Returns the number of uploads discarded.
+		- The digests of an upload are watched while they are read, an upload that writes a block or
+		commits in the meantime is left alone.
+	"""
+	reaped = 0
+	for token in await conn.zrangebyscore(UPLOADS, '-inf', time.time(), start=0, num=REAP_BATCH):
+		token = token.decode()
+		digests_key = f'upload:{token}:merkle:0'
+		async with conn.pipeline(transaction=True) as pipe:
+			try:
+				await pipe.watch(digests_key)
+				digests = await pipe.get(digests_key) or b''
+				levels = len(level_sizes(len(digests) // DIGEST_SIZE)) + 1 # the partial levels too
+
+				pipe.multi()
+				await release_blocks(pipe, digests)
+				pipe.delete(*[f'upload:{token}:merkle:{level}' for level in range(levels)])
+				pipe.zrem(UPLOADS, token)
+				await pipe.execute()
+				reaped += 1
+			except redis.WatchError:
+				continue
+	return reaped
+
+@app.post("/upload_payload_stream/")
+async def upload_payload_stream(request: Request):
+	"""
+		- Same as /upload_payload, but the request body is the payload itself (utf-8 text) and is read as
+		it arrives instead of being parsed into a StringPayload first. Meant for payloads of several MB,
+		memory use on the tracker stays around STREAM_BLOCK characters whatever the payload size.
+	"""
+	decoder = codecs.getincrementaldecoder('utf-8')()
+	stream = PayloadStream()
+	pending, size = [], 0
+	try:
+		async for piece in request.stream():
+			text = decoder.decode(piece)
+			pending.append(text)
+			size += len(text)
+			if size >= STREAM_BLOCK:
+				await stream.write_block(''.join(pending))
+				pending, size = [], 0
+		pending.append(decoder.decode(b'', final=True))
+		await stream.write_block(''.join(pending), last=True)
+		payloadId = await stream.commit()
+	except UnicodeDecodeError:
+		await stream.discard()
+		raise HTTPException(status_code=400, detail="The payload is not valid utf-8")
+	except BaseException:
+		# Cancelled too (the client went away), reap_uploads is only for a tracker that died
+		await asyncio.shield(stream.discard())
+		raise
+	return {'payloadId': payloadId}
+
+async def read_digests(payloadId, start=0, end=None):
+	"""
+		- The packed digests of the chunks start..end-1 of a payload (all of them if end is None), with one
+		GET or GETRANGE on merkle:payloadId:0.
+		- The digests of a payload that is still in the chunks:payloadId hash are read with HMGET on the
+		known field names, or HGETALL for all of them, and packed here.
+	"""
+	key = f'merkle:{payloadId}:0'
+	if end is not None and end <= start:
+		return b''
+	pipe = conn.pipeline(transaction=False)
+	pipe.exists(key)
+	if end is not None:
+		pipe.getrange(key, start * DIGEST_SIZE, end * DIGEST_SIZE - 1)
+	elif start:
+		pipe.getrange(key, start * DIGEST_SIZE, -1)
+	else:
+		pipe.get(key)
+	packed, digests = await pipe.execute()
+	if packed:
+		return digests
+
+	if end is None:
+		chunks = await conn.hgetall(f'chunks:{payloadId}')
+		hashes = [chunks[k] for k in sorted(chunks, key=int)][start:]
+	else:
+		pipe = conn.pipeline(transaction=False)
+		for first in range(start, end, HSET_BATCH):
+			pipe.hmget(f'chunks:{payloadId}', [str(i) for i in range(first, min(end, first + HSET_BATCH))])
+		hashes = [h for batch in await pipe.execute() for h in batch]
+	return bytes.fromhex(b''.join(hashes).decode())
+
+async def read_chunks(payloadId, start, end):
+	"""
+		- The chunk hashes start..end-1 of a payload in order, as hex
+	"""
+	return split_hex((await read_digests(payloadId, start, end)).hex())
+
+async def read_stored(payloadId, start, end, ascii=False):
+	"""
+		- The bytes of the chunks start..end-1 of a payload, put together from the store blocks that cover
+		them. The blocks are cut in bytes for an ascii payload, in characters for the others.
+	"""
+	first, last = start // STORE_BLOCK, -(-end // STORE_BLOCK)
+	digests = split_digests(block_digests(await read_digests(payloadId, first * STORE_BLOCK, last * STORE_BLOCK)))
+	pipe = conn.pipeline(transaction=False)
+	for i in range(0, len(digests), HSET_BATCH):
+		pipe.hmget(BLOCK_STORE, digests[i:i + HSET_BATCH])
+	data = b''.join([block for batch in await pipe.execute() for block in batch])
+
+	skip, size = (start - first * STORE_BLOCK) * CHUNK_SIZE, (end - start) * CHUNK_SIZE
+	if not skip and len(data) <= size:
+		return data
+	if ascii:
+		return data[skip:skip + size]
+	return data.decode()[skip:skip + size].encode()
+
+async def read_claimed(payloadId, first=0, last=-1, ascii=False, chars=False):
+	"""
+		- Bytes first..last (inclusive, GETRANGE style) of the claimed string of a payload, or characters
+		first..last with chars=True.
+		- Only the chunks covering the range are read from the block store when the payload is ascii or
+		the range is in characters, a chunk is a fixed number of characters. A byte range of any other
+		payload needs all of its chunks.
+		- Payloads uploaded before the block store keep the claimed string in claimed:payloadId, read with
+		GETRANGE, or in hash:payloadId, read whole and sliced here.
+	"""
+	pipe = conn.pipeline(transaction=False)
+	pipe.hmget(f'hash:{payloadId}', 'claimedString', 'chunkCount')
+	pipe.exists(f'claimed:{payloadId}')
+	pipe.getrange(f'claimed:{payloadId}', first, last)
+	(claimedString, count), claimed, part = await pipe.execute()
+
+	if claimedString is None and not claimed:
+		start, end = 0, int(count)
+		if ascii or chars:
+			start = first // CHUNK_SIZE
+			end = end if last == -1 else min(end, last // CHUNK_SIZE + 1)
+		claimedString = await read_stored(payloadId, start, end, ascii)
+		first -= start * CHUNK_SIZE
+		last = last if last == -1 else last - start * CHUNK_SIZE
+	elif claimedString is None and (ascii or not chars):
+		return part if not chars else part.decode()
+	elif claimedString is None:
+		claimedString = await conn.get(f'claimed:{payloadId}')
+
+	if chars:
+		claimedString = claimedString.decode()
+	return claimedString[first:] if last == -1 else claimedString[first:last + 1]
 
 @app.post("/get_payload/")
-async def get_payload(payload_id: PayloadId):
+async def get_payload(payload_id: PayloadId, request: Request, response: Response):
+	"""
+		- The chunk hashes, in order, the claimed string and the root hashes of a payload.
 
-	if not conn.sismember('list:payloads',payload_id.id):
+		- start/end select a range of chunks, only those chunk hashes and the part of the claimed string
+		they cover are returned. offset/length select a range of bytes of the claimed string, no chunk
+		hashes are returned then. A range past the end of the payload is cut short, a range that is
+		negative or splits a utf-8 character gets {'valid_range': False}.
+
+		- A payload never changes once it is uploaded, its rootHash is used as the ETag. A request with a
+		matching If-None-Match header gets an empty 304 response.
+	"""
+	payloadId = payload_id.id
+	pipe = conn.pipeline(transaction=False)
+	pipe.sismember(PAYLOAD_LIST, payloadId)
+	pipe.hmget(f'hash:{payloadId}', 'rootHash', 'ascii')
+	present, (rootHash, ascii) = await pipe.execute()
+	if not present:
 		return {'valid_payload': False}
-		
-	chunks = conn.hgetall(f'chunks:{payload_id.id}')
-	message = {"chunks": []}
-	for key, value in chunks.items():
-		message["chunks"].append(value.decode())
-
-	message["rootHash"] = conn.hget(f'hash:{payload_id.id}', 'rootHash').decode()
-	message["claimedString"] = conn.hget(f'hash:{payload_id.id}', 'claimedString').decode()
-	
+
+	etag = f'"{rootHash.decode()}"'
+	if_none_match = request.headers.get('if-none-match', '')
+	if if_none_match.strip() == '*' or etag in if_none_match:
+		return Response(status_code=304, headers={'ETag': etag})
+	response.headers['ETag'] = etag
+
+	merkleRoot, count = await ensure_merkle(payloadId)
+	message = {"rootHash": rootHash.decode(), "merkleRoot": merkleRoot, "chunkCount": count}
+	ascii = ascii == b'1'
+
+	if payload_id.offset is not None or payload_id.length is not None:
+		if payload_id.start is not None or payload_id.end is not None:
+			return {'valid_range': False, 'chunkCount': count}
+		offset, length = payload_id.offset or 0, payload_id.length
+		if offset < 0 or (length is not None and length < 0):
+			return {'valid_range': False, 'chunkCount': count}
+		last = -1 if length is None else offset + length - 1
+		part = b'' if length == 0 else await read_claimed(payloadId, offset, last, ascii=ascii)
+		try:
+			message["claimedString"] = part.decode()
+		except UnicodeDecodeError:
+			return {'valid_range': False, 'chunkCount': count}
+		message["offset"], message["length"] = offset, len(part)
+		return message
+
+	start = 0 if payload_id.start is None else payload_id.start
+	end = count if payload_id.end is None else min(payload_id.end, count)
+	if start < 0 or end < start:
+		return {'valid_range': False, 'chunkCount': count}
+
+	message["chunks"] = await read_chunks(payloadId, start, end)
+	if payload_id.start is None and payload_id.end is None:
+		message["claimedString"] = await read_claimed(payloadId, chars=True)
+	elif end > start:
+		message["claimedString"] = await read_claimed(payloadId, start * CHUNK_SIZE, end * CHUNK_SIZE - 1,
+			ascii=ascii, chars=True)
+	else:
+		message["claimedString"] = ''
+	message["start"], message["end"] = start, end
 	return message
 
-@app.get("/get_peers/")
-async def get_peers():
-	connected_peers = conn.smembers('list:peers')
-	print(connected_peers)
+async def ensure_merkle(payloadId):
+	"""
+		- Return the merkle root and chunk count of a payload.
+		- Payloads uploaded before the merkle trees were added get their tree built on first use, their
+		chunk digests move from chunks:payloadId to merkle:payloadId:0 with it.
+	"""
+	root, count = await conn.hmget(f'hash:{payloadId}', 'merkleRoot', 'chunkCount')
+	if root is not None:
+		return root.decode(), int(count)
+
+	leaves = split_digests(await read_digests(payloadId))
+	levels = await run_in_threadpool(merkle_levels, leaves)
+	pipe = conn.pipeline(transaction=True)
+	store_merkle(pipe, payloadId, levels)
+	pipe.hset(f'hash:{payloadId}', 'chunks', f'merkle:{payloadId}:0')
+	pipe.delete(f'chunks:{payloadId}')
+	await pipe.execute()
+	return (levels[-1][0].hex() if leaves else ''), len(leaves)
+
+@app.post("/get_proof/")
+async def get_proof(query: ProofQuery):
+	"""
+		- Inclusion proof of a single chunk: one sibling digest per level of the merkle tree, read with
+		one pipeline of O(log n) GETRANGE calls.
+		- A peer holding the chunk can check it against merkleRoot without the rest of the payload.
+	"""
+	if not await conn.sismember(PAYLOAD_LIST, query.id):
+		return {'valid_payload': False}
+
+	merkleRoot, count = await ensure_merkle(query.id)
+	if not 0 <= query.index < count:
+		return {'valid_payload': True, 'valid_index': False, 'chunkCount': count}
+
+	path = list(proof_path(query.index, count))
+	pipe = conn.pipeline(transaction=False)
+	for level, sibling, _ in path:
+		pipe.getrange(f'merkle:{query.id}:{level}', sibling * DIGEST_SIZE, (sibling + 1) * DIGEST_SIZE - 1)
+	nodes = await pipe.execute()
+	if path and path[0][0] == 0 and not nodes[0]:
+		# The chunk digests of the payload are still in chunks:payloadId
+		nodes[0] = await read_digests(query.id, path[0][1], path[0][1] + 1)
+	proof = [node.hex() for node in nodes]
+
+	return {
+		'payloadId': query.id,
+		'index': query.index,
+		'chunkCount': count,
+		'proof': proof,
+		'merkleRoot': merkleRoot,
+	}
+
+@app.delete("/delete_payload/")
+async def delete_payload(payload_id: PayloadId):
+	"""
+		- Remove a payload and drop its references to the block store, the blocks that no other payload
+		references go with it. Returns the number of bytes freed in the store.
+		- hash:payloadId is watched while the chunk digests are read, if another request deletes the payload
+		in the meantime the transaction fails and the deletion starts over, so references are only dropped once.
+	"""
+	payloadId = payload_id.id
+	keys = [f'hash:{payloadId}', f'chunks:{payloadId}', f'claimed:{payloadId}']
+	while True:
+		async with conn.pipeline(transaction=True) as pipe:
+			try:
+				await pipe.watch(keys[0])
+				if not await pipe.sismember(PAYLOAD_LIST, payloadId):
+					return {'valid_payload': False}
+				count, rootHash = await pipe.hmget(keys[0], 'chunkCount', 'rootHash')
+				count = int(count or 0) # no merkle tree without it
+				unindex = rootHash is not None and is_legacy_id(payloadId)
+				legacy = await pipe.exists(keys[2]) or await pipe.hexists(keys[0], 'claimedString')
+				digests = b'' if legacy else await read_digests(payloadId)
+
+				pipe.multi()
+				await release_blocks(pipe, digests)
+				pipe.delete(*keys, *[f'merkle:{payloadId}:{level}' for level in range(len(level_sizes(count)))])
+				pipe.srem(PAYLOAD_LIST, payloadId)
+				if unindex:
+					pipe.hdel(PAYLOAD_HASH_INDEX, rootHash)
+				results = await pipe.execute()
+			except redis.WatchError:
+				continue
+		freed = sum(results[:-3 if unindex else -2])
+		return {'payloadId': payloadId, 'freedBytes': freed}
+
+@app.get("/dedup_report")
+async def dedup_report():
+	"""
+		- What the block store saves: the bytes of the blocks referenced by the payloads (logicalBytes) and
+		the bytes of the distinct blocks it holds (storedBytes), with their ratio.
+		- storeMemory is the Redis memory of the store keys (MEMORY USAGE, an estimate from MEMORY_SAMPLES
+		fields), what the store really costs. bytesSaved compares it with logicalBytes, which is what the
+		same payloads would take as claimed strings at the very least, and is negative when the store costs more.
+		- Payloads uploaded before the block store are not counted.
+	"""
+	pipe = conn.pipeline(transaction=False)
+	pipe.hmget(DEDUP_STATS, 'logicalBytes', 'storedBytes')
+	pipe.hlen(BLOCK_STORE)
+	pipe.memory_usage(BLOCK_STORE, samples=MEMORY_SAMPLES)
+	pipe.memory_usage(BLOCK_REFS, samples=MEMORY_SAMPLES)
+	(logical, stored), blocks, data, refs = await pipe.execute()
+	logical, stored, memory = int(logical or 0), int(stored or 0), (data or 0) + (refs or 0)
+	return {
+		'logicalBytes': logical,
+		'storedBytes': stored,
+		'storeMemory': memory,
+		'bytesSaved': logical - memory,
+		'dedupRatio': logical / memory if memory else 1.0,
+		'distinctBlocks': blocks,
+	}
+
+class PeerWatch:
+	"""
+		- Wakes up the /get_peers long-polls when the peer list changes. A single subscription to
+		PEER_CHANNEL per tracker process, each change replaces the changed event and sets the old one, so
+		every request that was waiting on it checks for changes again.
+	"""
+
+	def __init__(self):
+		self.changed = asyncio.Event()
+		self.task = None
+
+	def start(self):
+		self.task = asyncio.ensure_future(self.run())
+
+	async def stop(self):
+		self.task.cancel()
+		try:
+			await self.task
+		except asyncio.CancelledError:
+			pass
+
+	def notify(self):
+		changed, self.changed = self.changed, asyncio.Event()
+		changed.set()
+
+	async def run(self):
+		while True:
+			pubsub = conn.pubsub()
+			try:
+				await pubsub.subscribe(PEER_CHANNEL)
+				while True:
+					if await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0) is not None:
+						self.notify()
+			except redis.RedisError as e:
+				logger.warning(f"Lost the subscription to {PEER_CHANNEL}: {e}")
+				# Changes may have been missed while reconnecting
+				self.notify()
+				await asyncio.sleep(1)
+			finally:
+				await pubsub.aclose()
+
+async def peer_snapshot():
+	"""
+		- (version, {peer_id: {'hostaddr', 'port'}}) of every registered peer, with one round trip for the
+		list and one for the peers
+	"""
+	pipe = conn.pipeline()
+	pipe.get(PEER_VERSION)
+	pipe.smembers(PEER_LIST)
+	version, peer_ids = await pipe.execute()
+	peer_ids = [p.decode() for p in peer_ids]
+	pipe = conn.pipeline(transaction=False)
+	for peer_id in peer_ids:
+		pipe.hgetall(f"peer:{peer_id}")
 	data = {}
-	for peer in connected_peers:
-		data[peer.decode()] = conn.hgetall(f"peer:{peer.decode()}")
-	return data
+	for peer_id, peer in zip(peer_ids, await pipe.execute()):
+		# A peer deregistered in between has no hash left
+		if peer:
+			data[peer_id] = {k.decode(): v.decode() for k, v in peer.items()}
+	return int(version or 0), data
+
+async def peer_delta(since):
+	"""
+		- The changes to the peer list after version since, folded into {'version', 'full', 'added',
+		'removed'}: added maps the peers registered since then to their address and removed lists the
+		peers that are gone.
+		- If the changes are no longer all in PEER_CHANGES, full is True and added has every peer.
+	"""
+	pipe = conn.pipeline()
+	pipe.get(PEER_VERSION)
+	pipe.zrange(PEER_CHANGES, 0, 0, withscores=True)
+	pipe.zrangebyscore(PEER_CHANGES, f"({since}", "+inf")
+	version, oldest, changes = await pipe.execute()
+	version = int(version or 0)
+	if since > version or (since < version and (not oldest or oldest[0][1] > since + 1)):
+		version, peers = await peer_snapshot()
+		return {'version': version, 'full': True, 'added': peers, 'removed': []}
+
+	added, removed = {}, set()
+	for change in changes:
+		change = json.loads(change)
+		if change[1] == '+':
+			added[change[2]] = {'hostaddr': change[3], 'port': change[4]}
+			removed.discard(change[2])
+		else:
+			added.pop(change[2], None)
+			removed.add(change[2])
+	return {'version': version, 'full': False, 'added': added, 'removed': sorted(removed)}
+
+@app.get("/get_peers/")
+async def get_peers(response: Response, since: Optional[int] = None, wait: float = 0):
+	"""
+		- Without since, every registered peer as {peer_id: {'hostaddr', 'port'}}, the version of the list
+		is in the X-Peers-Version header.
+		- With since, only the changes after that version, see peer_delta. If there are none the request
+		waits up to wait seconds (at most MAX_PEER_WAIT) for one before answering.
+	"""
+	if since is None:
+		version, data = await peer_snapshot()
+		response.headers[PEER_VERSION_HEADER] = str(version)
+		return data
+
+	loop = asyncio.get_running_loop()
+	deadline = loop.time() + min(max(wait, 0), MAX_PEER_WAIT)
+	while True:
+		# Take the event before reading the changes, so a change in between is not missed
+		changed = peer_watch.changed
+		delta = await peer_delta(since)
+		remaining = deadline - loop.time()
+		if delta['version'] != since or remaining <= 0:
+			return delta
+		try:
+			await asyncio.wait_for(changed.wait(), remaining)
+		except asyncio.TimeoutError:
+			pass
+
+@app.get("/metrics")
+async def metrics():
+	"""
+		- The latency histograms of the tracker and the number of peers and payloads, in the Prometheus
+		text format
+	"""
+	pipe = conn.pipeline(transaction=False)
+	pipe.scard(PEER_LIST)
+	pipe.scard(PAYLOAD_LIST)
+	peers, payloads = await pipe.execute()
+	lines = [
+		"# TYPE tracker_peers gauge",
+		f"tracker_peers {peers}",
+		"# TYPE tracker_payloads gauge",
+		f"tracker_payloads {payloads}",
+	]
+	return PlainTextResponse('\n'.join(lines) + '\n' + stats.prometheus(),
+		media_type="text/plain; version=0.0.4")
 
 @app.delete("/deregister")
 async def deregister_peer(peer: Peer):
@@ -157,13 +1258,12 @@ async def deregister_peer(peer: Peer):
 		- if so, then check for the host addr and port verification 
 		- if true then delete its entry from list of peers and also delete the peers hash
 	"""
-	connected_peers = conn.smembers('list:peers')
-	if f"{peer.peer_id}".encode() in connected_peers:
-		data = conn.hgetall(f"peer:{peer.peer_id}")
-		if data[b'hostaddr'].decode() == peer.hostaddr and data[b'port'].decode() == peer.port:
-			conn.delete('peer:{peer.peer_id}')
-			conn.srem('list:peers', f'{peer.peer_id}')
-			return {"message": f"The Peer {peer.peer_id} has been successfully deregistered"}
+	args = [peer.peer_id, peer.address, '', '', PEER_CHANGES_SIZE, PEER_CHANNEL]
+	removed = await deregister_script(keys=peer_keys(peer.peer_id), args=args)
+	if removed == 1:
+		return {"message": f"The Peer {peer.peer_id} has been successfully deregistered"}
+	elif removed == 0:
+		return {"message": f"The Peer {peer.peer_id} is registered at another address"}
 	else:
 		return {"message": "Peer not found"}
 	
@@ -0,0 +1,87 @@
+"""
+	- HTTP clients for the calls of a peer to the tracker.
+
+	- The module level requests.get/post open a new TCP connection for every call. TrackerClient keeps
+	a requests.Session with a pool of keep-alive connections instead, so a peer (or every peer of a
+	process, with shared_client()) reuses the same few connections to the tracker. The pool size and
+	the timeouts come from P2P_TRACKER_* and can be set per client.
+
+	- AsyncTrackerClient is the same on an httpx.AsyncClient, for peers driven from an event loop. httpx
+	is only needed when it is used.
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+	import httpx
+except ImportError:
+	httpx = None
+
+TRACKER_POOL_SIZE = int(os.environ.get("P2P_TRACKER_POOL_SIZE", 10))
+TRACKER_CONNECT_TIMEOUT = float(os.environ.get("P2P_TRACKER_CONNECT_TIMEOUT", 5))
+TRACKER_READ_TIMEOUT = float(os.environ.get("P2P_TRACKER_READ_TIMEOUT", 60))
+
+
+class TrackerClient:
+
+	def __init__(self, pool_size=TRACKER_POOL_SIZE, connect_timeout=TRACKER_CONNECT_TIMEOUT,
+			read_timeout=TRACKER_READ_TIMEOUT):
+		"""
+			args:
+				pool_size - Keep-alive connections kept open per tracker, more concurrent calls than that
+				open extra connections that are closed after use
+				connect_timeout - Seconds to wait for a connection to the tracker
+				read_timeout - Seconds to wait for the tracker between two reads of a response
+		"""
+		self.timeout = (connect_timeout, read_timeout)
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		return self.session.request(method, url, **kwargs)
+
+	def close(self):
+		self.session.close()
+
+
+class AsyncTrackerClient:
+
+	def __init__(self, pool_size=TRACKER_POOL_SIZE, connect_timeout=TRACKER_CONNECT_TIMEOUT,
+			read_timeout=TRACKER_READ_TIMEOUT):
+		"""
+			- Same arguments as TrackerClient, raises RuntimeError if httpx is not installed
+		"""
+		if httpx is None:
+			raise RuntimeError("AsyncTrackerClient needs httpx (pip install httpx)")
+		self.client = httpx.AsyncClient(
+			limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+			timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+		)
+
+	async def request(self, method, url, **kwargs):
+		return await self.client.request(method, url, **kwargs)
+
+	async def close(self):
+		await self.client.aclose()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_client():
+	"""
+		- The TrackerClient shared by every peer of the process that is not given its own
+	"""
+	global _shared
+	if _shared is None:
+		with _shared_lock:
+			if _shared is None:
+				_shared = TrackerClient()
+	return _shared
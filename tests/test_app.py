@@ -1,4 +1,21 @@
-from node import Node
+import asyncio
+import io
+import json
+import random
+import string
+import threading
+import time
+
+import pytest
+import redis
+import requests
+
+from node import Node, SEVERITY
+from hashing import CHUNK_SIZE, generate_hashes
+from merkle import DIGEST_SIZE, merkle_levels
+from framing import CAPABILITY_BINARY_CLAIMS, MSG_CLAIMS
+import migrate_chunks
+import server
 
 def test_f():
 	print("Started testing")
@@ -14,3 +31,360 @@ def test_f():
 	a.kill()
 	b.kill()
 
+
+def test_pipelined_verification():
+	a = Node('127.0.0.1', 1062)
+	a.daemon = True
+	a.start()
+	b = Node('127.0.0.1', 1063, use_asyncio=True)
+	b.daemon = True
+	b.start()
+	c = Node('127.0.0.1', 1064)
+	for peer in (a, b, c):
+		peer.available_payloads['payload_test'] = 'abcdefghijklmnopqrstuvwxyzEOM' * 10
+
+	for target in (a, b):
+		channel = c.connect_to_node(target.host, target.port)
+		assert c.connect_to_node(target.host, target.port) is channel
+		futures = [c.request_verification('payload_test', peer_id=channel.target_id) for _ in range(20)]
+		for f in futures:
+			assert all(f.result(5)['results'])
+		# Requests the peer fails on are answered with an error, not left waiting
+		for bad, msg_type in [({'payloadId': 'payload_test'}, MSG_CLAIMS),
+				({'payloadId': 'payload_test', 'claims': [{'chunk': 'a', 'position': 10 ** 6}]}, MSG_CLAIMS),
+				({'version': None}, 99)]:
+			with pytest.raises(ValueError):
+				channel.request(json.dumps(bad), msg_type).result(5)
+		assert all(c.verify_payload('payload_test', peer_id=channel.target_id)['results'])
+
+	# Framed peers without binary claims get JSON claims
+	a.binary_claims = False
+	c.connected_peers.clear()
+	channel = c.connect_to_node(a.host, a.port)
+	assert channel.framed and CAPABILITY_BINARY_CLAIMS not in channel.capabilities
+	results = c.verify_payload('payload_test', [1, 0, 2, 3])['results']
+	assert isinstance(results, list) and results == [False, False, True, True]
+
+	# Old peers only speak EOM, one connection per verification
+	c.framing = False
+	c.connected_peers.clear()
+	c.connect_to_node(a.host, a.port)
+	assert all(c.verify_payload('payload_test')['results'])
+
+	for peer in (a, b, c):
+		peer.kill()
+
+def test_chunk_proofs():
+	a = Node._build_and_run(port=1065)
+	payload = 'merkle proofs for every chunk!'
+	a.upload_payload(payload)
+	payloadId = a.payload_sent[-1]
+
+	chunks = [payload[i:i+CHUNK_SIZE] for i in range(0, len(payload), CHUNK_SIZE)]
+	for i, chunk in enumerate(chunks):
+		assert a.verify_chunk(payloadId, i, chunk)
+	assert not a.verify_chunk(payloadId, 1, chunks[0])
+	assert not a.verify_chunk(payloadId, len(chunks), 'x' * CHUNK_SIZE)
+
+	a.kill()
+
+def test_streamed_upload():
+	a = Node._build_and_run(port=1066)
+	payload = ''.join(random.choices(string.ascii_letters + 'é✓', k=1200000))
+	data = payload.encode()
+	# pieces that split the multi-byte characters
+	payloadId = a.upload_payload_stream(data[i:i+99991] for i in range(0, len(data), 99991))
+	assert a.available_payloads[payloadId] == payload
+
+	conn = redis.StrictRedis()
+	hashes, full_hash = generate_hashes(payload)
+	assert not conn.exists(f'claimed:{payloadId}')
+	assert a.querry_payload_range(payloadId, offset=0)['claimedString'] == payload
+	assert conn.hget(f'hash:{payloadId}', 'rootHash').decode() == full_hash
+	assert conn.strlen(f'merkle:{payloadId}:0') == len(hashes) * DIGEST_SIZE
+	assert conn.getrange(f'merkle:{payloadId}:0', -DIGEST_SIZE, -1).hex() == hashes[-1]
+	merkleRoot = merkle_levels([bytes.fromhex(h) for h in hashes])[-1][0].hex()
+	assert conn.hget(f'hash:{payloadId}', 'merkleRoot').decode() == merkleRoot
+	chunks = [payload[i:i+CHUNK_SIZE] for i in range(0, len(payload), CHUNK_SIZE)]
+	assert a.verify_chunk(payloadId, 12345, chunks[12345])
+
+	a.upload_payload(payload)
+	assert a.payload_sent == [payloadId]
+	small = 'small payload ' + ''.join(random.choices(string.ascii_letters, k=8))
+	assert a.upload_payload_stream(io.StringIO(small), keep=False) == server.derive_id(generate_hashes(small)[1])
+
+	a.kill()
+
+def test_payload_ranges():
+	a = Node._build_and_run(port=1067)
+	payload = 'ranged and conditional payload queries ' * 5
+	a.upload_payload(payload)
+	payloadId = a.payload_sent[-1]
+	hashes, _ = generate_hashes(payload)
+
+	full = a.querry_payload(payloadId)
+	assert full['chunks'] == hashes
+	assert full['claimedString'] == payload
+
+	part = a.querry_payload_range(payloadId, start=3, end=7)
+	assert part['chunks'] == hashes[3:7]
+	assert part['claimedString'] == payload[3 * CHUNK_SIZE:7 * CHUNK_SIZE]
+	assert a.querry_payload_range(payloadId, start=40, end=1000)['chunks'] == hashes[40:]
+	assert a.querry_payload_range(payloadId, offset=10, length=25)['claimedString'] == payload[10:35]
+	assert a.querry_payload_range(payloadId, start=-1)['valid_range'] is False
+
+	again = a.querry_payload(payloadId)
+	assert again['notModified'] and again['claimedString'] == payload
+
+	a.kill()
+
+def test_metrics():
+	a = Node('127.0.0.1', 1068)
+	before = a.metrics(SEVERITY.VERIFY_CLAIM, ignore_id=True)['VERIFY_CLAIM']
+	for _ in range(3):
+		a.log_activities('verify', SEVERITY.VERIFY_CLAIM)
+	metrics = a.metrics()
+	assert metrics['VERIFY_CLAIM'] == 3 and metrics['PEER_INTIALIZED'] == 1 and metrics['KILL'] == 0
+	assert a.metrics([SEVERITY.VERIFY_CLAIM], ignore_id=True) == {'VERIFY_CLAIM': before + 3}
+
+	a.register_peer("http://127.0.0.1:8000")
+	latency = a.metrics(percentiles=True)['LATENCY']
+	assert latency['tracker_request_seconds']['{path="/register/"}']['count'] == 1
+	text = requests.get(f"{a.tracker}/metrics").text
+	assert 'tracker_http_request_seconds_count{method="POST",path="/register/",status="200"}' in text
+	a.kill()
+
+
+def test_peer_sync():
+	a = Node('127.0.0.1', 1069)
+	a.register_peer("http://127.0.0.1:8000")
+	assert a.id in a.sync_peers() and a.peers_version is not None
+	version = a.peers_version
+
+	b = Node('127.0.0.1', 1070)
+	b.register_peer("http://127.0.0.1:8000")
+	assert a.sync_peers()[b.id] == {'hostaddr': '127.0.0.1', 'port': '1070'}
+	assert a.peers_version == version + 1
+
+	# Nothing changed: the long-poll waits, then the deregistration of b wakes it up
+	start = time.time()
+	threading.Timer(0.5, b.kill).start()
+	assert b.id not in a.sync_peers(wait=10)
+	assert 0.4 < time.time() - start < 5
+	assert a.sync_peers() == a.get_peers()
+	a.kill()
+
+
+def test_gossip():
+	nodes = []
+	for port in range(1071, 1076):
+		# Every peer starts from the list it got when it joined, only the last one has all of them
+		nodes.append(Node._build_and_run(port=port))
+		nodes[-1].get_peers()
+	assert len({node.peers_version for node in nodes}) == len(nodes)
+	live = nodes[0].connect_to_node(nodes[1].host, nodes[1].port)
+	for node in nodes:
+		node.start_gossip(interval=0.1, tracker_interval=None)
+	latest = max(node.peers_version for node in nodes)
+	ids = {node.id for node in nodes}
+
+	deadline = time.time() + 10
+	while time.time() < deadline and not all(node.peers_version == latest for node in nodes):
+		time.sleep(0.05)
+	for node in nodes:
+		assert node.peers_version == latest and ids <= set(node.peer_list)
+		# One request for the whole list, everything after that came from the other peers
+		assert node.metrics(percentiles=True)['LATENCY']['tracker_request_seconds']['{path="/get_peers/"}']['count'] == 1
+	# Gossip does not take over the channel verify_payload uses
+	assert nodes[0].live_channel is live and all(node.live_channel is None for node in nodes[2:])
+	for node in nodes:
+		node.kill()
+
+
+def test_peer_leases():
+	conn = redis.StrictRedis()
+	a = Node._build_and_run(port=1076)
+	assert a.lease_ttl
+	# Registering starts the thread that renews the lease, only one of them
+	assert a._heartbeat_thread.is_alive() and a.start_heartbeat() is a._heartbeat_thread
+	expiry = conn.zscore('leases:peers', a.id)
+	time.sleep(0.01)
+	assert a.heartbeat() == 1 and conn.zscore('leases:peers', a.id) > expiry
+
+	# A peer that stops renewing its lease is reaped, its next heartbeat registers it again
+	conn.zadd('leases:peers', {a.id: 0})
+	deadline = time.time() + 5
+	while time.time() < deadline and conn.sismember('list:peers', a.id):
+		time.sleep(0.1)
+	assert a.id not in a.get_peers() and conn.zscore('leases:peers', a.id) is None
+	assert a.heartbeat() == 0 and a.id in a.get_peers()
+	a.kill()
+	assert conn.zscore('leases:peers', a.id) is None
+
+
+def test_verify_payload_many():
+	payload = 'quorum of peers for every chunk'
+	peers = [Node('127.0.0.1', port) for port in range(1077, 1081)]
+	for peer in peers:
+		peer.daemon = True
+		peer.start()
+	a, others = peers[0], peers[1:]
+	a.available_payloads['payload_quorum'] = payload
+	others[0].available_payloads['payload_quorum'] = payload
+	others[1].available_payloads['payload_quorum'] = payload
+	# The last peer holds a copy with chunk 1 changed
+	others[2].available_payloads['payload_quorum'] = payload[:CHUNK_SIZE] + 'X' * CHUNK_SIZE + payload[2 * CHUNK_SIZE:]
+	ids = [a.connect_to_node(peer.host, peer.port).target_id for peer in others]
+
+	outcome = a.verify_payload_many('payload_quorum', peer_ids=ids)
+	assert outcome['valid'] and all(outcome['results'])
+
+	outcome = a.verify_payload_many('payload_quorum', peer_ids=ids, quorum=3)
+	assert not outcome['valid'] and outcome['results'][1] is False and outcome['results'][0] is True
+	assert outcome['peers'] == dict.fromkeys(ids, 'checked')
+
+	del others[0].available_payloads['payload_quorum']
+	outcome = a.verify_payload_many('payload_quorum', peer_ids=ids, quorum=3)
+	assert outcome['peers'][ids[0]] == 'unavailable' and outcome['results'][0] is False
+	for peer in peers:
+		peer.kill()
+
+
+def test_block_dedup():
+	a = Node._build_and_run(port=1081)
+	report = lambda: requests.get(f"{a.tracker}/dedup_report").json()
+	before = report()
+	block = server.STORE_BLOCK * CHUNK_SIZE # characters
+
+	# CJK characters, so that no block is already in the store
+	letters = lambda k: ''.join(chr(random.randrange(0x4e00, 0x9fff)) for _ in range(k))
+	base = letters(2 * block)
+	tail = letters(2) + 'æ!'
+	first, second = base, base + tail
+	size = len(base.encode())
+	firstId, secondId = a.upload_payload(first), a.upload_payload(second)
+	assert [firstId, secondId] == a.payload_sent[-2:]
+	after = report()
+	# Only the block of the tail is stored for the second payload
+	assert after['logicalBytes'] - before['logicalBytes'] == 2 * size + len(tail.encode())
+	assert after['storedBytes'] - before['storedBytes'] == size + len(tail.encode())
+	assert after['distinctBlocks'] - before['distinctBlocks'] == 3
+	assert after['storeMemory'] > before['storeMemory']
+
+	repeated = letters(block) * 3
+	a.upload_payload(repeated)
+	assert report()['storedBytes'] - after['storedBytes'] == len(repeated.encode()) // 3
+	assert a.querry_payload_range(a.payload_sent[-1], offset=0)['claimedString'] == repeated
+
+	assert a.delete_payload(firstId) == 0
+	chunks = 2 * server.STORE_BLOCK
+	assert a.querry_payload_range(secondId, start=chunks - 1, end=chunks + 1)['claimedString'] == second[(chunks - 1) * CHUNK_SIZE:]
+	assert a.querry_payload_range(secondId, start=3, end=5)['claimedString'] == second[3 * CHUNK_SIZE:5 * CHUNK_SIZE]
+	assert a.querry_payload_range(secondId, offset=size)['claimedString'] == tail
+	assert a.delete_payload(secondId) == len(second.encode())
+	assert a.delete_payload(secondId) is None
+	assert a.delete_payload(a.payload_sent[-1]) == len(repeated.encode()) // 3
+	now = report()
+	for key in ['logicalBytes', 'storedBytes', 'distinctBlocks']:
+		assert now[key] == before[key]
+	assert a.querry_payload_range(secondId, start=0)['valid_payload'] is False
+
+	a.kill()
+
+
+def test_reap_uploads():
+	conn = redis.StrictRedis()
+	# CJK characters, so that no block is already in the store. The last block is not full yet and
+	# takes no reference until the upload ends.
+	blocks = 3
+	text = ''.join(chr(random.randrange(0x4e00, 0x9fff)) for _ in range((blocks * server.STORE_BLOCK + 1) * CHUNK_SIZE))
+
+	async def abandoned_upload():
+		await server.connect_redis()
+		try:
+			before = await server.dedup_report()
+			stream = server.PayloadStream()
+			await stream.write_block(text)
+			during = await server.dedup_report()
+			# As if the tracker had died before the upload was committed
+			conn.zadd(server.UPLOADS, {stream.token: 0})
+			assert await server.reap_uploads() >= 1
+			return before, during, await server.dedup_report(), stream.token
+		finally:
+			await server.close_redis()
+
+	before, during, after, token = asyncio.run(abandoned_upload())
+	stored = len(text[:blocks * server.STORE_BLOCK * CHUNK_SIZE].encode())
+	assert during['storedBytes'] - before['storedBytes'] == stored
+	assert during['distinctBlocks'] - before['distinctBlocks'] == blocks
+	for key in ['logicalBytes', 'storedBytes', 'distinctBlocks']:
+		assert after[key] == before[key]
+	assert not conn.keys(f'upload:{token}:*') and conn.zscore(server.UPLOADS, token) is None
+
+
+def test_packed_chunk_digests():
+	a = Node._build_and_run(port=1082)
+	conn = redis.StrictRedis()
+	payload = ''.join(random.choices(string.ascii_letters, k=50 * CHUNK_SIZE + 1))
+	hashes, full_hash = generate_hashes(payload)
+	chunks = [payload[i:i+CHUNK_SIZE] for i in range(0, len(payload), CHUNK_SIZE)]
+
+	# A payload stored with a legacy Id and its chunk hashes in a chunks:payloadId hash
+	payloadId = 'payload_' + ''.join(random.choices(string.ascii_uppercase[:25], k=12))
+	levels = merkle_levels([bytes.fromhex(h) for h in hashes])
+	conn.hset(f'chunks:{payloadId}', mapping={str(i): h for i, h in enumerate(hashes)})
+	for level, nodes in enumerate(levels[1:], start=1):
+		conn.set(f'merkle:{payloadId}:{level}', b''.join(nodes))
+	conn.hset(f'hash:{payloadId}', mapping={'rootHash': full_hash, 'merkleRoot': levels[-1][0].hex(),
+		'chunkCount': len(hashes), 'ascii': 1})
+	conn.set(f'claimed:{payloadId}', payload)
+	conn.sadd('list:payloads', payloadId)
+	conn.hset(server.PAYLOAD_HASH_INDEX, full_hash, payloadId)
+
+	def check():
+		assert a.querry_payload_range(payloadId, start=10, end=20)['chunks'] == hashes[10:20]
+		assert a.querry_payload(payloadId)['chunks'] == hashes
+		assert a.verify_chunk(payloadId, 6, chunks[6]) and a.verify_chunk(payloadId, 50, chunks[50])
+
+	check()
+	migrated = migrate_chunks.migrate(conn)
+	assert migrated[0] >= 1 and migrated[2] < migrated[1]
+	assert not conn.exists(f'chunks:{payloadId}')
+	assert conn.get(f'merkle:{payloadId}:0') == bytes.fromhex(''.join(hashes))
+	a.payload_etags.clear()
+	check()
+
+	# Uploaded again, it keeps its legacy Id
+	async def upload():
+		await server.connect_redis()
+		try:
+			return await server.ingest_payloads([payload, payload + '!'])
+		finally:
+			await server.close_redis()
+	legacyId, newId = asyncio.run(upload())
+	assert legacyId == payloadId and newId == server.derive_id(generate_hashes(payload + '!')[1])
+	assert a.delete_payload(newId) is not None
+
+	assert migrate_chunks.migrate(conn) == (0, 0, 0)
+	assert a.delete_payload(payloadId) == 0
+	assert not conn.keys(f'*{payloadId}*')
+	assert not conn.hexists(server.PAYLOAD_HASH_INDEX, full_hash)
+
+	a.kill()
+
+
+def test_payload_ids():
+	a = Node._build_and_run(port=1083)
+	# Only differ before the last 'd' at every position modulo 12, which got the same 12 letter Id
+	tail = 'd' * 12 + ''.join(random.choices(string.ascii_letters, k=64))
+	payloads = ['x' + tail, 'y' + tail]
+	r = requests.post(f"{a.tracker}/upload_payloads/", json={'payloads': [{'payload': p} for p in payloads * 2]})
+	payloadIds = r.json()['payloadIds']
+	assert payloadIds[:2] == payloadIds[2:]
+	assert payloadIds[:2] == [server.derive_id(generate_hashes(p)[1]) for p in payloads]
+	assert not server.is_legacy_id(payloadIds[0]) and server.is_legacy_id('payload_ABCDEFGHIJKL')
+	assert a.upload_payload_stream(io.StringIO(payloads[0]), keep=False) == payloadIds[0]
+	for payloadId in payloadIds[:2]:
+		assert a.delete_payload(payloadId) is not None
+
+	a.kill()
@@ -0,0 +1,19 @@
+from bloom import BloomFilter
+
+
+def test_added_items_are_found():
+	bloom = BloomFilter(1000)
+	items = [f'payload_{i:032x}' for i in range(1000)]
+	for item in items:
+		bloom.add(item)
+	assert all(item in bloom for item in items)
+	assert len(bloom) == 1000
+
+
+def test_false_positive_rate():
+	bloom = BloomFilter(10000, error_rate=0.01)
+	for i in range(10000):
+		bloom.add(f'in_{i}')
+	false_positives = sum(f'out_{i}' in bloom for i in range(10000))
+	assert false_positives < 200 # about 100 expected
+	assert 'anything' not in BloomFilter(10)
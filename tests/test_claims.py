@@ -0,0 +1,49 @@
+from claims import encode_claims, decode_claims, check_claims, encode_results, decode_results, STATUS_CHECKED
+from claims import CLAIMS_HEADER, _pack
+from payload_cache import ChunkView
+
+
+def check(held, claimed, positions):
+	payloadId, positions, ends, buffer = decode_claims(encode_claims('payload_x', positions, ChunkView(claimed, 4)))
+	assert payloadId == 'payload_x'
+	bitmap = check_claims(ChunkView(held, 4), positions, ends, buffer)
+	return list(decode_results(encode_results(STATUS_CHECKED, len(positions), bitmap))['results'])
+
+
+def reference(held, claimed, positions):
+	held, claimed = ChunkView(held, 4), ChunkView(claimed, 4)
+	return [p < len(held) and held[p] == claimed[i] for i, p in enumerate(positions)]
+
+
+def test_binary_claims():
+	payload = ''.join(chr(65 + i % 26) for i in range(1001))
+	tampered = payload[:400] + 'xyz' + payload[403:]
+	cases = [
+		(payload, payload, range(251)),
+		(payload, tampered, range(251)),
+		(payload, payload, [3, 1, 2, 0, 250, 7]),
+		(payload, payload, [0, 1, 300]),
+		(payload, payload[:-1], range(250)),
+		('héllo wörld ✓ ' * 20, 'héllo wörld ✓ ' * 20, range(70)),
+		('héllo wörld ✓ ' * 20, 'hello world ✓ ' * 20, [5, 4, 3, 2, 1, 0]),
+		(payload, payload, []),
+	]
+	for held, claimed, positions in cases:
+		assert check(held, claimed, positions) == reference(held, claimed, positions)
+
+
+def test_results():
+	results = decode_results(encode_results(STATUS_CHECKED, 10, bytes([0xff, 0xc0])))['results']
+	assert results.all() and results.valid() == 10 and len(results) == 10
+	results = decode_results(encode_results(STATUS_CHECKED, 10, bytes([0xfe, 0xc0])))['results']
+	assert not results.all() and results.valid() == 9 and not results[7]
+
+
+def test_shifted_chunk_ends():
+	# The right bytes cut at other places than the chunks of the payload
+	held = ChunkView('abcdefgh', 4)
+	for ends in ([3, 8], [0, 8], [5, 8]):
+		body = CLAIMS_HEADER.pack(9, 2) + b'payload_x' + _pack([0, 1]) + _pack(ends) + b'abcdefgh'
+		_, positions, ends, buffer = decode_claims(body)
+		bitmap = check_claims(held, positions, ends, buffer)
+		assert list(decode_results(encode_results(STATUS_CHECKED, 2, bitmap))['results']) == [False, False]
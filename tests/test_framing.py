@@ -0,0 +1,83 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from framing import (FrameReader, FrameInfo, FrameTooLarge, END_BYTE, LEGACY_FRAME, FLAG_RESPONSE, MSG_CLAIMS,
+	FRAME_HEADER, FRAME_MAGIC, MAX_FRAME_SIZE,
+	CAPABILITY_FRAMED, CAPABILITY_BINARY_CLAIMS, send_message, read_message_async, encode_hello, decode_hello,
+	decode_capabilities)
+
+
+def test_frames_and_eom_messages_on_one_socket():
+	a, b = socket.socketpair()
+	big = bytes(range(256)) * 20000
+	messages = [(b'{"a": 1}', True), (b'claimsEM', False), (big, True), (b'', True), (b'x' * 100000, False)]
+
+	def writer():
+		for body, framed in messages:
+			send_message(a, body, framed)
+
+	t = threading.Thread(target=writer)
+	t.start()
+	reader = FrameReader(b, buffer_size=16)
+	for body, framed in messages:
+		data, info = reader.read_message()
+		assert bytes(data) == body
+		assert info.framed == framed
+	t.join()
+	a.close()
+	b.close()
+
+
+def test_async_reader():
+	a, b = socket.socketpair()
+	send_message(a, b'{}', False)
+	send_message(a, b'EOM', False)
+	send_message(a, b'framed', True, request_id=7, flags=FLAG_RESPONSE)
+
+	async def read_all():
+		reader, writer = await asyncio.open_connection(sock=b)
+		messages = [await read_message_async(reader) for _ in range(3)]
+		writer.close()
+		return messages
+
+	assert asyncio.run(read_all()) == [(b'{}', LEGACY_FRAME), (b'EOM', LEGACY_FRAME),
+		(b'framed', FrameInfo(True, FLAG_RESPONSE, MSG_CLAIMS, 7))]
+	a.close()
+
+
+def test_frame_too_large():
+	# Only the header is sent, the length in it is never allocated
+	header = FRAME_HEADER.pack(FRAME_MAGIC, 0, MSG_CLAIMS, 1, MAX_FRAME_SIZE + 1)
+	a, b = socket.socketpair()
+	a.sendall(header)
+	with pytest.raises(FrameTooLarge):
+		FrameReader(b).read_message()
+
+	a.sendall(header)
+
+	async def read_one():
+		reader, writer = await asyncio.open_connection(sock=b)
+		try:
+			await read_message_async(reader)
+		finally:
+			writer.close()
+
+	with pytest.raises(FrameTooLarge):
+		asyncio.run(read_one())
+	a.close()
+
+
+def test_hello():
+	assert decode_hello(encode_hello('201018_1', True)) == ('201018_1', True)
+	assert decode_hello(encode_hello('201018_1', False)) == ('201018_1', False)
+	assert END_BYTE not in encode_hello('201018_1')
+
+
+def test_hello_capabilities():
+	hello = encode_hello('201018_1', True, [CAPABILITY_BINARY_CLAIMS])
+	assert decode_capabilities(hello) == ('201018_1', {CAPABILITY_FRAMED, CAPABILITY_BINARY_CLAIMS})
+	assert decode_hello(hello) == ('201018_1', True)
+	assert decode_capabilities(encode_hello('201018_1', False, [CAPABILITY_BINARY_CLAIMS])) == ('201018_1', set())
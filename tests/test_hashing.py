@@ -0,0 +1,37 @@
+import hashlib
+import random
+import string
+from concurrent.futures import ThreadPoolExecutor
+
+import hashing
+from hashing import generate_hashes
+
+
+def reference_hashes(payload_string, chunk_size):
+	hashes = []
+	for i in range(0, len(payload_string), chunk_size):
+		hashes.append(hashlib.sha224(payload_string[i:i+chunk_size].encode()).hexdigest())
+	return hashes, hashlib.sha224(''.join(hashes).encode()).hexdigest()
+
+
+def test_same_hashes_as_reference():
+	payloads = ['', 'a', 'abcd', 'asdasdabsfaksjdas', 'héllo wörld ✓ 12345', ''.join(random.choices(string.printable, k=1001))]
+	for payload in payloads:
+		for chunk_size in (1, 3, 4, 64):
+			assert generate_hashes(payload, chunk_size) == reference_hashes(payload, chunk_size)
+
+
+def test_parallel_hashing(monkeypatch):
+	monkeypatch.setattr(hashing, 'PARALLEL_THRESHOLD', 1000)
+	monkeypatch.setattr(hashing, 'HASH_WORKERS', 3)
+	payload = ''.join(random.choices(string.ascii_letters, k=10007))
+	for chunk_size in (4, 7):
+		assert generate_hashes(payload, chunk_size) == reference_hashes(payload, chunk_size)
+
+
+def test_one_pool(monkeypatch):
+	monkeypatch.setattr(hashing, '_pool', None)
+	with ThreadPoolExecutor(8) as threads:
+		pools = list(threads.map(lambda _: hashing._get_pool(), range(8)))
+	assert all(pool is pools[0] for pool in pools)
+	pools[0].shutdown()
@@ -0,0 +1,30 @@
+from histogram import Histogram, Registry
+
+
+def test_percentiles():
+	h = Histogram()
+	assert h.percentile(50) is None
+	for _ in range(90):
+		h.observe(0.001)
+	for _ in range(10):
+		h.observe(0.5)
+	# Estimates stay inside the bucket of the true value, buckets are a factor 2 wide
+	assert 0.0005 < h.percentile(50) <= 0.00128
+	assert 0.25 < h.percentile(99) <= 0.65536
+	summary = h.summary()
+	assert summary['count'] == 100 and abs(summary['mean'] - 0.0509) < 1e-9
+
+
+def test_prometheus_text():
+	stats = Registry()
+	stats.observe('request_seconds', 0.003, path='/get_payload/')
+	stats.observe('request_seconds', 100, path='/get_payload/')
+	with stats.time('request_seconds', path='/get_peers/'):
+		pass
+	text = stats.prometheus()
+	assert text.count('# TYPE request_seconds histogram') == 1
+	assert 'request_seconds_bucket{path="/get_payload/",le="0.00512"} 1' in text
+	assert 'request_seconds_bucket{path="/get_payload/",le="+Inf"} 2' in text
+	assert 'request_seconds_count{path="/get_payload/"} 2' in text
+	assert 'request_seconds_count{path="/get_peers/"} 1' in text
+	assert stats.summary()['request_seconds']['{path="/get_payload/"}']['count'] == 2
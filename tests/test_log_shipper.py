@@ -0,0 +1,28 @@
+import redis
+
+from log_shipper import LogShipper, POLICY_DROP
+
+
+def test_batches_and_flush():
+	conn = redis.StrictRedis()
+	conn.delete('p2p:test_shipper', 'counters:test_shipper')
+	shipper = LogShipper(conn, batch_size=7, flush_interval=10)
+	shipper.start()
+	for i in range(20):
+		shipper.ship('p2p:test_shipper', [('counters:test_shipper', 'VERIFY_CLAIM')], f'log {i}', trim=9)
+	assert shipper.flush()
+	assert int(conn.hget('counters:test_shipper', 'VERIFY_CLAIM')) == 20
+	logs = [l.decode() for l in conn.lrange('p2p:test_shipper', 0, -1)]
+	assert len(logs) == 10 and logs[0].endswith('log 19') and logs[-1].endswith('log 10')
+
+	shipper.close()
+	shipper.ship('p2p:test_shipper', [('counters:test_shipper', 'VERIFY_CLAIM')], 'after close')
+	assert int(conn.hget('counters:test_shipper', 'VERIFY_CLAIM')) == 21
+	conn.delete('p2p:test_shipper', 'counters:test_shipper')
+
+
+def test_drop_when_full():
+	shipper = LogShipper(redis.StrictRedis(), max_queue=5, policy=POLICY_DROP)
+	for i in range(8):
+		shipper.ship('p2p:test_dropped', [('counters:test_dropped', 'VERIFY_CLAIM')], f'log {i}')
+	assert shipper.dropped == 3 and shipper.queue.qsize() == 5
@@ -0,0 +1,46 @@
+import hashlib
+
+from merkle import MerkleBuilder, merkle_levels, proof_path, verify_proof, hash_pair
+
+
+def reference_levels(leaves):
+	levels = [list(leaves)]
+	while len(levels[-1]) > 1:
+		level = levels[-1]
+		parents = [hash_pair(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+		if len(level) % 2:
+			parents.append(level[-1])
+		levels.append(parents)
+	return levels
+
+
+def test_levels_and_proofs():
+	for count in range(1, 40):
+		leaves = [hashlib.sha224(str(i).encode()).digest() for i in range(count)]
+		levels = merkle_levels(leaves)
+		assert levels == reference_levels(leaves)
+		root = levels[-1][0]
+		for index in range(count):
+			proof = [levels[level][sibling] for level, sibling, _ in proof_path(index, count)]
+			assert verify_proof(leaves[index], index, count, proof, root)
+			assert not verify_proof(leaves[index], (index + 1) % count, count, proof, root) or count == 1
+
+
+def test_flush_while_building():
+	leaves = [hashlib.sha224(str(i).encode()).digest() for i in range(100)]
+	builder = MerkleBuilder()
+	collected = []
+	for i, leaf in enumerate(leaves):
+		builder.add(leaf)
+		if i % 7 == 0:
+			for level, nodes in enumerate(builder.flush()):
+				if level == len(collected):
+					collected.append([])
+				collected[level].extend(nodes)
+	builder.finish()
+	for level, nodes in enumerate(builder.flush()):
+		if level == len(collected):
+			collected.append([])
+		collected[level].extend(nodes)
+	assert collected == reference_levels(leaves)
+	assert builder.root == collected[-1][0]
@@ -0,0 +1,38 @@
+import sys
+
+from payload_cache import ChunkView, PayloadCache
+
+
+def test_chunk_view():
+	payload = 'abcdefghij'
+	chunks = ChunkView(payload, 4)
+	assert len(chunks) == 3
+	assert list(chunks) == ['abcd', 'efgh', 'ij']
+	assert chunks[-1] == 'ij' and chunks[1:] == ['efgh', 'ij']
+	assert len(ChunkView('', 4)) == 0
+
+
+def test_eviction_and_refetch():
+	store = {f'p{i}': str(i) * 1000 for i in range(5)}
+	loads = []
+
+	def loader(payloadId):
+		loads.append(payloadId)
+		return store[payloadId]
+
+	cache = PayloadCache(max_bytes=3 * sys.getsizeof(store['p0']), loader=loader)
+	for payloadId, payload in store.items():
+		cache[payloadId] = payload
+	assert len(cache) == 5 and 'p0' in cache
+	assert not cache.is_cached('p0') and not cache.is_cached('p1')
+	assert cache.size <= cache.max_bytes
+
+	assert cache['p4'] == store['p4']
+	assert cache.chunks('p0')[0] == '0000'
+	assert loads == ['p0']
+	assert cache.is_cached('p0') and not cache.is_cached('p2')
+	assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+	assert cache.chunks('unknown') is None
+	del cache['p0']
+	assert 'p0' not in cache and cache.chunks('p0') is None
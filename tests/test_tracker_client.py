@@ -0,0 +1,52 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tracker_client import TrackerClient, AsyncTrackerClient
+
+TRACKER = "http://127.0.0.1:8000"
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1" # keep-alive
+	clients = []
+
+	def do_GET(self):
+		self.clients.append(self.client_address)
+		self.send_response(200)
+		self.send_header("Content-Length", "2")
+		self.end_headers()
+		self.wfile.write(b"{}")
+
+	def log_message(self, *args):
+		pass
+
+
+def test_keep_alive():
+	server = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	client = TrackerClient(pool_size=2, connect_timeout=1, read_timeout=2)
+	try:
+		for _ in range(5):
+			r = client.request('GET', f"http://127.0.0.1:{server.server_address[1]}/get_peers/")
+			assert r.status_code == 200 and r.json() == {}
+	finally:
+		client.close()
+		server.shutdown()
+		server.server_close()
+	# Every request came from the same client address, over one connection
+	assert len(RecordingHandler.clients) == 5 and len(set(RecordingHandler.clients)) == 1
+
+
+def test_async_client():
+	pytest.importorskip('httpx') # AsyncTrackerClient is optional
+
+	async def run():
+		client = AsyncTrackerClient(pool_size=2)
+		responses = await asyncio.gather(*[client.request('GET', f"{TRACKER}/get_peers/") for _ in range(4)])
+		await client.close()
+		return responses
+
+	assert all(r.status_code == 200 for r in asyncio.run(run()))